@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import Doctor
+from utils.projection import Projection
 
 class DoctorSerializer(serializers.ModelSerializer):
     class Meta:
@@ -13,4 +14,7 @@ class DoctorSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 f"Unknown field(s): {', '.join(unknown_fields)}"
             )
-        return data
\ No newline at end of file
+        return data
+
+# read-only fast path for DoctorList
+doctor_projection = Projection(DoctorSerializer)
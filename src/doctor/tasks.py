@@ -1,12 +1,53 @@
 from celery import shared_task
+from django.db import transaction
+from hospital.models import HospitalDepartment
+from utils import context
+from utils.audit import audit
+from utils.cache import invalidate_model
 from .models import *
 from .serializer import *
 
-@shared_task(serializer='pickle')
-def create_object_task(name, hospital, department):
+# arguments are plain ids, the worker reads the hospital and department as they are when the task
+# runs instead of unpickling copies taken when it was queued
+@shared_task
+def create_object_task(name, hospital_id, department_id):
     doctor = Doctor.objects.create(
         name=name,
-        hospital=hospital,
-        department=department
+        hospital_id=hospital_id,
+        department_id=department_id
     )
-    return DoctorSerializer(doctor).data
\ No newline at end of file
+    return DoctorSerializer(doctor).data
+
+# many doctors in one message and one insert, rows are [name, hospital_id, department_id]. rows
+# whose hospital and department aren't linked are skipped and reported back
+@shared_task
+def create_objects_task(rows):
+    # the links as they are now in one query, the name index can be behind another worker's change
+    linked = set(HospitalDepartment.objects.filter(
+        hospital_id__in={hospital_id for _, hospital_id, _ in rows},
+        department_id__in={department_id for _, _, department_id in rows},
+    ).values_list('hospital_id', 'department_id'))
+
+    doctors, skipped = [], []
+    for i, (name, hospital_id, department_id) in enumerate(rows):
+        if (hospital_id, department_id) in linked:
+            doctors.append(Doctor(name=name, hospital_id=hospital_id, department_id=department_id))
+        else:
+            skipped.append(i)
+
+    with transaction.atomic():
+        created = Doctor.objects.bulk_create(doctors)
+        # bulk_create skips post_save, drop the cached doctor lists and write one audit entry for the batch
+        invalidate_model(Doctor)
+        if created:
+            ctx = context.get()
+            transaction.on_commit(lambda: audit.record(
+                action=f"POST REQUEST: Bulk Created {len(created)} Doctor Instances",
+                actor_id=ctx.get('actor_id'),
+                ip_address=ctx.get('ip_address'),
+                method='POST',
+                # mysql doesn't hand back the ids of a bulk insert
+                metadata={'model': 'Doctor', 'count': len(created), 'request_id': ctx.get('request_id'),
+                          'instance_ids': [doctor.pk for doctor in created if doctor.pk is not None]},
+            ))
+    return {"created": len(created), "skipped": skipped}
@@ -49,6 +49,12 @@ class DoctorModelTest(TestCase):
 from django.test import TestCase, Client
 from django.contrib.auth.models import User, Permission
 from hospital.models import HospitalDepartment
+from utils import streaming
+from utils.pagination import MAX_PAGE_SIZE, encode_cursor
+from unittest import mock
+from hospital.index import name_index
+from .tasks import create_object_task, create_objects_task
+from rest_framework_simplejwt.tokens import AccessToken
 import json
 
 class DoctorViewTests(TestCase):
@@ -109,6 +115,64 @@ class DoctorViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['name'], 'Dr. Updated')
 
+    def test_update_invalidates_cached_doctor(self):
+        # warm both the detail and the list cache
+        self.client.get(f'/doctor/{self.doctor.id}')
+        self.client.get('/doctors')
+        data = {
+            'name': 'Dr. Renamed',
+            'hospital': 'Test Hospital',
+            'department': 'Test Department'
+        }
+        self.client.put(f'/doctor/{self.doctor.id}', data=json.dumps(data), content_type='application/json')
+        self.assertEqual(self.client.get(f'/doctor/{self.doctor.id}').json()['name'], 'Dr. Renamed')
+        self.assertEqual(self.client.get('/doctors').json()[0]['name'], 'Dr. Renamed')
+
+    def test_delete_invalidates_cached_list(self):
+        self.client.get('/doctors')
+        self.client.delete(f'/doctor/{self.doctor.id}')
+        self.assertEqual(self.client.get('/doctors').json(), [])
+
+    def test_doctor_list_pagination(self):
+        for i in range(4):
+            Doctor.objects.create(name=f"Dr. Page {i}", hospital=self.hospital, department=self.department)
+
+        names, url = [], '/doctors?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json()), 2)
+            names += [doctor['name'] for doctor in response.json()]
+            cursor = response.headers.get('X-Next-Cursor')
+            url = f'/doctors?page_size=2&cursor={cursor}' if cursor else None
+
+        self.assertEqual(names, ['Dr. Test'] + [f"Dr. Page {i}" for i in range(4)])
+
+    def test_doctor_list_invalid_cursor(self):
+        response = self.client.get('/doctors?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 400)
+        # well formed, but not an id
+        for values in (["abc"], [{"x": 1}], [None], [[1]]):
+            with self.subTest(values=values):
+                response = self.client.get('/doctors', {'cursor': encode_cursor(values)})
+                self.assertEqual(response.status_code, 400)
+
+    def test_doctor_list_stream(self):
+        for i in range(4):
+            Doctor.objects.create(name=f"Dr. Stream {i}", hospital=self.hospital, department=self.department)
+        page = self.client.get(f'/doctors?page_size={MAX_PAGE_SIZE}')
+
+        # the streamed array is the same body as the unpaginated list, just sent in pieces
+        with mock.patch.object(streaming, 'STREAM_CHUNK_SIZE', 2):
+            response = self.client.get('/doctors?stream=1')
+        self.assertTrue(response.streaming)
+        self.assertEqual(b"".join(response.streaming_content), page.content)
+
+        response = self.client.get('/doctors?stream=ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], page.json())
+
     def test_delete_doctor(self):
         response = self.client.delete(f'/doctor/{self.doctor.id}')
         self.assertEqual(response.status_code, 204)
@@ -135,6 +199,64 @@ class DoctorViewTests(TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertIsInstance(response.json(), dict)
 
+class DoctorAsyncViewTests(TestCase):
+    def setUp(self):
+        self.hospital = Hospital.objects.create(name="Async Hospital", addr="x")
+        self.department = Department.objects.create(name="Async Department")
+        HospitalDepartment.objects.create(hospital=self.hospital, department=self.department)
+        self.doctors = [
+            Doctor.objects.create(name=f"Dr. Async {i}", hospital=self.hospital, department=self.department)
+            for i in range(3)
+        ]
+        self.user = User.objects.create_user(username='asyncuser', password='pass')
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='view_doctor'),
+            Permission.objects.get(codename='change_doctor'),
+        )
+        self.client = Client()
+        self.client.login(username='asyncuser', password='pass')
+
+    def test_same_answers_as_sync(self):
+        doctor = self.doctors[0]
+        for path in (f'/doctor/{doctor.id}', '/doctors', '/doctors?page_size=2'):
+            sync, async_ = self.client.get(path), self.client.get('/async' + path)
+            self.assertEqual(async_.status_code, 200)
+            self.assertEqual(async_.content, sync.content)
+            self.assertEqual(async_.get('X-Next-Cursor'), sync.get('X-Next-Cursor'))
+
+        cursor = self.client.get('/async/doctors?page_size=2')['X-Next-Cursor']
+        response = self.client.get(f'/async/doctors?page_size=2&cursor={cursor}')
+        self.assertEqual([d['name'] for d in response.json()], ["Dr. Async 2"])
+        self.assertEqual(self.client.get('/async/doctors?cursor=not-a-cursor').status_code, 400)
+
+    def test_sees_sync_writes(self):
+        doctor = self.doctors[0]
+        self.client.get(f'/async/doctor/{doctor.id}')
+        self.client.get('/async/doctors')
+        data = {'name': 'Dr. Renamed', 'hospital': 'Async Hospital', 'department': 'Async Department'}
+        self.client.put(f'/doctor/{doctor.id}', data=json.dumps(data), content_type='application/json')
+        self.assertEqual(self.client.get(f'/async/doctor/{doctor.id}').json()['name'], 'Dr. Renamed')
+        self.assertEqual(self.client.get('/async/doctors').json()[0]['name'], 'Dr. Renamed')
+
+    def test_authentication_and_permission(self):
+        self.assertEqual(Client().get('/async/doctors').status_code, 401)
+        User.objects.create_user(username='noperm', password='pass')
+        client = Client()
+        client.login(username='noperm', password='pass')
+        self.assertEqual(client.get('/async/doctors').status_code, 403)
+        self.assertEqual(client.get(f'/async/doctor/{self.doctors[0].id}').status_code, 403)
+
+    async def test_jwt_on_event_loop(self):
+        token = str(AccessToken.for_user(self.user))
+        response = await self.async_client.get(
+            f'/async/doctor/{self.doctors[1].id}', headers={"Authorization": f"Bearer {token}"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], "Dr. Async 1")
+
+        response = await self.async_client.get('/async/doctors', headers={"Authorization": "Bearer broken"})
+        self.assertEqual(response.status_code, 401)
+
 class DoctorAuthenticationAuthorizationTests(TestCase):
     def setUp(self):
         self.hospital = Hospital.objects.create(name="Test Hospital")
@@ -172,3 +294,48 @@ class DoctorAuthenticationAuthorizationTests(TestCase):
         response = self.client.delete(f'/doctor/{self.doctor.id}')
         self.assertEqual(response.status_code, 403)
 
+
+class DoctorProjectionTests(TestCase):
+    def test_same_json_as_serializer(self):
+        from rest_framework.renderers import JSONRenderer
+        from .serializer import DoctorSerializer, doctor_projection
+        hospital = Hospital.objects.create(name="Projection Hospital", addr="x")
+        department = Department.objects.create(name="Projection Department")
+        Doctor.objects.create(name="Dr. Active", hospital=hospital, department=department)
+        Doctor.objects.create(name="Dr. Inactive", hospital=hospital, department=department, active=False)
+
+        queryset = Doctor.objects.order_by('id')
+        expected = JSONRenderer().render(DoctorSerializer(list(queryset), many=True).data)
+        actual = JSONRenderer().render(doctor_projection.serialize(doctor_projection.queryset(queryset)))
+        self.assertEqual(actual, expected)
+
+class DoctorTaskTests(TestCase):
+    def setUp(self):
+        self.hospital = Hospital.objects.create(name="Task Hospital", addr="x")
+        self.department = Department.objects.create(name="Task Department")
+        self.other = Department.objects.create(name="Unlinked Department")
+        HospitalDepartment.objects.create(hospital=self.hospital, department=self.department)
+
+    def test_create_from_ids(self):
+        data = create_object_task.apply(args=("Dr. Task", self.hospital.id, self.department.id)).get()
+        self.assertEqual(data["name"], "Dr. Task")
+        self.assertEqual(data["hospital"], self.hospital.id)
+        # the result has to survive the json result serializer
+        json.dumps(data)
+
+    def test_bulk_create_from_ids(self):
+        rows = [["Dr. A", self.hospital.id, self.department.id], ["Dr. B", self.hospital.id, self.other.id]]
+        with mock.patch('doctor.tasks.audit.record') as record, self.captureOnCommitCallbacks(execute=True):
+            result = create_objects_task.apply(args=(rows,)).get()
+        self.assertEqual(result, {"created": 1, "skipped": [1]})
+        self.assertEqual(list(Doctor.objects.values_list('name', flat=True)), ["Dr. A"])
+        # one audit entry for the batch
+        record.assert_called_once()
+        self.assertEqual(record.call_args.kwargs["metadata"]["count"], 1)
+
+    def test_bulk_create_sees_links_the_index_missed(self):
+        name_index.load()
+        # linked elsewhere without signals( another worker's bulk insert ), the index doesn't know yet
+        HospitalDepartment.objects.bulk_create([HospitalDepartment(hospital=self.hospital, department=self.other)])
+        result = create_objects_task.apply(args=([["Dr. C", self.hospital.id, self.other.id]],)).get()
+        self.assertEqual(result, {"created": 1, "skipped": []})
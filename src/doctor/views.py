@@ -4,30 +4,29 @@ from rest_framework import status
 from django.template.response import ContentNotRenderedError
 from .models import *
 from hospital.models import *
+from hospital.index import name_index
 from .serializer import *
 from django.contrib.auth.decorators import permission_required
 from django.utils.decorators import method_decorator
 from rest_framework.permissions import IsAuthenticated
 from django.core.cache import cache
+from utils.cache import detail_key, CACHE_TTL
+from utils.pagination import KeysetPaginator, InvalidCursor, cached_page, acached_page
+from utils.streaming import stream_format, stream_response
+from utils.async_cache import acache, adetail_key
+from utils.async_views import AsyncReadView, json_response
 import json
 
+# names resolve through the process-local index, the database is only hit on a miss
 def get_hospital_id(hospital_name):
-    try:
-        hospital = Hospital.objects.get(name=hospital_name)
-        return hospital.id  # Return the hospital ID
-    except Hospital.DoesNotExist:
-        return None
+    return name_index.hospital_id(hospital_name)
 
 def get_department_id(department_name):
-    try:
-        department = Department.objects.get(name=department_name)
-        return department.id  # Return the department ID
-    except Department.DoesNotExist:
-        return None
+    return name_index.department_id(department_name)
 
 def check_valid_pair(hospital_name, department_name):
     hospital, department = get_hospital_id(hospital_name), get_department_id(department_name)
-    is_valid = HospitalDepartment.objects.filter(hospital=hospital, department=department).exists()
+    is_valid = hospital is not None and department is not None and name_index.is_linked(hospital, department)
     return [hospital, department, is_valid]
 
 class DoctorList(APIView):
@@ -35,13 +34,18 @@ class DoctorList(APIView):
 
     @method_decorator(permission_required('doctor.view_doctor', raise_exception=True))
     def get(self, request):
-        cached_data = cache.get('doctor_list')
-        if cached_data is not None:
-            return Response(cached_data, status=status.HTTP_200_OK)
-        doctors = Doctor.objects.all()
-        serializer = DoctorSerializer(doctors, many=True)
-        cache.set('doctor_list', serializer.data, timeout=60*10)
-        return Response(serializer.data)
+        fmt = stream_format(request)
+        if fmt:
+            return stream_response(doctor_projection.queryset(Doctor.objects.order_by('id')), doctor_projection.serialize, fmt)
+
+        try:
+            paginator = KeysetPaginator(request, Doctor)
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = cached_page(
+            paginator, Doctor, doctor_projection.queryset(Doctor.objects.all()), doctor_projection.serialize
+        )
+        return Response(data, status=status.HTTP_200_OK, headers=paginator.get_headers(next_cursor))
     
     @method_decorator(permission_required('doctor.change_doctor', raise_exception=True))
     def post(self, request):
@@ -60,14 +64,10 @@ class DoctorList(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Get Hospital and Department instances from their IDs
-        hospital = Hospital.objects.get(id=hospital_id)
-        department = Department.objects.get(id=department_id)
-
         doctor = Doctor.objects.create(
             name=name,
-            hospital=hospital,
-            department=department
+            hospital_id=hospital_id,
+            department_id=department_id
         )
         doctor_serializer = DoctorSerializer(doctor)
         return Response(doctor_serializer.data, status=status.HTTP_202_ACCEPTED)
@@ -83,14 +83,15 @@ class DoctorView(APIView):
 
     @method_decorator(permission_required('doctor.view_doctor', raise_exception=True))
     def get(self, request, pk):
-        cached_data = cache.get(f'doctor_{pk}')
+        key = detail_key(Doctor, pk)
+        cached_data = cache.get(key)
         if cached_data is not None:
             return Response(cached_data, status=status.HTTP_200_OK)
         doctor = self.get_object(pk)
         if not doctor:
             return Response(status.HTTP_400_BAD_REQUEST)
         serializer = DoctorSerializer(doctor)
-        cache.set(f'doctor_{pk}', serializer.data, timeout=60*10)
+        cache.set(key, serializer.data, timeout=CACHE_TTL)
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     @method_decorator(permission_required('doctor.change_doctor', raise_exception=True))
@@ -132,4 +133,35 @@ class DoctorView(APIView):
         if not doctor:
             return Response(status=status.HTTP_400_BAD_REQUEST)
         doctor.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+# async versions of the read endpoints, under /async/( utils/async_views.py )
+
+class AsyncDoctorList(AsyncReadView):
+    permission = 'doctor.view_doctor'
+
+    async def get(self, request):
+        try:
+            paginator = KeysetPaginator(request, Doctor)
+        except InvalidCursor as e:
+            return json_response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = await acached_page(
+            paginator, Doctor, doctor_projection.queryset(Doctor.objects.all()), doctor_projection.serialize
+        )
+        return json_response(data, headers=paginator.get_headers(next_cursor))
+
+class AsyncDoctorView(AsyncReadView):
+    permission = 'doctor.view_doctor'
+
+    async def get(self, request, pk):
+        key = await adetail_key(Doctor, pk)
+        cached_data = await acache.get(key)
+        if cached_data is not None:
+            return json_response(cached_data)
+        try:
+            doctor = await Doctor.objects.aget(pk=pk)
+        except Doctor.DoesNotExist:
+            return json_response(None, status=status.HTTP_400_BAD_REQUEST)
+        data = DoctorSerializer(doctor).data
+        await acache.set(key, data, timeout=CACHE_TTL)
+        return json_response(data)
@@ -3,13 +3,27 @@ from celery import Celery
 from celery.schedules import crontab
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hms.settings")
-app = Celery("hms")
+# tasks run inside the request context of whoever queued them, see utils/context.py
+app = Celery("hms", task_cls="utils.context:ContextTask")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
     'send_emails_to_patient': {
-        'task': 'utils.tasks.send_email_task',
+        'task': 'patient.tasks.send_patient_notifications',
         'schedule': crontab(hour=15, minute=8),
     },
+    # picks up runs whose workers died halfway
+    'resume_patient_notifications': {
+        'task': 'patient.tasks.resume_notification_runs',
+        'schedule': crontab(minute='*/10'),
+    },
+    'reconcile_occupancy': {
+        'task': 'patient.tasks.reconcile_occupancy',
+        'schedule': crontab(minute='*/5'),
+    },
+    'update_reporting_rollups': {
+        'task': 'reporting.tasks.update_rollups',
+        'schedule': crontab(minute='*/5'),
+    },
 }
\ No newline at end of file
@@ -33,9 +33,42 @@ ALLOWED_HOSTS = ['10.10.0.71', 'localhost', '127.0.0.1']
 # CELERY SETTINGS
 CELERY_BROKER_URL = os.getenv('REDIS_SERVICE')
 CELERY_RESULT_BACKEND = os.getenv('REDIS_SERVICE')
+# task arguments are ids and plain values, never model instances. pickle is still accepted so
+# messages queued by the previous release drain, drop it once they have
 CELERY_ACCEPT_CONTENT = ['json', 'pickle']
-CELERY_TASK_SERIALIZER = 'pickle'
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
 CELERY_RESULT_BACKEND = 'redis'
+# /tasks/status, ids per request and the longest a long-poll is held( it polls the backend with one
+# MGET every interval ), on /async/tasks/status and on the sync view that ties up a worker meanwhile
+TASK_STATUS_MAX_IDS = 500
+TASK_STATUS_MAX_WAIT = 30
+TASK_STATUS_SYNC_MAX_WAIT = 2
+TASK_STATUS_POLL_INTERVAL = 0.5
+
+# outgoing mail( utils.emailer ), every worker keeps one authenticated session open and reuses it
+EMAIL_HOST = os.getenv('EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = int(os.getenv('EMAIL_PORT', 587))
+EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', '1') == '1'
+EMAIL_TIMEOUT = 30
+EMAIL_IDLE_TIMEOUT = 60 # seconds a session may sit unused before it's replaced
+EMAIL_MAX_PER_CONNECTION = 100
+EMAIL_MAX_RETRIES = 5 # send_email_batch_task, transient failures only
+EMAIL_RETRY_DELAY = 30 # doubles on every retry
+
+# scheduled patient notifications( patient.tasks ), patients per chunk task, chunk tasks in flight
+# at once and the seconds a chunk may stay claimed before it's handed to another worker
+PATIENT_NOTIFICATION_CHUNK_SIZE = 500
+PATIENT_NOTIFICATION_CONCURRENCY = 8
+PATIENT_NOTIFICATION_LEASE = 15 * 60
+PATIENT_NOTIFICATION_MAX_ATTEMPTS = 5
+
+# reporting rollups( reporting.rollup ), visits folded in per transaction, transactions per run, and
+# the seconds a changed visit is left alone so a slower transaction can't commit behind the watermark
+REPORTING_BATCH_SIZE = 5000
+REPORTING_MAX_BATCHES = 50
+REPORTING_WATERMARK_LAG = 60
+REPORT_MAX_DAYS = 366
 
 # Application definition
 
@@ -57,7 +90,8 @@ INSTALLED_APPS = [
     'doctor',
     'hospital',
     'patient',
-    'utils'
+    'utils',
+    'reporting',
 ]
 
 MIDDLEWARE = [
@@ -71,8 +105,9 @@ MIDDLEWARE = [
 
     #self
     # 'hms.middleware.LogRequestDataMiddleware',
-    'utils.middleware.RequestMiddleware',
     'utils.middleware.AuditLogMiddleware',
+    # after AuditLogMiddleware, the request context is built from what it resolved
+    'utils.middleware.RequestMiddleware',
 ]
 
 ROOT_URLCONF = 'hms.urls'
@@ -95,9 +130,13 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'hms.wsgi.application'
 
+# ModelBackend with cached permission sets, see utils/backends.py
+AUTHENTICATION_BACKENDS = ['utils.backends.CachedPermissionBackend']
+PERMISSION_CACHE_LOCAL_TTL = 5
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'utils.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     )
     ## TODO: LATER
@@ -105,6 +144,13 @@ REST_FRAMEWORK = {
 }
 
 
+# keyset pagination for list endpoints, clients pick a size with ?page_size= up to the max
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# ?stream=1 / ?stream=ndjson on a list endpoint sends every row, this many are read and encoded at a time
+STREAM_CHUNK_SIZE = 2000
+
+
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
@@ -137,6 +183,15 @@ CACHES = {
     }
 }
 
+# audit log writes, see utils/audit.py. 'buffered' bulk inserts from a background thread,
+# 'celery' hands the batches to a task, 'sync' inserts inside the request
+AUDIT_LOG_MODE = os.getenv('AUDIT_LOG_MODE', 'buffered')
+AUDIT_BATCH_SIZE = 200
+AUDIT_FLUSH_INTERVAL = 1.0
+
+# ttl for cached api responses, writes invalidate them through utils.cache generations
+CACHE_TTL = 60*60*6
+
 # Optional: This is to ensure Django sessions are stored in Redis
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 SESSION_CACHE_ALIAS = 'default'
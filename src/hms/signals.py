@@ -1,12 +1,14 @@
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
 from utils.logger import log, Level
 from utils.models import Log
+from utils.audit import audit
+from utils.cache import invalidate_on_save, invalidate_on_delete
 from django.apps import apps
+from functools import partial
 import json
 
-alog = Log()
-
 def model_to_json(instance):
     serialized = {}
     for key, value in instance.__dict__.items():
@@ -18,29 +20,32 @@ def model_to_json(instance):
     return serialized
 
 from django.core.handlers.wsgi import WSGIRequest
-import threading
+from utils import context
 import json
 
 def log_model_save(sender, instance, created, **kwargs):
     try:
-        # store request stuff in thread local storage( for the log )
-        request = getattr(threading.current_thread(), '_current_request', None)
+        # who and where from, bound by RequestMiddleware or carried into a task( utils/context.py )
+        ctx = context.get()
         metadata = {
             'model': sender.__name__,
             'instance_id': instance.id,
-            'instance_data': str(instance)  # or a more detailed serialization if needed
+            'instance_data': str(instance),  # or a more detailed serialization if needed
+            'request_id': ctx.get('request_id'),
         }
         method = 'POST' if created else 'PUT/PATCH'
         action_type = 'Created' if created else 'Updated'
         
-        # make log entry
-        alog.log_action(
+        # queue the log entry once the write commits( a rolled back save leaves none ), utils.audit
+        # writes it in a batch off the request path
+        transaction.on_commit(partial(
+            audit.record,
             action=f"{method} REQUEST: {action_type} {sender.__name__} Instance - {instance.id}",
-            actor=getattr(request, 'jwt_user', None) if request else None,
-            ip_address=getattr(request, 'client_ip', None) if request else None,
+            actor_id=ctx.get('actor_id'),
+            ip_address=ctx.get('ip_address'),
             method=method,
             metadata=metadata
-        )
+        ), using=kwargs.get('using'))
         
         log(Level.INFO, f"{action_type} Action Recorded into Action Log for {sender.__name__}!")
     except AttributeError:
@@ -59,21 +64,23 @@ def log_model_save(sender, instance, created, **kwargs):
 
 def log_model_delete(sender, instance, **kwargs):
     try:
-        request = getattr(threading.current_thread(), '_current_request', None)
+        ctx = context.get()
         
         metadata = {
             'model': sender.__name__,
             'instance_id': instance.id,
-            'instance_data': str(instance)
+            'instance_data': str(instance),
+            'request_id': ctx.get('request_id'),
         }
         
-        alog.log_action(
+        transaction.on_commit(partial(
+            audit.record,
             action=f"DELETE REQUEST: Deleted {sender.__name__} Instance - {instance.id}",
-            actor=getattr(request, 'jwt_user', None) if request else None,
-            ip_address=getattr(request, 'client_ip', None) if request else None,
+            actor_id=ctx.get('actor_id'),
+            ip_address=ctx.get('ip_address'),
             method='DELETE',
             metadata=metadata
-        )
+        ), using=kwargs.get('using'))
         
         log(Level.INFO, f"Delete Action Recorded into Action Log for {sender.__name__}!")
     except AttributeError:
@@ -86,4 +93,7 @@ excluded = [Log] # dont log the log because recursion
 for model in apps.get_models():
     if model not in excluded:
         post_save.connect(log_model_save, sender=model)
-        post_delete.connect(log_model_delete, sender=model)
\ No newline at end of file
+        post_delete.connect(log_model_delete, sender=model)
+        # bump the model's cache generations so cached lists/details of it go stale
+        post_save.connect(invalidate_on_save, sender=model)
+        post_delete.connect(invalidate_on_delete, sender=model)
\ No newline at end of file
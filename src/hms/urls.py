@@ -20,6 +20,7 @@ from hospital.views import *
 from doctor.views import *
 from patient.views import *
 from utils.views import *
+from reporting.views import *
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -31,15 +32,34 @@ urlpatterns = [
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
 
     path('task/<uuid:task_id>', TaskView.as_view(), name="Task View"),
+    path('tasks/status', TaskStatusView.as_view(), name="Task Status View"),
     path('hospitals', HospitalList.as_view(), name='Hospital List'),
+    path('hospitals/bulk', HospitalBulkList.as_view(), name='Hospital Bulk List'),
     path('hospital/<int:pk>', HospitalView.as_view(), name='Hospital View'),
+    path('hospital/<int:pk>/occupancy', HospitalOccupancyView.as_view(), name='Hospital Occupancy View'),
     path('departments', DepartmentList.as_view(), name='Department List'),
     path('department/<int:pk>', DepartmentView.as_view(), name='Department View'),
     path('doctors', DoctorList.as_view(), name='Doctor List'),
     path('doctor/<int:pk>', DoctorView.as_view(), name='Doctor View'),
     path('patients', PatientList.as_view(), name='Patient List'),
+    path('patients/bulk', PatientBulkList.as_view(), name='Patient Bulk List'),
+    path('patients/activate', PatientActivateView.as_view(), name='Patient Activate View'),
+    path('patients/search', PatientSearchView.as_view(), name='Patient Search View'),
     path('patient/<int:pk>', PatientView.as_view(), name='Patient View'),
     path('patient/status/<int:pk>', StatusView.as_view(), name="Status View"),
     path('visits', VisitList.as_view(), name='Visit List'),
-    path('visit/<int:pk>', VisitView.as_view(), name='Visit View')
+    path('visit/<int:pk>', VisitView.as_view(), name='Visit View'),
+    path('reports/visits', VisitReportView.as_view(), name='Visit Report View'),
+    path('reports/admissions', AdmissionReportView.as_view(), name='Admission Report View'),
+
+    # async read endpoints, same answers as the ones above but native under asgi
+    path('async/hospitals', AsyncHospitalList.as_view(), name='Async Hospital List'),
+    path('async/hospital/<int:pk>', AsyncHospitalView.as_view(), name='Async Hospital View'),
+    path('async/departments', AsyncDepartmentList.as_view(), name='Async Department List'),
+    path('async/department/<int:pk>', AsyncDepartmentView.as_view(), name='Async Department View'),
+    path('async/doctors', AsyncDoctorList.as_view(), name='Async Doctor List'),
+    path('async/doctor/<int:pk>', AsyncDoctorView.as_view(), name='Async Doctor View'),
+    path('async/patient/status/<int:pk>', AsyncStatusView.as_view(), name='Async Status View'),
+    path('async/visit/<int:pk>', AsyncVisitView.as_view(), name='Async Visit View'),
+    path('async/tasks/status', AsyncTaskStatusView.as_view(), name='Async Task Status View'),
 ]
@@ -0,0 +1,152 @@
+from django.conf import settings
+from utils.cache import write_snapshot, only_own_writes
+from .models import *
+import threading
+import time
+
+# how often a worker checks the shared cache for hospital/department writes made by other workers
+CHECK_INTERVAL = getattr(settings, 'NAME_INDEX_CHECK_INTERVAL', 5)
+
+# process-local copy of the hospital and department names and the valid hospital-department pairs,
+# so validating a pair is a couple of dict lookups instead of three queries. the whole thing is
+# loaded on first use, kept current by the signals in hospital/signals.py and falls back to the
+# database when a name or pair isn't in it
+class NameIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._snapshot = None
+        self._checked_at = 0
+        self._hospitals, self._hospital_names = {}, {}
+        self._departments, self._department_names = {}, {}
+        self._pairs = set()
+
+    def _models(self):
+        return (Hospital, Department, HospitalDepartment)
+
+    def load(self):
+        with self._lock:
+            snapshot = write_snapshot(*self._models())
+            hospitals = dict(Hospital.objects.order_by('-id').values_list('id', 'name'))
+            departments = dict(Department.objects.order_by('-id').values_list('id', 'name'))
+            # walking ids high to low leaves the lowest id for a duplicated name, like .first() would
+            self._hospital_names, self._hospitals = hospitals, {name: pk for pk, name in hospitals.items()}
+            self._department_names, self._departments = departments, {name: pk for pk, name in departments.items()}
+            self._pairs = set(HospitalDepartment.objects.values_list('hospital_id', 'department_id'))
+            self._snapshot, self._checked_at, self._loaded = snapshot, time.monotonic(), True
+
+    def clear(self):
+        with self._lock:
+            self._loaded = False
+
+    def _ensure_fresh(self):
+        if self._loaded and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+            return
+        # one thread loads or checks, the others wait for it instead of loading again
+        with self._lock:
+            if not self._loaded:
+                return self.load()
+            if time.monotonic() - self._checked_at < CHECK_INTERVAL:
+                return
+            self._adopt_or_reload()
+
+    # a hit is never checked against the database, so any write another worker made to one of the
+    # tables( a rename, a delete, an unlink ) means a reload. writes of our own are already in here
+    def _adopt_or_reload(self):
+        own, snapshot = only_own_writes(self._snapshot, *self._models())
+        if not own:
+            return self.load()
+        self._snapshot, self._checked_at = snapshot, time.monotonic()
+
+    def hospital_id(self, name):
+        self._ensure_fresh()
+        pk = self._hospitals.get(name)
+        if pk is None:
+            pk = Hospital.objects.filter(name=name).order_by('id').values_list('id', flat=True).first()
+            if pk is not None:
+                self.set_hospital(pk, name)
+        return pk
+
+    def department_id(self, name):
+        self._ensure_fresh()
+        pk = self._departments.get(name)
+        if pk is None:
+            pk = Department.objects.filter(name=name).order_by('id').values_list('id', flat=True).first()
+            if pk is not None:
+                self.set_department(pk, name)
+        return pk
+
+    def hospital_name(self, pk):
+        self._ensure_fresh()
+        name = self._hospital_names.get(pk)
+        if name is None:
+            name = Hospital.objects.filter(pk=pk).values_list('name', flat=True).first()
+            if name is not None:
+                self.set_hospital(pk, name)
+        return name
+
+    def department_name(self, pk):
+        self._ensure_fresh()
+        name = self._department_names.get(pk)
+        if name is None:
+            name = Department.objects.filter(pk=pk).values_list('name', flat=True).first()
+            if name is not None:
+                self.set_department(pk, name)
+        return name
+
+    def is_linked(self, hospital_id, department_id):
+        self._ensure_fresh()
+        if (hospital_id, department_id) in self._pairs:
+            return True
+        linked = HospitalDepartment.objects.filter(hospital_id=hospital_id, department_id=department_id).exists()
+        if linked:
+            self._pairs.add((hospital_id, department_id))
+        return linked
+
+    # incremental updates, called from the save/delete signals once the write is committed
+    def _set(self, ids, names, pk, name):
+        with self._lock:
+            old = names.get(pk)
+            if old is not None and ids.get(old) == pk:
+                del ids[old]
+            names[pk] = name
+            ids.setdefault(name, pk)
+
+    def _remove(self, ids, names, pk):
+        with self._lock:
+            old = names.pop(pk, None)
+            if old is not None and ids.get(old) == pk:
+                del ids[old]
+
+    def set_hospital(self, pk, name):
+        self._set(self._hospitals, self._hospital_names, pk, name)
+
+    def set_department(self, pk, name):
+        self._set(self._departments, self._department_names, pk, name)
+
+    def remove_hospital(self, pk):
+        self._remove(self._hospitals, self._hospital_names, pk)
+        with self._lock:
+            self._pairs = {pair for pair in self._pairs if pair[0] != pk}
+
+    def remove_department(self, pk):
+        self._remove(self._departments, self._department_names, pk)
+        with self._lock:
+            self._pairs = {pair for pair in self._pairs if pair[1] != pk}
+
+    def link(self, hospital_id, department_id):
+        with self._lock:
+            self._pairs.add((hospital_id, department_id))
+
+    def unlink(self, hospital_id, department_id):
+        with self._lock:
+            self._pairs.discard((hospital_id, department_id))
+
+    # after our own write was applied: take the generation it bumped on, unless another worker wrote
+    # meanwhile too, then reload
+    def sync_generation(self):
+        with self._lock:
+            if self._loaded:
+                self._adopt_or_reload()
+
+name_index = NameIndex()
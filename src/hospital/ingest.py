@@ -0,0 +1,191 @@
+from django.db import transaction
+from .models import *
+from utils import context
+from utils.audit import audit
+from utils.cache import invalidate_model
+import codecs
+import json
+
+CHUNK_SIZE = 500
+READ_SIZE = 64 * 1024
+
+# yields one parsed row at a time from a NDJSON or JSON array body, the stream is read in
+# READ_SIZE blocks so the whole payload is never held in memory
+def iter_records(stream, content_type=""):
+    if "ndjson" in content_type or "jsonl" in content_type:
+        yield from _iter_ndjson(stream)
+    else:
+        yield from _iter_json_array(stream)
+
+def _iter_ndjson(stream):
+    buffer = b""
+    while True:
+        block = stream.read(READ_SIZE)
+        if not block:
+            break
+        buffer += block
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _decode(line)
+    if buffer.strip():
+        yield _decode(buffer)
+
+def _decode(line):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+def _iter_json_array(stream):
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos, started, eof = "", 0, False, False
+
+    while True:
+        # skip whitespace and separators between array items
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                started, pos = True, pos + 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if eof:
+                    raise ValueError("Malformed JSON array body")
+            else:
+                # a value ending exactly at the buffer edge might be cut off, read more before trusting it
+                if end < len(buffer) or eof:
+                    yield record
+                    pos = end
+                    continue
+        elif eof:
+            if started:
+                raise ValueError("Unterminated JSON array body")
+            return
+
+        block = stream.read(READ_SIZE)
+        if not block:
+            eof = True
+        else:
+            buffer = buffer[pos:] + (utf8.decode(block) if isinstance(block, bytes) else block)
+            pos = 0
+
+def chunked(records, size=CHUNK_SIZE):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _validate(row):
+    if isinstance(row, Exception):
+        return f"Invalid JSON: {row}"
+    if not isinstance(row, dict):
+        return "Row must be an object"
+    if not isinstance(row.get("name"), str) or not row["name"]:
+        return "Missing field \"name\""
+    if row.get("addr") is not None and not isinstance(row["addr"], str):
+        return "\"addr\" must be a string"
+    departments = row.get("departments", [])
+    if not isinstance(departments, list) or not all(isinstance(d, str) and d for d in departments):
+        return "\"departments\" must be a list of names"
+    return None
+
+# creates the hospitals, departments and their links for one chunk of rows( and moves existing
+# hospitals to a new addr ) with a fixed number of queries, no matter how many rows or departments
+# the chunk has
+def ingest_chunk(rows, offset=0):
+    results = [None] * len(rows)
+    valid = []
+    for i, row in enumerate(rows):
+        error = _validate(row)
+        if error:
+            results[i] = {"row": offset + i, "status": "error", "error": error}
+        else:
+            valid.append((i, row))
+
+    hospital_names = {row["name"] for _, row in valid}
+    department_names = {name for _, row in valid for name in row.get("departments", [])}
+
+    with transaction.atomic():
+        existing = {name: (pk, addr) for name, pk, addr in
+                    Hospital.objects.filter(name__in=hospital_names).values_list("name", "id", "addr")}
+        hospital_ids = {name: pk for name, (pk, _) in existing.items()}
+        department_ids = dict(Department.objects.filter(name__in=department_names).values_list("name", "id"))
+
+        # rows apply in order, the last addr given for a hospital is the one it ends up with. rows
+        # without one leave it as it is and can't create a hospital
+        addrs = {row["name"]: row["addr"] for _, row in valid if row.get("addr")}
+        new_hospitals = {name: Hospital(name=name, addr=addr) for name, addr in addrs.items() if name not in existing}
+        moved = [Hospital(id=existing[name][0], addr=addr) for name, addr in addrs.items()
+                 if name in existing and existing[name][1] != addr]
+        new_departments = department_names - department_ids.keys()
+
+        Hospital.objects.bulk_create(new_hospitals.values(), ignore_conflicts=True)
+        Hospital.objects.bulk_update(moved, ["addr"])
+        Department.objects.bulk_create(
+            [Department(name=name) for name in new_departments], ignore_conflicts=True
+        )
+
+        # bulk_create doesn't hand back ids on every backend, read the new ones back in one go
+        hospital_ids.update(Hospital.objects.filter(name__in=new_hospitals).values_list("name", "id"))
+        department_ids.update(Department.objects.filter(name__in=new_departments).values_list("name", "id"))
+
+        links = {
+            (hospital_ids[row["name"]], department_ids[name])
+            for _, row in valid if row["name"] in hospital_ids
+            for name in row.get("departments", [])
+        }
+        HospitalDepartment.objects.bulk_create(
+            [HospitalDepartment(hospital_id=h, department_id=d) for h, d in links], ignore_conflicts=True
+        )
+
+        # bulk_create/bulk_update skip post_save, so invalidate the cached lists by hand and write one
+        # audit entry for the chunk
+        for model in (Hospital, Department, HospitalDepartment):
+            invalidate_model(model)
+        if new_hospitals or moved or new_departments or links:
+            ctx = context.get()
+            created_ids = sorted(hospital_ids[name] for name in new_hospitals if name in hospital_ids)
+            transaction.on_commit(lambda: audit.record(
+                action=f"POST REQUEST: Bulk Ingested {len(created_ids)} New and {len(moved)} Updated Hospital Instances",
+                actor_id=ctx.get('actor_id'),
+                ip_address=ctx.get('ip_address'),
+                method='POST',
+                metadata={'model': 'Hospital', 'request_id': ctx.get('request_id'), 'rows': len(rows),
+                          'created_ids': created_ids, 'updated_ids': sorted(hospital.pk for hospital in moved),
+                          'departments_created': len(new_departments), 'links': len(links)},
+            ))
+
+    for i, row in valid:
+        name = row["name"]
+        if name not in hospital_ids:
+            results[i] = {"row": offset + i, "name": name, "status": "error", "error": f"{name} needs field \"addr\""}
+        else:
+            results[i] = {
+                "row": offset + i,
+                "name": name,
+                "id": hospital_ids[name],
+                "status": "created" if name in new_hospitals else "updated",
+                "departments": len(row.get("departments", [])),
+            }
+            # the same hospital on a later row only updates
+            new_hospitals.pop(name, None)
+    return results
+
+def ingest(records, chunk_size=CHUNK_SIZE):
+    offset = 0
+    for chunk in chunked(records, chunk_size):
+        yield from ingest_chunk(chunk, offset)
+        offset += len(chunk)
@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Min
+from django.db.models.functions import Lower
+from django.utils import timezone
+from doctor.models import Doctor
+from hospital.models import Hospital, Department, HospitalDepartment
+from patient.models import Patient, Visit
+from utils.cache import invalidate_model
+
+# run before the migration that makes Hospital.name, Department.name and Patient.email unique, it
+# fails on a table that still has duplicates. names are compared lowered, mysql's default collation
+# makes the unique index case insensitive. a hospital or department named twice is merged into its
+# oldest row( doctors, visits and department links move over ), patients sharing an email can't be
+# merged without knowing who is who and are only listed. the rollups keep the old ids in the past
+# days, live occupancy is put right by the next reconcile_occupancy
+class Command(BaseCommand):
+    help = "Merges hospitals and departments with the same name and lists patients sharing an email"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='only report, fail if there are duplicates')
+
+    def duplicates(self, model, field):
+        groups = (
+            model.objects.annotate(key=Lower(field)).values('key')
+            .annotate(count=Count('id'), keep=Min('id')).filter(count__gt=1)
+        )
+        return [
+            (group['keep'], list(model.objects.annotate(key=Lower(field)).filter(key=group['key'])
+                                 .exclude(id=group['keep']).values_list('id', flat=True)))
+            for group in groups
+        ]
+
+    def handle(self, *args, **options):
+        hospitals = self.duplicates(Hospital, 'name')
+        departments = self.duplicates(Department, 'name')
+        emails = self.duplicates(Patient, 'email')
+        for label, groups in (("hospital", hospitals), ("department", departments), ("patient email", emails)):
+            for keep, others in groups:
+                self.stdout.write(f"{label} {keep} has duplicates {others}")
+
+        if options['check']:
+            if hospitals or departments or emails:
+                raise CommandError("duplicates found, the unique constraints can't be added yet")
+            self.stdout.write(self.style.SUCCESS("no duplicates"))
+            return
+
+        with transaction.atomic():
+            for keep, others in hospitals:
+                self.merge(keep, others, 'hospital', 'department')
+            for keep, others in departments:
+                self.merge(keep, others, 'department', 'hospital')
+        for model in (Hospital, Department, HospitalDepartment, Doctor, Visit):
+            invalidate_model(model)
+
+        merged = sum(len(others) for _, others in hospitals + departments)
+        self.stdout.write(self.style.SUCCESS(f"done, {merged} hospitals and departments merged"))
+        if emails:
+            raise CommandError("patients sharing an email are left, merge or change them by hand")
+
+    # moves everything pointing at others over to keep and deletes others. side is 'hospital' or
+    # 'department', other the far end of the link table
+    def merge(self, keep, others, side, other):
+        Doctor.objects.filter(**{f"{side}_id__in": others}).update(**{f"{side}_id": keep})
+        # the rollup job picks up changed visits by updated_at
+        Visit.objects.filter(**{f"{side}_id__in": others}).update(**{f"{side}_id": keep}, updated_at=timezone.now())
+
+        linked = set(HospitalDepartment.objects.filter(**{f"{side}_id": keep}).values_list(f"{other}_id", flat=True))
+        for link in HospitalDepartment.objects.filter(**{f"{side}_id__in": others}).order_by('id'):
+            far = getattr(link, f"{other}_id")
+            if far in linked:
+                link.delete()
+            else:
+                HospitalDepartment.objects.filter(pk=link.pk).update(**{f"{side}_id": keep})
+                linked.add(far)
+
+        model = Hospital if side == 'hospital' else Department
+        model.objects.filter(id__in=others).delete()
@@ -1,8 +1,10 @@
 from django.db import models
 
+# the unique names( and Patient.email ) fail to migrate on a table with duplicates, run
+# manage.py dedupe_names first on an existing database
 class Hospital(models.Model):
     id = models.AutoField(primary_key=True)
-    name = models.CharField(max_length=128)
+    name = models.CharField(max_length=128, unique=True) # looked up by name everywhere( get_or_create, doctors, visits )
     addr = models.CharField(max_length=256)
 
     # def __str__(self):
@@ -10,7 +12,7 @@ class Hospital(models.Model):
     
 class Department(models.Model):
     id = models.AutoField(primary_key=True)
-    name = models.CharField(max_length=128)
+    name = models.CharField(max_length=128, unique=True)
 
     # def __str__(self):
     #     return f'department@{self.id}@{self.name}'
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import *
+from utils.projection import Projection
 
 class HospitalSerializer(serializers.ModelSerializer):
     class Meta:
@@ -11,6 +12,10 @@ class DepartmentSerializer(serializers.ModelSerializer):
         model = Department
         fields = "__all__"
 
+# read-only fast paths for the list endpoints
+hospital_projection = Projection(HospitalSerializer)
+department_projection = Projection(DepartmentSerializer)
+
 class HospitalDepartmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = HospitalDepartment
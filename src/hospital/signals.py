@@ -0,0 +1,44 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import *
+from .index import name_index
+
+# keep the process-local name index in step with writes, only once they are committed so a rolled
+# back write never ends up in it
+
+def _after_commit(update):
+    def apply():
+        update()
+        name_index.sync_generation()
+    transaction.on_commit(apply)
+
+@receiver(post_save, sender=Hospital)
+def index_hospital_save(sender, instance, **kwargs):
+    pk, name = instance.id, instance.name
+    _after_commit(lambda: name_index.set_hospital(pk, name))
+
+@receiver(post_delete, sender=Hospital)
+def index_hospital_delete(sender, instance, **kwargs):
+    pk = instance.id  # delete() clears the pk before the commit callback runs
+    _after_commit(lambda: name_index.remove_hospital(pk))
+
+@receiver(post_save, sender=Department)
+def index_department_save(sender, instance, **kwargs):
+    pk, name = instance.id, instance.name
+    _after_commit(lambda: name_index.set_department(pk, name))
+
+@receiver(post_delete, sender=Department)
+def index_department_delete(sender, instance, **kwargs):
+    pk = instance.id
+    _after_commit(lambda: name_index.remove_department(pk))
+
+@receiver(post_save, sender=HospitalDepartment)
+def index_link_save(sender, instance, **kwargs):
+    pair = (instance.hospital_id, instance.department_id)
+    _after_commit(lambda: name_index.link(*pair))
+
+@receiver(post_delete, sender=HospitalDepartment)
+def index_link_delete(sender, instance, **kwargs):
+    pair = (instance.hospital_id, instance.department_id)
+    _after_commit(lambda: name_index.unlink(*pair))
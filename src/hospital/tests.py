@@ -1,3 +1,187 @@
-from django.test import TestCase
+from django.test import TestCase, Client
+from unittest import mock
+from rest_framework_simplejwt.tokens import AccessToken
+from django.contrib.auth.models import User, Permission
+from .models import Hospital, Department, HospitalDepartment
+import json
 
-# Create your tests here.
\ No newline at end of file
+class HospitalBulkListTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_hospital'))
+        self.client.login(username='testuser', password='testpass')
+
+    def test_bulk_json_array(self):
+        existing = Hospital.objects.create(name="Old Hospital", addr="Somewhere")
+        Department.objects.create(name="Cardiology")
+        data = [
+            {"name": "New Hospital", "addr": "Main Street", "departments": ["Cardiology", "Neurology"]},
+            {"name": "Old Hospital", "departments": ["Neurology"]},
+            {"name": "No Addr Hospital", "departments": ["Cardiology"]},
+            {"departments": ["Cardiology"]},
+        ]
+        response = self.client.post('/hospitals/bulk', data=json.dumps(data), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["summary"], {"rows": 4, "created": 1, "updated": 1, "errors": 2})
+        self.assertEqual([r["status"] for r in body["results"]], ["created", "updated", "error", "error"])
+
+        self.assertEqual(Department.objects.filter(name="Cardiology").count(), 1)
+        self.assertTrue(HospitalDepartment.objects.filter(hospital=existing, department__name="Neurology").exists())
+        self.assertEqual(HospitalDepartment.objects.filter(hospital__name="New Hospital").count(), 2)
+        self.assertFalse(Hospital.objects.filter(name="No Addr Hospital").exists())
+
+    def test_bulk_updates_addr(self):
+        existing = Hospital.objects.create(name="Old Hospital", addr="Somewhere")
+        data = [
+            {"name": "Old Hospital", "addr": "Elsewhere", "departments": []},
+            {"name": "Old Hospital", "departments": ["Neurology"]},
+            {"name": "Other Hospital", "addr": 5},
+        ]
+        response = self.client.post('/hospitals/bulk', data=json.dumps(data), content_type='application/json')
+        self.assertEqual([r["status"] for r in response.json()["results"]], ["updated", "updated", "error"])
+        existing.refresh_from_db()
+        self.assertEqual(existing.addr, "Elsewhere")
+
+    def test_bulk_audits_each_chunk(self):
+        existing = Hospital.objects.create(name="Old Hospital", addr="Somewhere")
+        data = [
+            {"name": "New Hospital", "addr": "Main Street", "departments": ["Cardiology"]},
+            {"name": "Old Hospital", "addr": "Elsewhere"},
+            {"name": "Third Hospital", "addr": "Side Street"},
+        ]
+        headers = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}", "X-Request-ID": "ingest-1"}
+        with mock.patch('hospital.ingest.audit.record') as record, self.captureOnCommitCallbacks(execute=True):
+            Client().post('/hospitals/bulk?chunk_size=2', data=json.dumps(data), content_type='application/json',
+                          headers=headers)
+        self.assertEqual(record.call_count, 2)
+        first, second = (call.kwargs for call in record.call_args_list)
+        self.assertEqual((first["actor_id"], first["metadata"]["request_id"]), (self.user.id, "ingest-1"))
+        self.assertEqual(first["metadata"]["created_ids"], [Hospital.objects.get(name="New Hospital").id])
+        self.assertEqual(first["metadata"]["updated_ids"], [existing.id])
+        self.assertEqual(first["metadata"]["departments_created"], 1)
+        self.assertEqual(second["metadata"]["created_ids"], [Hospital.objects.get(name="Third Hospital").id])
+
+        # nothing written, nothing recorded
+        with mock.patch('hospital.ingest.audit.record') as record, self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/hospitals/bulk', data=json.dumps(data[1:2]), content_type='application/json')
+        record.assert_not_called()
+
+    def test_bulk_ndjson_chunks(self):
+        lines = "\n".join(
+            json.dumps({"name": f"Hospital {i}", "addr": "addr", "departments": ["ER", f"Ward {i % 3}"]})
+            for i in range(25)
+        )
+        response = self.client.post('/hospitals/bulk?chunk_size=10', data=lines, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["summary"]["created"], 25)
+        self.assertEqual(Hospital.objects.count(), 25)
+        self.assertEqual(Department.objects.count(), 4)
+        self.assertEqual(HospitalDepartment.objects.count(), 50)
+
+    def test_bulk_malformed_body_keeps_earlier_chunks(self):
+        body = '[{"name": "A", "addr": "x", "departments": []}, {"name": "B", "addr": '
+        response = self.client.post('/hospitals/bulk?chunk_size=1', data=body, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("error", response.json())
+        self.assertTrue(Hospital.objects.filter(name="A").exists())
+
+    def test_bulk_requires_permission(self):
+        User.objects.create_user(username='noauth', password='noauth')
+        self.client.login(username='noauth', password='noauth')
+        response = self.client.post('/hospitals/bulk', data="[]", content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+
+from .index import name_index
+from django.core.cache import cache
+from utils.cache import _list_gen_key
+from unittest import mock
+
+class NameIndexTests(TestCase):
+    def setUp(self):
+        self.hospital = Hospital.objects.create(name="Index Hospital", addr="addr")
+        self.department = Department.objects.create(name="Index Department")
+        name_index.load()
+
+    def test_lookup_without_queries(self):
+        HospitalDepartment.objects.create(hospital=self.hospital, department=self.department)
+        name_index.load()
+        with self.assertNumQueries(0):
+            self.assertEqual(name_index.hospital_id("Index Hospital"), self.hospital.id)
+            self.assertEqual(name_index.department_id("Index Department"), self.department.id)
+            self.assertTrue(name_index.is_linked(self.hospital.id, self.department.id))
+
+    def test_miss_falls_back_to_database(self):
+        self.assertIsNone(name_index.hospital_id("Missing Hospital"))
+        HospitalDepartment.objects.create(hospital=self.hospital, department=self.department)
+        self.assertTrue(name_index.is_linked(self.hospital.id, self.department.id))
+
+    def test_signals_update_index(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.hospital.name = "Renamed Hospital"
+            self.hospital.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(name_index.hospital_id("Renamed Hospital"), self.hospital.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.department.delete()
+        self.assertIsNone(name_index.department_id("Index Department"))
+
+    def test_own_write_keeps_index(self):
+        with mock.patch.object(name_index, 'load') as load:
+            with self.captureOnCommitCallbacks(execute=True):
+                Department.objects.create(name="Own Department")
+            load.assert_not_called()
+
+    def test_foreign_write_not_absorbed(self):
+        # another worker renames the hospital( its signal bumps the shared generation, not ours ) ...
+        Hospital.objects.filter(pk=self.hospital.pk).update(name="Elsewhere Renamed")
+        cache.incr(_list_gen_key(Hospital))
+        # ... before our own write commits, adopting its generation must not swallow the rename
+        with self.captureOnCommitCallbacks(execute=True):
+            Department.objects.create(name="Own Department")
+        with self.assertNumQueries(0):
+            self.assertEqual(name_index.hospital_id("Elsewhere Renamed"), self.hospital.id)
+        self.assertIsNone(name_index.hospital_id("Index Hospital"))
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from doctor.models import Doctor
+from patient.models import Patient, Visit
+from django.contrib.auth.models import Group
+import io
+
+class DedupeNamesTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        self.ward, self.er = Department.objects.create(name="Ward"), Department.objects.create(name="ER")
+        # the same name to mysql, the unique index there doesn't tell case apart
+        self.hospital = Hospital.objects.create(name="City Hospital", addr="x")
+        self.copy = Hospital.objects.create(name="CITY HOSPITAL", addr="y")
+        HospitalDepartment.objects.create(hospital=self.hospital, department=self.ward)
+        HospitalDepartment.objects.create(hospital=self.copy, department=self.ward)
+        HospitalDepartment.objects.create(hospital=self.copy, department=self.er)
+        self.doctor = Doctor.objects.create(name="Dr. Copy", hospital=self.copy, department=self.er)
+        patient = Patient.objects.create(name="Dedupe Patient", addr="x", email="dedupe@example.com")
+        self.visit = Visit.objects.create(patient=patient, doctor=self.doctor, hospital=self.copy, department=self.er)
+
+    def run_command(self, *args):
+        call_command('dedupe_names', *args, stdout=io.StringIO())
+
+    def test_check_reports_duplicates(self):
+        with self.assertRaises(CommandError):
+            self.run_command('--check')
+        self.assertEqual(Hospital.objects.count(), 2)
+
+    def test_merges_into_oldest(self):
+        self.run_command()
+        self.assertEqual(list(Hospital.objects.values_list('id', flat=True)), [self.hospital.id])
+        self.assertEqual(
+            sorted(HospitalDepartment.objects.values_list('hospital_id', 'department_id')),
+            sorted([(self.hospital.id, self.ward.id), (self.hospital.id, self.er.id)]),
+        )
+        self.doctor.refresh_from_db()
+        self.visit.refresh_from_db()
+        self.assertEqual((self.doctor.hospital_id, self.visit.hospital_id), (self.hospital.id, self.hospital.id))
+        self.run_command('--check')
@@ -4,24 +4,36 @@ from rest_framework import status
 from django.db import IntegrityError
 from .models import *
 from .serializer import *
+from .ingest import iter_records, ingest, CHUNK_SIZE
 from django.contrib.auth.decorators import permission_required
 from django.utils.decorators import method_decorator
 from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from django.core.cache import cache
+from utils.cache import detail_key, CACHE_TTL
+from utils.pagination import KeysetPaginator, InvalidCursor, cached_page, acached_page
+from utils.streaming import stream_format, stream_response
+from utils.async_cache import acache, adetail_key
+from utils.async_views import AsyncReadView, json_response
 import json
+import io
 
 class HospitalList(APIView):
     permission_classes = [IsAuthenticated]
 
     @method_decorator(permission_required('hospital.view_hospital', raise_exception=True))
     def get(self, request):
-        cached_data = cache.get('hospital_list')
-        if cached_data is not None:
-            return Response(cached_data, status=status.HTTP_200_OK)
-        products = Hospital.objects.all()
-        serializer = HospitalSerializer(products, many=True)
-        cache.set('hospital_list', serializer.data, timeout=60*10)
-        return Response(serializer.data)
+        fmt = stream_format(request)
+        if fmt:
+            return stream_response(hospital_projection.queryset(Hospital.objects.order_by('id')), hospital_projection.serialize, fmt)
+
+        try:
+            paginator = KeysetPaginator(request, Hospital)
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = cached_page(
+            paginator, Hospital, hospital_projection.queryset(Hospital.objects.all()), hospital_projection.serialize
+        )
+        return Response(data, status=status.HTTP_200_OK, headers=paginator.get_headers(next_cursor))
 
     @method_decorator(permission_required('hospital.change_patient', raise_exception=True))
     def post(self, request):
@@ -60,6 +72,39 @@ class HospitalList(APIView):
         
         return Response("donezo", status=status.HTTP_200_OK)
     
+# bulk onboarding, takes a JSON array or NDJSON( application/x-ndjson ) stream of
+# {"name", "addr", "departments"} rows and ingests them in chunked transactions
+class HospitalBulkList(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @method_decorator(permission_required('hospital.add_hospital', raise_exception=True))
+    def post(self, request):
+        try:
+            chunk_size = max(1, min(int(request.query_params.get("chunk_size", CHUNK_SIZE)), 5000))
+        except ValueError:
+            return Response({"error": "chunk_size must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        records = iter_records(request.stream or io.BytesIO(), request.content_type or "")
+        results, error = [], None
+        try:
+            # chunks already ingested stay committed even if a later part of the body is malformed
+            for result in ingest(records, chunk_size):
+                results.append(result)
+        except ValueError as e:
+            error = str(e)
+
+        summary = {
+            "rows": len(results),
+            "created": sum(1 for r in results if r["status"] == "created"),
+            "updated": sum(1 for r in results if r["status"] == "updated"),
+            "errors": sum(1 for r in results if r["status"] == "error"),
+        }
+        body = {"summary": summary, "results": results}
+        if error:
+            body["error"] = error
+            return Response(body, status=status.HTTP_400_BAD_REQUEST)
+        return Response(body, status=status.HTTP_200_OK)
+    
 class HospitalView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -71,14 +116,15 @@ class HospitalView(APIView):
 
     @method_decorator(permission_required('hospital.view_hospital', raise_exception=True))
     def get(self, request, pk):
-        cached_data = cache.get(f'hospital_{pk}')
+        key = detail_key(Hospital, pk)
+        cached_data = cache.get(key)
         if cached_data is not None:
             return Response(cached_data, status=status.HTTP_200_OK)
         hospital = self.get_object(pk)
         if not hospital:
             return Response(status.HTTP_400_BAD_REQUEST)
         serializer = HospitalSerializer(hospital)
-        cache.set(f'hospital_{pk}', serializer.data, timeout=60*10)
+        cache.set(key, serializer.data, timeout=CACHE_TTL)
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     # add hospital if it doesn't exist, if exists, add intersection of departments, if certain departments exist and hospital is new, make connection from existing departments to new hospital
@@ -107,13 +153,18 @@ class DepartmentList(APIView):
 
     @method_decorator(permission_required('hospital.view_department', raise_exception=True))
     def get(self, request):
-        cached_data = cache.get('department_list')
-        if cached_data is not None:
-            return Response(cached_data, status=status.HTTP_200_OK)
-        products = Department.objects.all()
-        serializer = DepartmentSerializer(products, many=True)
-        cache.set('department_list', serializer.data, timeout=60*10)
-        return Response(serializer.data)
+        fmt = stream_format(request)
+        if fmt:
+            return stream_response(department_projection.queryset(Department.objects.order_by('id')), department_projection.serialize, fmt)
+
+        try:
+            paginator = KeysetPaginator(request, Department)
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = cached_page(
+            paginator, Department, department_projection.queryset(Department.objects.all()), department_projection.serialize
+        )
+        return Response(data, status=status.HTTP_200_OK, headers=paginator.get_headers(next_cursor))
     
 class DepartmentView(APIView):
     permission_classes = [IsAuthenticated]
@@ -126,14 +177,15 @@ class DepartmentView(APIView):
 
     @method_decorator(permission_required('hospital.view_department', raise_exception=True))
     def get(self, request, pk):
-        cached_data = cache.get(f'department_{pk}')
+        key = detail_key(Department, pk)
+        cached_data = cache.get(key)
         if cached_data is not None:
             return Response(cached_data, status=status.HTTP_200_OK)
         department = self.get_object(pk)
         if not department:
             return Response(status.HTTP_400_BAD_REQUEST)
         serializer = DepartmentSerializer(department)
-        cache.set(f'department_{pk}', serializer.data, timeout=60*10)
+        cache.set(key, serializer.data, timeout=CACHE_TTL)
         return Response(serializer.data, status=status.HTTP_200_OK)
     
     @method_decorator(permission_required('hospital.change_department', raise_exception=True))
@@ -153,4 +205,65 @@ class DepartmentView(APIView):
         if not department:
             return Response(status=status.HTTP_400_BAD_REQUEST)
         department.delete()
-        return Response(status=status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+# async versions of the read endpoints, under /async/( utils/async_views.py ). a cache hit is
+# answered without leaving the event loop
+
+class AsyncHospitalList(AsyncReadView):
+    permission = 'hospital.view_hospital'
+
+    async def get(self, request):
+        try:
+            paginator = KeysetPaginator(request, Hospital)
+        except InvalidCursor as e:
+            return json_response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = await acached_page(
+            paginator, Hospital, hospital_projection.queryset(Hospital.objects.all()), hospital_projection.serialize
+        )
+        return json_response(data, headers=paginator.get_headers(next_cursor))
+
+class AsyncHospitalView(AsyncReadView):
+    permission = 'hospital.view_hospital'
+
+    async def get(self, request, pk):
+        key = await adetail_key(Hospital, pk)
+        cached_data = await acache.get(key)
+        if cached_data is not None:
+            return json_response(cached_data)
+        try:
+            hospital = await Hospital.objects.aget(pk=pk)
+        except Hospital.DoesNotExist:
+            return json_response(None, status=status.HTTP_400_BAD_REQUEST)
+        data = HospitalSerializer(hospital).data
+        await acache.set(key, data, timeout=CACHE_TTL)
+        return json_response(data)
+
+class AsyncDepartmentList(AsyncReadView):
+    permission = 'hospital.view_department'
+
+    async def get(self, request):
+        try:
+            paginator = KeysetPaginator(request, Department)
+        except InvalidCursor as e:
+            return json_response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = await acached_page(
+            paginator, Department, department_projection.queryset(Department.objects.all()), department_projection.serialize
+        )
+        return json_response(data, headers=paginator.get_headers(next_cursor))
+
+class AsyncDepartmentView(AsyncReadView):
+    permission = 'hospital.view_department'
+
+    async def get(self, request, pk):
+        key = await adetail_key(Department, pk)
+        cached_data = await acache.get(key)
+        if cached_data is not None:
+            return json_response(cached_data)
+        try:
+            department = await Department.objects.aget(pk=pk)
+        except Department.DoesNotExist:
+            return json_response(None, status=status.HTTP_400_BAD_REQUEST)
+        data = DepartmentSerializer(department).data
+        await acache.set(key, data, timeout=CACHE_TTL)
+        return json_response(data)
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from patient.models import Patient, refresh_current_visit
+
+# sets Patient.current_visit/current_status from the visits already there, a chunk of patients per
+# transaction. safe to run while the app is up, visits saved meanwhile keep the pointer current
+class Command(BaseCommand):
+    help = "Points every patient at their latest visit( Patient.current_visit / current_status )"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        last_id, updated = 0, 0
+
+        while True:
+            ids = list(Patient.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:options['chunk_size']])
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            with transaction.atomic():
+                updated += refresh_current_visit(ids)
+            self.stdout.write(f"backfilled {updated} patients( up to id {last_id} )")
+
+        self.stdout.write(self.style.SUCCESS(f"done, {updated} patients updated"))
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from patient.models import Patient
+from utils.crypto import CryptUtils, VERSION_PREFIX
+import os
+
+class Command(BaseCommand):
+    help = "Fills Patient.phone_index for existing rows and re-encrypts fixed-iv phone numbers with a random iv"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        parser.add_argument('--no-reencrypt', action='store_true', help='only fill the blind index')
+
+    def handle(self, *args, **options):
+        cu = CryptUtils(os.getenv('DJANGO_SECRET_KEY'))
+        last_id, updated, conflicts = 0, 0, []
+
+        while True:
+            rows = list(
+                Patient.objects.filter(id__gt=last_id, phone__isnull=False, phone_index__isnull=True)
+                .order_by('id').values_list('id', 'phone')[:options['chunk_size']]
+            )
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            phones = cu.decrypt_many([phone for _, phone in rows])
+            indexes = [cu.blind_index(phone) for phone in phones]
+            reencrypted = cu.encrypt_many(phones)
+            taken = set(Patient.objects.filter(phone_index__in=indexes).values_list('phone_index', flat=True))
+
+            patients = []
+            for (pk, phone), index, encrypted in zip(rows, indexes, reencrypted):
+                # the same number on two patients, only the first one gets the unique index
+                if index in taken:
+                    conflicts.append(pk)
+                    continue
+                taken.add(index)
+                patient = Patient(id=pk, phone_index=index, phone=phone)
+                if not options['no_reencrypt'] and not phone.startswith(VERSION_PREFIX):
+                    patient.phone = encrypted
+                patients.append(patient)
+
+            with transaction.atomic():
+                Patient.objects.bulk_update(patients, ['phone_index', 'phone'])
+            updated += len(patients)
+            self.stdout.write(f"backfilled {updated} patients( up to id {last_id} )")
+
+        self.stdout.write(self.style.SUCCESS(f"done, {updated} patients updated"))
+        if conflicts:
+            self.stdout.write(self.style.WARNING(f"duplicate phone numbers left without index: {conflicts}"))
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from patient.models import Patient
+from patient.serializer import PatientSerializer
+from patient.services import register_patients, MAX_ROWS
+import time
+
+class Rollback(Exception):
+    pass
+
+# registers synthetic intake batches through patient.services and, for comparison, a few patients
+# one at a time through the serializer + post_save signal path PatientList.post uses. everything is
+# rolled back afterwards unless --keep is given
+class Command(BaseCommand):
+    help = "Reports patient registration throughput of the bulk service against one-by-one registration"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=MAX_ROWS, help='patients per bulk call')
+        parser.add_argument('--batches', type=int, default=1)
+        parser.add_argument('--single', type=int, default=20, help='patients registered one at a time for comparison')
+        parser.add_argument('--keep', action='store_true', help='commit the rows instead of rolling them back')
+
+    def handle(self, *args, **options):
+        run = int(time.time())
+        try:
+            with transaction.atomic():
+                self.bulk(run, options)
+                self.single(run, options)
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            self.stdout.write("rolled back")
+
+    # phone numbers have to be unique too, start says where this batch's numbers begin
+    def rows(self, run, prefix, count, start):
+        return [{
+            "name": f"bench-{run}-{prefix}-{i}",
+            "email": f"bench-{run}-{prefix}-{i}@example.com",
+            "addr": "bench",
+            "phone": f"9{(run + start + i) % 10**9:09d}",
+        } for i in range(count)]
+
+    def bulk(self, run, options):
+        total, elapsed = 0, 0.0
+        for batch in range(options['batches']):
+            summary, _ = register_patients(self.rows(run, f"bulk{batch}", options['batch'], batch * options['batch']))
+            total += summary['created']
+            elapsed += summary['elapsed_ms'] / 1000
+            self.stdout.write(
+                f"bulk batch {batch}: {summary['created']}/{summary['rows']} created in "
+                f"{summary['elapsed_ms']:.0f} ms ({summary['rows_per_second']} rows/s)"
+            )
+        if elapsed:
+            self.stdout.write(f"bulk:   {total / elapsed:10.0f} patients/s")
+
+    def single(self, run, options):
+        if not options['single']:
+            return
+        start = time.perf_counter()
+        for row in self.rows(run, "single", options['single'], options['batches'] * options['batch']):
+            serializer = PatientSerializer(data=row)
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"single: {options['single'] / elapsed:10.0f} patients/s")
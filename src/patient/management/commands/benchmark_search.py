@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand
+from patient.models import Patient
+from patient.search import PatientSearchIndex
+from collections import Counter
+import random
+import string
+import time
+
+FIRST_NAMES = [
+    "james", "mary", "john", "patricia", "robert", "jennifer", "michael", "linda", "william", "elizabeth",
+    "david", "barbara", "richard", "susan", "joseph", "jessica", "thomas", "sarah", "charles", "karen",
+    "aarav", "priya", "rahul", "ananya", "vikram", "kavya", "arjun", "diya", "rohan", "isha",
+    "mohammed", "fatima", "omar", "aisha", "li", "wei", "yuki", "hana", "carlos", "sofia",
+]
+LAST_NAMES = [
+    "smith", "johnson", "williams", "brown", "jones", "garcia", "miller", "davis", "rodriguez", "martinez",
+    "sharma", "verma", "gupta", "patel", "reddy", "iyer", "nair", "khan", "singh", "das",
+    "wang", "chen", "tanaka", "sato", "kim", "park", "nguyen", "silva", "rossi", "muller",
+]
+
+# builds the search index from synthetic patients( or the real table with --from-db ) and times
+# queries typed the way the front desk types them: whole names, a prefix, a letter swapped
+class Command(BaseCommand):
+    help = "Reports build time and query latency of the patient search index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=1000000)
+        parser.add_argument('--queries', type=int, default=1000)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--from-db', action='store_true', help='index the patients table instead of synthetic rows')
+
+    def rows(self, count):
+        for pk in range(1, count + 1):
+            first, last = random.choice(FIRST_NAMES), random.choice(LAST_NAMES)
+            # a random suffix keeps the names apart the way real ones are
+            last += ''.join(random.choices(string.ascii_lowercase, k=3))
+            yield pk, f"{first.title()} {last.title()}", f"{first}.{last}{pk}@example.com"
+
+    def typo(self, word):
+        if len(word) < 4:
+            return word
+        i = random.randrange(1, len(word) - 2)
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+    # (kind, query, id of the patient it was made from)
+    def queries(self, patients, count):
+        kinds = [
+            ("full name", lambda name: name),
+            ("prefix", lambda name: name.split()[0][:3] + " " + name.split()[-1][:4]),
+            ("typo", lambda name: " ".join(self.typo(word) for word in name.split())),
+            ("last name", lambda name: name.split()[-1]),
+        ]
+        picks = [random.choice(patients) for _ in range(count // len(kinds))]
+        return [(kind, build(name), pk) for kind, build in kinds for pk, name in picks]
+
+    def handle(self, *args, **options):
+        index = PatientSearchIndex()
+        start = time.perf_counter()
+        if options['from_db']:
+            index.load()
+            patients = list(Patient.objects.order_by('?').values_list('id', 'name')[:options['queries']])
+        else:
+            rows = list(self.rows(options['patients']))
+            index.load(rows)
+            patients = [(pk, name) for pk, name, _ in rows]
+        self.stdout.write(f"indexed {len(index)} patients, {len(index._grams)} trigrams in {time.perf_counter() - start:.1f} s")
+        if not patients:
+            return
+
+        # found: how often the patient the query was made from is among the results. a last name
+        # alone matches thousands of patients, that one is about the time
+        timings, found = {}, Counter()
+        for kind, query, pk in self.queries(patients, options['queries']):
+            start = time.perf_counter()
+            results = index.search(query, options['limit'])
+            timings.setdefault(kind, []).append((time.perf_counter() - start) * 1000)
+            found[kind] += any(result == pk for result, _ in results)
+
+        everything = []
+        for kind, values in timings.items():
+            everything += values
+            self.report(kind, values, found[kind])
+        self.report("all", everything, sum(found.values()))
+
+    def report(self, kind, values, found):
+        values = sorted(values)
+        pick = lambda p: values[min(len(values) - 1, int(len(values) * p))]
+        self.stdout.write(
+            f"{kind:<10} p50 {pick(0.5):7.2f} ms  p95 {pick(0.95):7.2f} ms  p99 {pick(0.99):7.2f} ms  "
+            f"max {values[-1]:7.2f} ms  found {found / len(values):6.1%}"
+        )
@@ -1,18 +1,40 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import OuterRef, Subquery
 from doctor.models import Doctor
 from hospital.models import *
 from django.utils import timezone
 from django.contrib.auth.models import User
+from reporting.models import VisitTransition
+from . import occupancy
+
+# longest phone number taken, in bytes of the plain text. the column holds "v2:" + hex(iv + ciphertext),
+# 31 bytes pad to two blocks( 3 + 2 * (16 + 32) = 99 characters ), 32 would need a third( 131 )
+PHONE_MAX_LENGTH = 31
 
 # Create your models here.
 class Patient(models.Model):
     id = models.AutoField(primary_key=True)
-    name = models.CharField(max_length=128)
+    name = models.CharField(max_length=128, db_index=True)
     dob = models.DateField(default="2000-01-01")
     addr = models.CharField(max_length=128)
-    phone = models.CharField(max_length=1024, null=True, blank=True)
-    email = models.EmailField()
+    # encrypted with a random iv, so lookups and dedup go through phone_index instead
+    phone = models.CharField(max_length=128, null=True, blank=True)
+    # keyed hmac of the number( CryptUtils.blind_index )
+    phone_index = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
+    email = models.EmailField(unique=True)  # see manage.py dedupe_names for existing duplicates
     user_id = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True) # blank because it is updates post user creation
+    # the latest visit and its status, kept up to date by Visit.save( and refresh_current_visit ) so
+    # status reads and the admission check are a primary key lookup instead of a sort over the visits
+    current_visit = models.ForeignKey('Visit', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', editable=False)
+    current_status = models.CharField(max_length=10, null=True, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        # only visits write the pointer, a full save of a patient loaded earlier must not put an old one back
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in CURRENT_VISIT_FIELDS
+            ]
+        super().save(*args, **kwargs)
 
     def populate_userid(self, user_id):
         if not self.user_id: # only update if user_id blank
@@ -22,6 +44,8 @@ class Patient(models.Model):
     # def __str__(self):
     #     return f"patient@{self.id}@{self.name}"
 
+CURRENT_VISIT_FIELDS = ('current_visit', 'current_status')
+
 class Visit(models.Model):
     class Status(models.TextChoices):
         ADMITTED = 'admitted'
@@ -30,13 +54,156 @@ class Visit(models.Model):
 
     id = models.AutoField(primary_key=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # reporting.rollup picks up changed visits by this, a queryset .update() on visits has to set it
+    # too( and write the VisitTransition rows of a status change, see save() )
+    updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=10, choices=Status.choices, default=Status.WAITING)
 
-    # a deleted patient wont affect related row in visit
-    patient = models.ForeignKey(Patient, on_delete=models.SET_NULL, null=True)
-    doctor = models.ForeignKey(Doctor, on_delete=models.SET_NULL, null=True)
-    hospital = models.ForeignKey(Hospital, on_delete=models.SET_NULL, null=True)
-    department = models.ForeignKey(Department, on_delete=models.SET_NULL, null=True)
+    # a deleted patient wont affect related row in visit. no single column index on the foreign keys,
+    # each one leads a composite index below, which covers the constraint and the SET_NULL lookups too
+    patient = models.ForeignKey(Patient, on_delete=models.SET_NULL, null=True, db_index=False)
+    doctor = models.ForeignKey(Doctor, on_delete=models.SET_NULL, null=True, db_index=False)
+    hospital = models.ForeignKey(Hospital, on_delete=models.SET_NULL, null=True, db_index=False)
+    department = models.ForeignKey(Department, on_delete=models.SET_NULL, null=True, db_index=False)
+
+    class Meta:
+        indexes = [
+            # latest visit of a patient, ORDER BY timestamp DESC LIMIT 1 is a backward index scan
+            models.Index(fields=['patient', 'timestamp'], name='visit_patient_timestamp_idx'),
+            # the rollup job's watermark scan
+            models.Index(fields=['updated_at', 'id'], name='visit_updated_at_idx'),
+            # the filters of GET /visits, see VISIT_FILTER_INDEXES
+            models.Index(fields=['timestamp'], name='visit_timestamp_idx'),
+            models.Index(fields=['status', 'timestamp'], name='visit_status_timestamp_idx'),
+            models.Index(fields=['doctor', 'timestamp'], name='visit_doctor_timestamp_idx'),
+            models.Index(fields=['hospital', 'timestamp'], name='visit_hospital_timestamp_idx'),
+            models.Index(fields=['hospital', 'status', 'timestamp'], name='visit_hosp_status_ts_idx'),
+            models.Index(fields=['hospital', 'department', 'timestamp'], name='visit_hosp_dept_ts_idx'),
+            models.Index(fields=['department', 'timestamp'], name='visit_department_ts_idx'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded = instance._tracked()
+        return instance
+
+    # what save() compares against to know what moved, None when some of it was deferred
+    def _tracked(self):
+        fields = ('patient_id', 'status', 'hospital_id', 'department_id')
+        if any(field not in self.__dict__ for field in fields):
+            return None
+        return tuple(self.__dict__[field] for field in fields)
+
+    def occupancy_bucket(self):
+        return occupancy.bucket(self.hospital_id, self.department_id, self.status)
+
+    # the visit and the patient's pointer change in one transaction. a new visit is always the
+    # patient's latest( auto_now_add ), an updated one only matters if it is the current one
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            loaded = getattr(self, '_loaded', None)
+            if adding:
+                old_status = None
+            elif loaded is not None:
+                old_status = loaded[1]
+            else:
+                old_status = Visit.objects.filter(pk=self.pk).values_list('status', flat=True).first()
+            super().save(*args, **kwargs)
+            if adding:
+                if self.patient_id is not None:
+                    Patient.objects.filter(pk=self.patient_id).update(current_visit_id=self.pk, current_status=self.status)
+            elif loaded is None or loaded[0] != self.patient_id:
+                # moved to another patient( or not loaded from the database ), recompute both sides
+                refresh_current_visit({self.patient_id, loaded[0] if loaded else None} - {None})
+            elif loaded[1] != self.status and self.patient_id is not None:
+                Patient.objects.filter(pk=self.patient_id, current_visit=self.pk).update(current_status=self.status)
+
+            # live occupancy counters, a visit saved without being loaded first is left to reconcile()
+            if adding or loaded is not None:
+                old = None if adding else occupancy.bucket(loaded[2], loaded[3], loaded[1])
+                occupancy.record(old, self.occupancy_bucket())
+
+            # admissions and discharges for reporting.rollup. bulk_create, no audit entry or cache bump
+            if self.status != old_status and self.status in (Visit.Status.ADMITTED, Visit.Status.DISCHARGED):
+                VisitTransition.objects.bulk_create([VisitTransition(visit_id=self.pk, status=self.status)])
+        self._loaded = self._tracked()
 
     def __str__(self):
-        return f"visit@{self.id}"
\ No newline at end of file
+        return f"visit@{self.id}"
+
+
+# the equality filters GET /visits takes together -> the index that serves them. each index is the
+# filter columns followed by timestamp, so a date range and the ordering are a range scan on what's
+# left of it( innodb appends the primary key to every secondary index, the id tie break included )
+VISIT_FILTER_INDEXES = {
+    frozenset(): 'visit_timestamp_idx',
+    frozenset({'status'}): 'visit_status_timestamp_idx',
+    frozenset({'patient'}): 'visit_patient_timestamp_idx',
+    frozenset({'doctor'}): 'visit_doctor_timestamp_idx',
+    frozenset({'hospital'}): 'visit_hospital_timestamp_idx',
+    frozenset({'hospital', 'status'}): 'visit_hosp_status_ts_idx',
+    frozenset({'hospital', 'department'}): 'visit_hosp_dept_ts_idx',
+    frozenset({'department'}): 'visit_department_ts_idx',
+}
+
+
+# points the patients at their latest visit( or nothing ), for deletes, moves and the backfill
+def refresh_current_visit(patient_ids):
+    latest = Visit.objects.filter(patient=OuterRef('pk')).order_by('-timestamp', '-id')
+    return Patient.objects.filter(pk__in=patient_ids).update(
+        current_visit=Subquery(latest.values('id')[:1]),
+        current_status=Subquery(latest.values('status')[:1]),
+    )
+
+
+# one run of the scheduled patient notification job( patient.tasks ), patients are split into
+# id ranges up front so a crashed run can pick up where it stopped without re-sending finished chunks
+class NotificationRun(models.Model):
+    class Status(models.TextChoices):
+        PLANNING = 'planning'
+        SENDING = 'sending'
+        DONE = 'done'
+
+    id = models.AutoField(primary_key=True)
+    kind = models.CharField(max_length=32)
+    scheduled_for = models.DateField()
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PLANNING)
+    chunk_size = models.PositiveIntegerField()
+    # highest patient id already cut into a chunk, planning resumes after it
+    planned_until = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('kind', 'scheduled_for')
+
+
+class NotificationChunk(models.Model):
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        CLAIMED = 'claimed'
+        DONE = 'done'
+
+    id = models.AutoField(primary_key=True)
+    run = models.ForeignKey(NotificationRun, on_delete=models.CASCADE, related_name='chunks')
+    # patient ids first_id..last_id, both included
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    # a claim older than the lease belongs to a worker that died, the chunk is handed out again
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    # a chunk that failed isn't handed out again before this, a little later after every attempt
+    not_before = models.DateTimeField(null=True, blank=True)
+    # set when only some of the chunk failed( the connection broke midway ), the patients left to send
+    retry_ids = models.JSONField(null=True, blank=True)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('run', 'first_id')
+        indexes = [
+            models.Index(fields=['run', 'status'], name='notification_chunk_status_idx'),
+        ]
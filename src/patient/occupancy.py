@@ -0,0 +1,162 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count
+from collections import Counter
+from utils.logger import log, Level
+import threading
+
+# live count of waiting and admitted visits per hospital, department and status. one redis hash
+# per hospital, field "<department_id>:<status>", so a hospital's whole board is one HGETALL. the
+# counters move when a visit is saved or deleted( Visit.save, patient/signals.py ), after the
+# transaction commits, and reconcile() puts them right against the database now and then
+KEY_PREFIX = getattr(settings, 'OCCUPANCY_KEY_PREFIX', 'occupancy')
+ACTIVE_STATUSES = ('waiting', 'admitted')
+
+def _key(hospital_id):
+    return f"{KEY_PREFIX}:{hospital_id}"
+
+def _parse(raw):
+    board = {}
+    for field, count in raw.items():
+        field = field.decode() if isinstance(field, bytes) else field
+        department_id, _, status = field.partition(':')
+        board[(int(department_id), status)] = int(count)
+    return board
+
+class RedisOccupancy:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def apply(self, deltas):
+        # one MULTI for every counter the change touches, a visit moving between hospitals included
+        pipe = self.connection.pipeline(transaction=True)
+        for (hospital_id, department_id, status), delta in deltas.items():
+            pipe.hincrby(_key(hospital_id), f"{department_id}:{status}", delta)
+        pipe.execute()
+
+    def board(self, hospital_id):
+        return _parse(self.connection.hgetall(_key(hospital_id)))
+
+    def hospital_ids(self):
+        return {int(key.decode().rpartition(':')[2]) for key in self.connection.scan_iter(f"{KEY_PREFIX}:*")}
+
+    # rewrites a hospital's hash with count(), unless a counter moved while count() ran( WATCH ),
+    # then it is left for the next pass. returns whether it was written
+    def replace(self, hospital_id, count):
+        import redis
+
+        with self.connection.pipeline(transaction=True) as pipe:
+            try:
+                pipe.watch(_key(hospital_id))
+                counts = count()
+                pipe.multi()
+                pipe.delete(_key(hospital_id))
+                if counts:
+                    pipe.hset(_key(hospital_id), mapping={f"{d}:{s}": n for (d, s), n in counts.items()})
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+# stand-in when the cache isn't redis( local development, tests ), only counts this process' writes
+class LocalOccupancy:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards = {}
+
+    def apply(self, deltas):
+        with self._lock:
+            for (hospital_id, department_id, status), delta in deltas.items():
+                board = self._boards.setdefault(hospital_id, Counter())
+                board[(department_id, status)] += delta
+
+    def board(self, hospital_id):
+        with self._lock:
+            return dict(self._boards.get(hospital_id, {}))
+
+    def hospital_ids(self):
+        with self._lock:
+            return set(self._boards)
+
+    def replace(self, hospital_id, count):
+        counts = count()
+        with self._lock:
+            self._boards[hospital_id] = Counter(counts)
+        return True
+
+_local = LocalOccupancy()
+
+def store():
+    if hasattr(getattr(cache, 'client', None), 'get_client'):
+        from django_redis import get_redis_connection
+        return RedisOccupancy(get_redis_connection('default'))
+    return _local
+
+# a visit's counter, None for one that isn't waiting/admitted somewhere
+def bucket(hospital_id, department_id, status):
+    if hospital_id is None or department_id is None or status not in ACTIVE_STATUSES:
+        return None
+    return (hospital_id, department_id, status)
+
+def _apply(deltas):
+    try:
+        store().apply(deltas)
+    except Exception as e:
+        # the next reconcile() puts it right
+        log(Level.ERROR, f"Occupancy update {deltas} failed: {e}")
+
+# moves a visit from one counter to another( None for none ), once the transaction commits
+def record(old, new):
+    if old == new:
+        return
+    deltas = Counter()
+    if old is not None:
+        deltas[old] -= 1
+    if new is not None:
+        deltas[new] += 1
+    transaction.on_commit(lambda: _apply(dict(deltas)))
+
+# {"departments": [{"id", "waiting", "admitted"}, ...], "waiting", "admitted"} of one hospital
+def hospital_board(hospital_id):
+    departments = {}
+    for (department_id, status), count in store().board(hospital_id).items():
+        if status in ACTIVE_STATUSES:
+            departments.setdefault(department_id, dict.fromkeys(ACTIVE_STATUSES, 0))[status] = count
+    return {
+        "departments": [{"id": department_id, **counts} for department_id, counts in sorted(departments.items())],
+        **{status: sum(counts[status] for counts in departments.values()) for status in ACTIVE_STATUSES},
+    }
+
+def count_hospital(hospital_id):
+    from .models import Visit
+
+    rows = (
+        Visit.objects.filter(hospital_id=hospital_id, status__in=ACTIVE_STATUSES, department__isnull=False)
+        .values_list('department_id', 'status').annotate(count=Count('id')).order_by()
+    )
+    return {(department_id, status): count for department_id, status, count in rows}
+
+# recounts every hospital from the visits table, hospitals whose counters moved during their recount
+# are skipped and picked up by the next run
+def reconcile():
+    from hospital.models import Hospital
+
+    occupancy = store()
+    hospital_ids = set(Hospital.objects.values_list('id', flat=True)) | occupancy.hospital_ids()
+    corrected, skipped = [], []
+    for hospital_id in sorted(hospital_ids):
+        before = occupancy.board(hospital_id)
+        counts = {}
+
+        def count():
+            counts.update(count_hospital(hospital_id))
+            return counts
+
+        if not occupancy.replace(hospital_id, count):
+            skipped.append(hospital_id)
+        elif {k: v for k, v in before.items() if v} != counts:
+            corrected.append(hospital_id)
+    if corrected:
+        log(Level.WARNING, f"Occupancy counters of hospitals {corrected} were off and have been recounted")
+    return {"hospitals": len(hospital_ids), "corrected": corrected, "skipped": skipped}
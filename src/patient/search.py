@@ -0,0 +1,270 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from utils.cache import write_snapshot, only_own_writes
+from utils.logger import log, Level
+from array import array
+from collections import Counter
+import re
+import threading
+import time
+import unicodedata
+
+# how often a worker checks the shared cache for patient writes made by other workers, and the
+# least time between two full reloads( a reload reads every patient )
+CHECK_INTERVAL = getattr(settings, 'PATIENT_SEARCH_CHECK_INTERVAL', 5)
+RELOAD_INTERVAL = getattr(settings, 'PATIENT_SEARCH_RELOAD_INTERVAL', 60)
+# reloads run in a thread of their own and the old copy keeps answering meanwhile( a million patients
+# take most of a minute ). off in the tests, whose rows another connection can't see
+BACKGROUND_RELOAD = getattr(settings, 'PATIENT_SEARCH_BACKGROUND_RELOAD', True)
+# postings counted per query, rarest trigrams first. a trigram most patients have( "son", "an " )
+# says little about who is meant and would cost more than the rest of the query together
+POSTINGS_BUDGET = getattr(settings, 'PATIENT_SEARCH_POSTINGS_BUDGET', 50000)
+# about how many of the patients sharing the most trigrams with the query get scored properly
+CANDIDATES = getattr(settings, 'PATIENT_SEARCH_CANDIDATES', 300)
+# share of the query's trigrams a patient needs to come back at all
+MIN_SCORE = getattr(settings, 'PATIENT_SEARCH_MIN_SCORE', 0.3)
+
+WORD = re.compile(r'[^\W_]+')
+
+def normalize(text):
+    # "José" finds "Jose" and the other way round
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+# pg_trgm style: every word padded with two spaces in front and one behind, so "jo" still has
+# "  j" and " jo" and a word's start counts for more than its middle
+def _trigrams(normalized):
+    grams = set()
+    for word in WORD.findall(normalized):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def trigrams(text):
+    return _trigrams(normalize(text))
+
+# what is searched of a patient( normalized ), the name and the part of the email before the @,
+# every domain would otherwise match every query with "com" or "gmail" in it
+def document(name, email):
+    return normalize(f"{name or ''} {(email or '').partition('@')[0]}")
+
+# process-local trigram index over patient names and emails for the front desk's fuzzy lookup. every
+# trigram gets a number, each patient keeps the numbers of theirs( for scoring ) and each trigram an
+# array of the patients that have it( for finding candidates ). built on first use, kept current by
+# the signals in patient/signals.py and rebuilt when other workers wrote patients. a changed
+# patient's old postings stay behind until the next rebuild, they only ever add a candidate that
+# scores low
+class PatientSearchIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._reloading = False
+        # writes applied while a rebuild runs, replayed onto the new copy before it is swapped in
+        self._pending = None
+        self._snapshot = None
+        # another worker wrote patients since the copy was built, the ones it added( ids above
+        # _max_id ) are looked up in the database until the rebuild
+        self._stale, self._max_id = False, 0
+        self._checked_at = self._loaded_at = 0
+        self._grams, self._documents, self._postings = {}, {}, []
+
+    def _models(self):
+        from .models import Patient
+        return (Patient,)
+
+    def _rows(self):
+        from .models import Patient
+        return Patient.objects.values_list('id', 'name', 'email').iterator(chunk_size=10000)
+
+    def _set(self, index, pk, name, email):
+        grams, documents, postings = index
+        old = documents.get(pk, ())
+        ids = array('I')
+        for gram in _trigrams(document(name, email)):
+            gram_id = grams.get(gram)
+            if gram_id is None:
+                gram_id = grams[gram] = len(postings)
+                postings.append(array('i'))
+            ids.append(gram_id)
+        documents[pk] = ids
+        for gram_id in set(ids).difference(old):
+            postings[gram_id].append(pk)
+
+    # builds a new copy from rows( the patients table by default ) and swaps it in, synchronously
+    def load(self, rows=None):
+        snapshot = write_snapshot(*self._models())
+        with self._lock:
+            self._pending = []
+        try:
+            index, max_id = ({}, {}, []), 0
+            for pk, name, email in self._rows() if rows is None else rows:
+                self._set(index, pk, name, email)
+                max_id = max(max_id, pk)
+            with self._lock:
+                for update, args in self._pending:
+                    update(index, *args)
+                self._grams, self._documents, self._postings = index
+                self._snapshot, self._loaded = snapshot, True
+                self._stale, self._max_id = False, max_id
+                self._checked_at = self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception as e:
+            log(Level.ERROR, f"Patient search index rebuild failed: {e}")
+        finally:
+            with self._lock:
+                self._reloading = False
+            if BACKGROUND_RELOAD:
+                connection.close()  # the thread's own
+
+    def _start_reload(self):
+        self._reloading = True
+        if not BACKGROUND_RELOAD:
+            return self._reload()
+        threading.Thread(target=self._reload, name="patient-search-reload", daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self._loaded = False
+            self._grams, self._documents, self._postings = {}, {}, []
+
+    def _ensure_fresh(self):
+        if self._loaded and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._reloading or (self._loaded and now - self._checked_at < CHECK_INTERVAL):
+                return
+            self._checked_at = now
+            if self._loaded:
+                own, snapshot = only_own_writes(self._snapshot, *self._models())
+                if own:
+                    self._snapshot = snapshot
+                    return
+                # another worker wrote patients. the snapshot is kept as it is, so the rebuild happens
+                # as soon as RELOAD_INTERVAL allows, the patients it added are searched in the
+                # database meanwhile
+                self._stale = True
+                if now - self._loaded_at < RELOAD_INTERVAL:
+                    return
+            self._start_reload()
+
+    # [(patient id, score)] best first, score is the share of the query's trigrams the patient has
+    def search(self, query, limit=20):
+        self._ensure_fresh()
+        grams = trigrams(query)
+        if not grams:
+            return []
+        # a rebuild swaps all three, don't mix an old one with a new one
+        with self._lock:
+            loaded, gram_ids, documents, all_postings = self._loaded, self._grams, self._documents, self._postings
+            stale, max_id = self._stale, self._max_id
+        if not loaded:
+            return _rank(self._search_database(query, grams), len(grams), limit)
+        known = {gram_ids[gram] for gram in grams if gram in gram_ids}
+
+        postings = sorted((all_postings[gram_id] for gram_id in known), key=len)
+        counts, spent = Counter(), 0
+        for ids in postings:
+            if spent + len(ids) > POSTINGS_BUDGET:
+                if spent:
+                    break
+                # even the rarest trigram is everywhere( a one letter query ), a slice of it will do
+                ids = ids[:POSTINGS_BUDGET]
+            counts.update(ids)
+            spent += len(ids)
+
+        # the lowest count that still leaves about CANDIDATES patients, one pass over the histogram of
+        # counts instead of a heap over every patient counted
+        histogram, least, kept = Counter(counts.values()), 1, 0
+        for count in sorted(histogram, reverse=True):
+            kept += histogram[count]
+            least = count
+            if kept >= CANDIDATES:
+                break
+
+        # everyone above the lowest count kept( fewer than CANDIDATES ), then the lowest count's bucket
+        # up to the limit, in the order the postings met them
+        candidates = [pk for pk, count in counts.items() if count > least]
+        candidates += [pk for pk, count in counts.items() if count == least][:CANDIDATES * 4 - len(candidates)]
+        results = {}
+        for pk in candidates:
+            ids = documents.get(pk)
+            if ids is None:
+                continue  # deleted
+            results[pk] = (pk, len(known.intersection(ids)), len(ids))
+        if stale:
+            # a patient another worker just registered isn't in this copy yet
+            results.update((result[0], result) for result in self._search_database(query, grams, max_id))
+        return _rank(results.values(), len(grams), limit)
+
+    # until the first copy is built, and for the patients added after it by other workers: the
+    # patients with a word of the query in their name or at the start of their email, as
+    # (patient id, shared, size) like the index. no misspellings, and a scan of the table( of the
+    # ids above after_id only once a copy is built )
+    def _search_database(self, query, grams, after_id=None):
+        from .models import Patient
+
+        words = Q()
+        for word in WORD.findall(query):
+            if len(word) > 1:
+                words |= Q(name__icontains=word) | Q(email__istartswith=word)
+        if not words:
+            return []
+        patients = Patient.objects.filter(words)
+        if after_id is not None:
+            patients = patients.filter(id__gt=after_id)
+        results = []
+        for pk, name, email in patients.values_list('id', 'name', 'email')[:CANDIDATES]:
+            found = _trigrams(document(name, email))
+            results.append((pk, len(grams & found), len(found)))
+        return results
+
+    # incremental updates, called from the save/delete signals once the write is committed. a write
+    # made while a rebuild runs goes into both copies
+    def _update(self, update, *args):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((update, args))
+            if self._loaded:
+                update((self._grams, self._documents, self._postings), *args)
+
+    def set_patient(self, pk, name, email):
+        self._update(self._set, pk, name, email)
+
+    def remove_patient(self, pk):
+        self._update(lambda index, pk: index[1].pop(pk, None), pk)
+
+    # after our own write was applied: take the generation it bumped on, unless another worker wrote
+    # meanwhile too, then the next search checks again( and rebuilds as RELOAD_INTERVAL allows )
+    def sync_generation(self):
+        with self._lock:
+            if not self._loaded or self._reloading:
+                return
+            own, snapshot = only_own_writes(self._snapshot, *self._models())
+            if own:
+                self._snapshot, self._checked_at = snapshot, time.monotonic()
+            else:
+                self._stale, self._checked_at = True, 0
+
+    def __len__(self):
+        return len(self._documents)
+
+# (patient id, trigrams shared with the query, trigrams of the patient) -> the best limit of them
+def _rank(results, query_size, limit):
+    ranked = []
+    for pk, shared, size in results:
+        score = shared / query_size
+        if score >= MIN_SCORE:
+            # between equal scores the closer match wins, "jon" ranks Jon above Jonathan
+            ranked.append((score, shared / (query_size + size - shared), pk))
+    ranked.sort(key=lambda result: (-result[0], -result[1], result[2]))
+    return [(pk, round(score, 3)) for score, _, pk in ranked[:limit]]
+
+patient_index = PatientSearchIndex()
@@ -1,21 +1,40 @@
 from rest_framework import serializers
+from django.db import models
 from .models import *
 from rest_framework.response import Response
 from rest_framework import status
 from utils.crypto import CryptUtils
+from utils.projection import Projection
 from dotenv import load_dotenv
 from utils.crypto import CryptUtils
 import re
 import os
 
+# decrypts the phone numbers of the whole list in one batch instead of one aes setup per row
+class PatientListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        rows = [serializers.ModelSerializer.to_representation(self.child, item) for item in iterable]
+        phones = self.child.cu.decrypt_many([row.get('phone') for row in rows])
+        for row, phone in zip(rows, phones):
+            if 'phone' in row:
+                row['phone'] = phone
+        return rows
+
 class PatientSerializer(serializers.ModelSerializer):
     cu = CryptUtils(os.getenv('DJANGO_SECRET_KEY'))
     class Meta:
         model = Patient
-        fields = "__all__"
+        exclude = ['phone_index', 'current_visit', 'current_status']
+        list_serializer_class = PatientListSerializer
 
     def validate_phone(self, value):
-        if Patient.objects.filter(phone=self.cu.encrypt(value)).exists():
+        if len(str(value).encode()) > PHONE_MAX_LENGTH:
+            raise serializers.ValidationError(f"A phone number can be at most {PHONE_MAX_LENGTH} characters.")
+        duplicates = Patient.objects.filter(phone_index=self.cu.blind_index(value))
+        if self.instance is not None:
+            duplicates = duplicates.exclude(pk=self.instance.pk)
+        if duplicates.exists():
             raise serializers.ValidationError("A patient with this phone number already exists.")
         return value
 
@@ -28,6 +47,7 @@ class PatientSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         phone = validated_data.get('phone')
         if phone:
+            validated_data['phone_index'] = self.cu.blind_index(str(phone))
             validated_data['phone'] = self.cu.encrypt(str(phone))
         
         return super().create(validated_data)
@@ -36,6 +56,7 @@ class PatientSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         phone = validated_data.get('phone')
         if phone:
+            validated_data['phone_index'] = self.cu.blind_index(str(phone))
             validated_data['phone'] = self.cu.encrypt(str(phone))
         
         return super().update(instance, validated_data)
@@ -43,11 +64,14 @@ class PatientSerializer(serializers.ModelSerializer):
     # decrypt phone number before returning the instance
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        if 'phone' in data:
+        if 'phone' in data and data['phone'] is not None:
             # print("DA PHONE", data['phone'])
             data['phone'] = self.cu.decrypt(data['phone'])
         return data
 
+# read-only fast path for PatientList, same output as PatientSerializer(many=True)
+patient_projection = Projection(PatientSerializer, transforms={'phone': PatientSerializer.cu.decrypt_many})
+
 class VisitSerializer(serializers.ModelSerializer):
 
     class Meta:
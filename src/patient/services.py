@@ -0,0 +1,206 @@
+from django.contrib.auth.models import User, Group
+from django.contrib.auth.password_validation import validate_password
+from django.contrib.auth.tokens import default_token_generator
+from django.utils.encoding import force_bytes, force_str
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Lower
+from django.utils.dateparse import parse_date
+from utils.audit import audit
+from utils.cache import LRUCache, invalidate_model
+from utils.logger import log, Level
+from .models import Patient, PHONE_MAX_LENGTH
+from .serializer import PatientSerializer
+import re
+import time
+
+PATIENT_GROUP = "PatientUser"
+BATCH_SIZE = 1000
+# rows accepted by one bulk registration request, they all go in a single transaction
+MAX_ROWS = 10000
+# same check PatientList.post does on a single registration
+PHONE_PATTERN = re.compile(r"((\+*)((0[ -]*)*|((91 )*))((\d{12})+|(\d{10})+))|\d{5}([- ]*)\d{6}")
+
+_group_ids = LRUCache(maxsize=16, ttl=300)
+
+def group_id(name=PATIENT_GROUP):
+    pk = _group_ids.get(name)
+    if pk is None:
+        pk = Group.objects.values_list('id', flat=True).get(name=name)
+        _group_ids.set(name, pk)
+    return pk
+
+class InvalidActivation(ValueError):
+    pass
+
+# one-time token for setting the first password, it's tied to the current password hash so it
+# stops working once the password is set( or after PASSWORD_RESET_TIMEOUT )
+def activation_token(user):
+    return {"uid": urlsafe_base64_encode(force_bytes(user.pk)), "token": default_token_generator.make_token(user)}
+
+def activate(uid, token, password):
+    try:
+        user = User.objects.get(pk=force_str(urlsafe_base64_decode(uid)))
+    except (TypeError, ValueError, OverflowError, User.DoesNotExist):
+        raise InvalidActivation("Invalid or expired activation link")
+    if user.has_usable_password() or not default_token_generator.check_token(user, token):
+        raise InvalidActivation("Invalid or expired activation link")
+
+    # raises ValidationError with the validators' messages
+    validate_password(password, user)
+    # the only place the password gets hashed
+    user.set_password(password)
+    user.save(update_fields=['password'])
+    return user
+
+def _validate(row):
+    if isinstance(row, Exception):
+        return f"Invalid JSON: {row}"
+    if not isinstance(row, dict):
+        return "Row must be an object"
+    for field in ("name", "email", "addr"):
+        if not isinstance(row.get(field), str) or not row[field]:
+            return f"Missing field \"{field}\""
+    if len(row["name"]) > 128 or len(row["addr"]) > 128:
+        return "\"name\" and \"addr\" can be at most 128 characters"
+    try:
+        validate_email(row["email"])
+    except ValidationError:
+        return "Enter a valid email address"
+    phone = row.get("phone")
+    if phone is not None and (not isinstance(phone, str) or not PHONE_PATTERN.fullmatch(phone)):
+        return "Enter a valid phone number"
+    if phone is not None and len(phone.encode()) > PHONE_MAX_LENGTH:
+        return f"\"phone\" can be at most {PHONE_MAX_LENGTH} characters"
+    if "dob" in row and (not isinstance(row["dob"], str) or parse_date(row["dob"]) is None):
+        return "\"dob\" must be a date( YYYY-MM-DD )"
+    return None
+
+# registers a batch of patients and their users with a fixed number of statements, instead of the
+# per patient user create, group lookup, membership insert, user save and patient update the
+# post_save signal does. everything goes in one transaction, rows that would clash with an existing
+# or earlier row( username, email, phone ) come back as errors and the rest are created
+def register_patients(rows, actor_id=None, ip_address=None):
+    started = time.perf_counter()
+    cu = PatientSerializer.cu
+    results = [None] * len(rows)
+
+    valid = []
+    for i, row in enumerate(rows):
+        error = _validate(row)
+        if error:
+            results[i] = {"row": i, "status": "error", "error": error}
+        else:
+            valid.append((i, row))
+
+    # names and emails are compared lowered, in the batch and against the tables: mysql's default
+    # collation makes the unique indexes case insensitive, "Alice" next to "alice" would fail the
+    # whole insert
+    names = {row["name"].lower() for _, row in valid}
+    emails = {row["email"].lower() for _, row in valid}
+    phone_indexes = {i: cu.blind_index(row["phone"]) for i, row in valid if row.get("phone")}
+
+    accepted = []
+    try:
+        with transaction.atomic():
+            taken_names = set(
+                User.objects.annotate(lowered=Lower('username')).filter(lowered__in=names).values_list('lowered', flat=True)
+            )
+            taken_emails = set(
+                Patient.objects.annotate(lowered=Lower('email')).filter(lowered__in=emails).values_list('lowered', flat=True)
+            )
+            taken_phones = set(Patient.objects.filter(phone_index__in=phone_indexes.values()).values_list('phone_index', flat=True))
+
+            for i, row in valid:
+                # the username is the patient's name, like the signal does it
+                if row["name"].lower() in taken_names:
+                    error = "A user with this name already exists."
+                elif row["email"].lower() in taken_emails:
+                    error = "A patient with this email already exists."
+                elif phone_indexes.get(i) in taken_phones:
+                    error = "A patient with this phone number already exists."
+                else:
+                    error = None
+                if error:
+                    results[i] = {"row": i, "name": row["name"], "status": "error", "error": error}
+                    continue
+                taken_names.add(row["name"].lower())
+                taken_emails.add(row["email"].lower())
+                if i in phone_indexes:
+                    taken_phones.add(phone_indexes[i])
+                accepted.append((i, row))
+
+            if accepted:
+                # no passwords to hash, every account starts unusable and gets an activation token
+                users = [User(username=row["name"], email=row["email"]) for _, row in accepted]
+                for user in users:
+                    user.set_unusable_password()
+                User.objects.bulk_create(users, batch_size=BATCH_SIZE)
+                # bulk_create doesn't return ids on mysql, read them back in one go
+                user_ids = dict(User.objects.filter(username__in=[row["name"] for _, row in accepted]).values_list('username', 'id'))
+                for user in users:
+                    user.pk = user_ids[user.username]
+
+                Membership = User.groups.through
+                patient_group = group_id()
+                Membership.objects.bulk_create(
+                    [Membership(user_id=user_ids[row["name"]], group_id=patient_group) for _, row in accepted],
+                    batch_size=BATCH_SIZE,
+                )
+
+                phones = cu.encrypt_many([row.get("phone") for _, row in accepted])
+                Patient.objects.bulk_create([
+                    Patient(
+                        name=row["name"],
+                        addr=row["addr"],
+                        email=row["email"],
+                        dob=row.get("dob", "2000-01-01"),
+                        phone=phone,
+                        phone_index=phone_indexes.get(i),
+                        # the user is known up front, so there's no second update to link it
+                        user_id_id=user_ids[row["name"]],
+                    )
+                    for (i, row), phone in zip(accepted, phones)
+                ], batch_size=BATCH_SIZE)
+                patient_ids = dict(Patient.objects.filter(email__in=[row["email"] for _, row in accepted]).values_list('email', 'id'))
+
+                # bulk_create skips post_save, drop the cached lists and write one audit entry for the batch
+                invalidate_model(Patient)
+                invalidate_model(User)
+                transaction.on_commit(lambda: audit.record(
+                    action=f"POST REQUEST: Bulk Registered {len(accepted)} Patient Instances",
+                    actor_id=actor_id,
+                    ip_address=ip_address,
+                    method='POST',
+                    metadata={'model': 'Patient', 'count': len(accepted), 'instance_ids': sorted(patient_ids.values())},
+                ))
+
+                for (i, row), user in zip(accepted, users):
+                    results[i] = {
+                        "row": i,
+                        "name": row["name"],
+                        "id": patient_ids[row["email"]],
+                        "user_id": user.pk,
+                        "activation": activation_token(user),
+                        "status": "created",
+                    }
+    except IntegrityError as e:
+        # a clash the checks didn't see( a collation that ignores accents too, a row inserted
+        # meanwhile ), nothing of the batch was written
+        log(Level.ERROR, f"Bulk patient registration rolled back: {e}")
+        for i, row in accepted:
+            results[i] = {"row": i, "name": row["name"], "status": "error",
+                          "error": "Clashes with an existing user or patient, nothing of this batch was created."}
+
+    elapsed = time.perf_counter() - started
+    created = sum(1 for result in results if result["status"] == "created")
+    summary = {
+        "rows": len(rows),
+        "created": created,
+        "errors": len(rows) - created,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "rows_per_second": round(len(rows) / elapsed) if elapsed else None,
+    }
+    return summary, results
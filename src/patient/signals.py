@@ -1,5 +1,8 @@
 from .models import *
 from .serializer import *
+from . import occupancy
+from .search import patient_index
+from django.db import transaction
 from rest_framework.response import Response
 from rest_framework import status
 from django.dispatch import receiver
@@ -7,7 +10,6 @@ from django.db.models.signals import post_save, post_delete
 from utils.logger import log, Level
 from utils.models import Log
 from django.contrib.auth.models import User, Group, Permission
-from django.contrib.auth.hashers import make_password
 from dotenv import load_dotenv
 import os
 
@@ -32,11 +34,11 @@ alog = Log()
 def create_user_post_save(sender, instance, created, *args, **kwargs):
     if created:
         log(Level.INFO, "Creating User for New Patient")
-        user = User.objects.create(
-            username=instance.name,
-            email=instance.email,
-            password=make_password('default') # user is created by hospital staff, user should be allowed to change password later
-        )
+        # no password yet, the patient sets one through the activation link( patient.services.activate ).
+        # hashing a default one here was ~all of the registration's cpu time
+        user = User(username=instance.name, email=instance.email)
+        user.set_unusable_password()
+        user.save()
 
         group = Group.objects.get(name="PatientUser")
         user.groups.add(group)
@@ -51,4 +53,28 @@ def delete_user_post_delete(sender, instance, using, *args, **kwargs):
     if deleted_count > 0:
         log(Level.INFO, f"User {instance.name} with email deleted successfully.")
     else:
-        log(Level.WARNING, f"No user found with email '{instance.email}'.")
\ No newline at end of file
+        log(Level.WARNING, f"No user found with email '{instance.email}'.")
+
+# deleting a visit nulls the pointer of its patient( SET_NULL ), fall back to the one before it
+@receiver(post_delete, sender=Visit)
+def refresh_current_visit_post_delete(sender, instance, *args, **kwargs):
+    if instance.patient_id is not None:
+        refresh_current_visit([instance.patient_id])
+    occupancy.record(instance.occupancy_bucket(), None)
+
+# keep this worker's search index( patient/search.py ) in step with its own writes, once committed
+def _index_after_commit(update):
+    def apply():
+        update()
+        patient_index.sync_generation()
+    transaction.on_commit(apply)
+
+@receiver(post_save, sender=Patient)
+def index_patient_save(sender, instance, **kwargs):
+    pk, name, email = instance.id, instance.name, instance.email
+    _index_after_commit(lambda: patient_index.set_patient(pk, name, email))
+
+@receiver(post_delete, sender=Patient)
+def index_patient_delete(sender, instance, **kwargs):
+    pk = instance.id  # delete() clears the pk before the commit callback runs
+    _index_after_commit(lambda: patient_index.remove_patient(pk))
@@ -0,0 +1,187 @@
+from celery import shared_task, chord
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F, Max, Min, Sum, Count
+from django.utils import timezone
+from datetime import timedelta
+from utils.emailer import get_transport
+from utils.logger import log, Level
+from .models import Patient, NotificationRun, NotificationChunk
+from . import occupancy
+
+# patients per chunk task, chunk tasks in flight at once, and how long a claimed chunk may go
+# without finishing before it's considered lost with its worker
+CHUNK_SIZE = getattr(settings, 'PATIENT_NOTIFICATION_CHUNK_SIZE', 500)
+CONCURRENCY = getattr(settings, 'PATIENT_NOTIFICATION_CONCURRENCY', 8)
+LEASE = getattr(settings, 'PATIENT_NOTIFICATION_LEASE', 15 * 60)
+MAX_ATTEMPTS = getattr(settings, 'PATIENT_NOTIFICATION_MAX_ATTEMPTS', 5)
+# a failed chunk waits RETRY_DELAY before its second attempt, twice that before the third and so on
+# up to MAX_RETRY_DELAY, so an smtp outage doesn't use up every attempt within seconds
+RETRY_DELAY = getattr(settings, 'PATIENT_NOTIFICATION_RETRY_DELAY', 30)
+MAX_RETRY_DELAY = getattr(settings, 'PATIENT_NOTIFICATION_MAX_RETRY_DELAY', 10 * 60)
+DAILY = 'daily'
+
+def notification_message(name, email):
+    return {
+        "subject": "Your daily update",
+        "body": f"Hello, {name}!\nThis is your daily update from the hospital.",
+        "to": email,
+    }
+
+# the job in short:
+#   send_patient_notifications  (beat)  creates today's run and cuts the patients into id ranges
+#   dispatch_notification_run           claims CONCURRENCY chunks and sends them as a chord, the
+#                                       chord's callback is the next dispatch, so at most
+#                                       CONCURRENCY chunk tasks are ever queued
+#   send_notification_chunk             sends one chunk over the pooled smtp session
+#   resume_notification_runs    (beat)  restarts the dispatch loop of a run whose worker died
+# finished chunks are marked done in the database and never sent again, a chunk whose worker died
+# mid-send is handed out again once its lease runs out
+
+def plan_run(run):
+    # keyset scan over the primary key, each chunk ends at the CHUNK_SIZE-th id after the previous one
+    while True:
+        after = run.planned_until
+        remaining = Patient.objects.filter(id__gt=after).order_by('id').values_list('id', flat=True)
+        boundary = list(remaining[run.chunk_size - 1:run.chunk_size])
+        last_id = boundary[0] if boundary else remaining.aggregate(last=Max('id'))['last']
+        if last_id is None:
+            break
+        with transaction.atomic():
+            NotificationChunk.objects.bulk_create(
+                [NotificationChunk(run=run, first_id=after + 1, last_id=last_id)], ignore_conflicts=True
+            )
+            NotificationRun.objects.filter(pk=run.pk).update(planned_until=last_id)
+        run.planned_until = last_id
+
+    NotificationRun.objects.filter(pk=run.pk).update(status=NotificationRun.Status.SENDING)
+    run.status = NotificationRun.Status.SENDING
+
+def progress(run_id):
+    counts = dict(NotificationChunk.objects.filter(run_id=run_id).values_list('status').annotate(count=Count('id')))
+    totals = NotificationChunk.objects.filter(run_id=run_id).aggregate(sent=Sum('sent'), failed=Sum('failed'))
+    return {
+        "chunks": sum(counts.values()),
+        **{status: counts.get(status, 0) for status in NotificationChunk.Status.values},
+        "sent": totals["sent"] or 0,
+        "failed": totals["failed"] or 0,
+    }
+
+def _claimable(run_id):
+    now = timezone.now()
+    expired = now - timedelta(seconds=LEASE)
+    return NotificationChunk.objects.filter(run_id=run_id).filter(
+        Q(status=NotificationChunk.Status.PENDING) & (Q(not_before__isnull=True) | Q(not_before__lte=now))
+        | Q(status=NotificationChunk.Status.CLAIMED, claimed_at__lt=expired)
+    )
+
+def _retry_at(attempts):
+    return timezone.now() + timedelta(seconds=min(RETRY_DELAY * 2 ** max(attempts - 1, 0), MAX_RETRY_DELAY))
+
+@shared_task
+def dispatch_notification_run(run_id):
+    run = NotificationRun.objects.get(pk=run_id)
+    if run.status != NotificationRun.Status.SENDING:
+        return progress(run_id)
+
+    ids = list(_claimable(run_id).order_by('first_id').values_list('id', flat=True)[:CONCURRENCY])
+    claimed_at = timezone.now()
+    # the claimable filter is repeated in the update, a chunk another dispatcher got first isn't ours
+    _claimable(run_id).filter(id__in=ids).update(
+        status=NotificationChunk.Status.CLAIMED, claimed_at=claimed_at, attempts=F('attempts') + 1
+    )
+    claimed = list(NotificationChunk.objects.filter(id__in=ids, claimed_at=claimed_at).values_list('id', flat=True))
+
+    if claimed:
+        log(Level.INFO, f"Notification run {run_id}: sending {len(claimed)} chunks, {progress(run_id)}")
+        chord(send_notification_chunk.si(chunk_id) for chunk_id in claimed)(dispatch_notification_run.si(run_id))
+        return {"dispatched": len(claimed)}
+
+    in_flight = NotificationChunk.objects.filter(run_id=run_id, status=NotificationChunk.Status.CLAIMED).exists()
+    if not in_flight:
+        # only chunks waiting out their retry delay left, come back when the first one may go
+        retry_at = NotificationChunk.objects.filter(
+            run_id=run_id, status=NotificationChunk.Status.PENDING
+        ).aggregate(first=Min('not_before'))['first']
+        if retry_at is not None:
+            dispatch_notification_run.apply_async((run_id,), countdown=max((retry_at - timezone.now()).total_seconds(), 0))
+            return progress(run_id)
+        NotificationRun.objects.filter(pk=run_id, status=NotificationRun.Status.SENDING).update(
+            status=NotificationRun.Status.DONE, finished_at=timezone.now()
+        )
+        log(Level.INFO, f"Notification run {run_id} finished, {progress(run_id)}")
+    return progress(run_id)
+
+@shared_task
+def send_notification_chunk(chunk_id):
+    chunk = NotificationChunk.objects.get(pk=chunk_id)
+    if chunk.status == NotificationChunk.Status.DONE:
+        return {"chunk": chunk_id, "skipped": True}
+
+    patients = Patient.objects.filter(id__gte=chunk.first_id, id__lte=chunk.last_id)
+    if chunk.retry_ids is not None:
+        patients = patients.filter(id__in=chunk.retry_ids)
+    patients = list(patients.order_by('id').values_list('id', 'name', 'email'))
+    gave_up = chunk.attempts >= MAX_ATTEMPTS
+    try:
+        results = get_transport().send_many([notification_message(name, email) for _, name, email in patients])
+        sent = sum(1 for result in results if result["status"] == "sent")
+        if results and not sent and all(result["retry"] for result in results):
+            raise ConnectionError(results[0]["error"])
+    except Exception as e:
+        # the next wave takes it again after a while, unless it keeps failing
+        log(Level.ERROR, f"Notification chunk {chunk_id} failed( attempt {chunk.attempts} ): {e}")
+        NotificationChunk.objects.filter(pk=chunk_id, status=NotificationChunk.Status.CLAIMED).update(
+            status=NotificationChunk.Status.DONE if gave_up else NotificationChunk.Status.PENDING,
+            failed=F('failed') + (len(patients) if gave_up else 0),
+            not_before=None if gave_up else _retry_at(chunk.attempts),
+        )
+        return {"chunk": chunk_id, "error": str(e)}
+
+    # the connection broke midway: the patients after the break are sent again on a later attempt
+    retry = [] if gave_up else [
+        pk for (pk, _, _), result in zip(patients, results) if result["status"] != "sent" and result["retry"]
+    ]
+    failed = len(results) - sent - len(retry)
+    NotificationChunk.objects.filter(pk=chunk_id).exclude(status=NotificationChunk.Status.DONE).update(
+        status=NotificationChunk.Status.PENDING if retry else NotificationChunk.Status.DONE,
+        sent=F('sent') + sent, failed=F('failed') + failed,
+        retry_ids=retry or None, not_before=_retry_at(chunk.attempts) if retry else None,
+    )
+    return {"chunk": chunk_id, "sent": sent, "failed": failed, "retry": len(retry)}
+
+@shared_task
+def send_patient_notifications(kind=DAILY):
+    run, _ = NotificationRun.objects.get_or_create(
+        kind=kind, scheduled_for=timezone.localdate(), defaults={"chunk_size": CHUNK_SIZE}
+    )
+    if run.status != NotificationRun.Status.PLANNING:
+        # already sending or done, resume_notification_runs looks after a stalled one
+        return {"run": run.pk, "status": run.status}
+    plan_run(run)
+    dispatch_notification_run.delay(run.pk)
+    return {"run": run.pk, "status": run.status}
+
+# a run whose dispatch loop stopped( worker killed between waves, a lost chord ) has no chunk
+# claimed within the lease, start a new loop for it. a live loop claims a wave every few seconds
+# and is left alone
+@shared_task
+def resume_notification_runs():
+    expired = timezone.now() - timedelta(seconds=LEASE)
+    resumed = []
+    for run in NotificationRun.objects.exclude(status=NotificationRun.Status.DONE):
+        if run.status == NotificationRun.Status.PLANNING:
+            if run.created_at >= expired:
+                continue  # still being planned
+            plan_run(run)
+        latest = NotificationChunk.objects.filter(run=run).aggregate(latest=Max('claimed_at'))['latest'] or run.created_at
+        if latest < expired:
+            dispatch_notification_run.delay(run.pk)
+            resumed.append(run.pk)
+    return {"resumed": resumed}
+
+# counters missed by a failed redis write, bulk imports or a worker dying between the commit and
+# the update are put right here
+@shared_task
+def reconcile_occupancy():
+    return occupancy.reconcile()
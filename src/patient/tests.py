@@ -1,3 +1,740 @@
-from django.test import TestCase
+from django.test import TestCase, Client
+from django.contrib.auth.models import User, Group, Permission
+from django.contrib.auth.tokens import default_token_generator
+from rest_framework.renderers import JSONRenderer
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from .models import Patient, Visit, NotificationRun, NotificationChunk, VISIT_FILTER_INDEXES
+from .views import filter_visits, visit_list_queryset
+from . import tasks, occupancy, search
+from .search import patient_index
+from utils.cache import invalidate_model, _list_gen_key
+from utils.pagination import encode_cursor
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from hospital.models import Hospital, Department
+from hospital.index import name_index
+from doctor.models import Doctor
+from .serializer import PatientSerializer, patient_projection
+from rest_framework.exceptions import ValidationError
+from .services import activation_token
+from django.core.management import call_command
+import io
+import json
+import threading
 
-# Create your tests here.
+class PatientProjectionTests(TestCase):
+    def setUp(self):
+        cu = PatientSerializer.cu
+        # creating a patient creates its user in this group( patient/signals.py )
+        Group.objects.create(name="PatientUser")
+        Patient.objects.create(
+            name="Ada", dob="1990-05-01", addr="1 Road", email="ada@example.com",
+            phone=cu.encrypt("9876543210"), phone_index=cu.blind_index("9876543210"),
+        )
+        Patient.objects.create(name="No Phone", addr="2 Road", email="nophone@example.com")
+        # written before random ivs, no version prefix
+        Patient.objects.create(
+            name="Légacy", addr="3 Road", email="legacy@example.com",
+            phone=self.legacy_encrypt("9123456780"), phone_index=cu.blind_index("9123456780"),
+        )
+
+    def legacy_encrypt(self, value):
+        cu = PatientSerializer.cu
+        return AES.new(cu.key, AES.MODE_CBC, cu.iv).encrypt(pad(value.encode(), AES.block_size)).hex()
+
+    def test_same_json_as_serializer(self):
+        queryset = Patient.objects.order_by('id')
+        expected = JSONRenderer().render(PatientSerializer(list(queryset), many=True).data)
+        actual = JSONRenderer().render(patient_projection.serialize(patient_projection.queryset(queryset)))
+        self.assertEqual(actual, expected)
+
+    def test_empty(self):
+        self.assertEqual(patient_projection.serialize(patient_projection.queryset(Patient.objects.none())), [])
+
+    def test_rows_keep_cursor_keys(self):
+        row = patient_projection.queryset(Patient.objects.order_by('id')).first()
+        self.assertEqual(row.id, Patient.objects.order_by('id').first().id)
+
+class VisitListTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        hospital = Hospital.objects.create(name="Visit Hospital", addr="x")
+        department = Department.objects.create(name="Visit Department")
+        doctor = Doctor.objects.create(name="Dr. Visit", hospital=hospital, department=department)
+        for i in range(3):
+            patient = Patient.objects.create(name=f"Visitor {i}", addr="x", email=f"visitor{i}@example.com")
+            Visit.objects.create(patient=patient, doctor=doctor, hospital=hospital, department=department)
+
+        self.client = Client()
+        user = User.objects.create_user(username="visit-staff", password="pass", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='view_visit'))
+        self.client.login(username="visit-staff", password="pass")
+
+    def test_list_names(self):
+        response = self.client.get('/visits')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([visit['patient_name'] for visit in response.json()], [f"Visitor {i}" for i in range(3)])
+        self.assertEqual(response.json()[0]['doctor_name'], "Dr. Visit")
+
+    def test_stream_matches_list(self):
+        page = self.client.get('/visits')
+        response = self.client.get('/visits?stream=1')
+        self.assertEqual(b"".join(response.streaming_content), page.content)
+
+        response = self.client.get('/visits?stream=ndjson')
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], page.json())
+
+class VisitFilterTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        self.hospital = Hospital.objects.create(name="Filter Hospital", addr="x")
+        self.other_hospital = Hospital.objects.create(name="Other Filter Hospital", addr="x")
+        self.er = Department.objects.create(name="Filter ER")
+        self.icu = Department.objects.create(name="Filter ICU")
+        self.doctor = Doctor.objects.create(name="Dr. Filter", hospital=self.hospital, department=self.er)
+        self.patient = Patient.objects.create(name="Filter Patient", addr="x", email="filter@example.com")
+
+        now = timezone.now()
+        self.visits = {}
+        for name, hospital, department, status, days_ago in [
+            ("old", self.hospital, self.er, Visit.Status.DISCHARGED, 10),
+            ("recent", self.hospital, self.icu, Visit.Status.DISCHARGED, 2),
+            ("elsewhere", self.other_hospital, self.er, Visit.Status.DISCHARGED, 1),
+            ("today", self.hospital, self.er, Visit.Status.ADMITTED, 0),
+        ]:
+            visit = Visit.objects.create(patient=self.patient, doctor=self.doctor, hospital=hospital, department=department, status=status)
+            Visit.objects.filter(pk=visit.pk).update(timestamp=now - timedelta(days=days_ago))
+            self.visits[name] = visit.id
+        self.today = timezone.localdate()
+
+        self.client = Client()
+        user = User.objects.create_user(username="filter-staff", password="pass", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='view_visit'))
+        self.client.login(username="filter-staff", password="pass")
+
+    def ids(self, **params):
+        response = self.client.get('/visits', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [visit["id"] for visit in response.json()]
+
+    def test_filters(self):
+        v = self.visits
+        self.assertEqual(self.ids(), [v["old"], v["recent"], v["elsewhere"], v["today"]])
+        self.assertEqual(self.ids(ordering='-timestamp'), [v["today"], v["elsewhere"], v["recent"], v["old"]])
+        self.assertEqual(self.ids(status='admitted'), [v["today"]])
+        self.assertEqual(self.ids(hospital=self.hospital.id, status='discharged'), [v["old"], v["recent"]])
+        self.assertEqual(self.ids(hospital=self.hospital.id, department=self.er.id), [v["old"], v["today"]])
+        self.assertEqual(self.ids(department=self.er.id), [v["old"], v["elsewhere"], v["today"]])
+        self.assertEqual(self.ids(doctor=self.doctor.id, **{'from': (self.today - timedelta(days=3)).isoformat()}),
+                         [v["recent"], v["elsewhere"], v["today"]])
+        # a plain 'to' date takes the whole day
+        self.assertEqual(self.ids(patient=self.patient.id, to=(self.today - timedelta(days=1)).isoformat()),
+                         [v["old"], v["recent"], v["elsewhere"]])
+        self.assertEqual(self.ids(to=(timezone.now() - timedelta(days=5)).isoformat()), [v["old"]])
+
+    def test_filtered_pages(self):
+        v = self.visits
+        response = self.client.get('/visits', {'hospital': self.hospital.id, 'ordering': '-timestamp', 'page_size': 2})
+        self.assertEqual([visit["id"] for visit in response.json()], [v["today"], v["recent"]])
+        response = self.client.get('/visits', {
+            'hospital': self.hospital.id, 'ordering': '-timestamp', 'page_size': 2, 'cursor': response['X-Next-Cursor'],
+        })
+        self.assertEqual([visit["id"] for visit in response.json()], [v["old"]])
+
+        response = self.client.get('/visits', {'status': 'admitted', 'stream': 'ndjson'})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], [v["today"]])
+
+    def test_bad_filters(self):
+        for params in [
+            {'status': 'gone'}, {'hospital': 'x'}, {'hospital': '²'}, {'from': 'yesterday'}, {'to': '2024-13-01'}, {'ordering': 'status'},
+            # no index for these together
+            {'doctor': self.doctor.id, 'status': 'admitted'}, {'patient': self.patient.id, 'hospital': self.hospital.id},
+            # a made up cursor, the timestamp isn't one
+            {'cursor': encode_cursor(["yesterday", 1])}, {'cursor': encode_cursor([["x"], 1])},
+        ]:
+            with self.subTest(params=params):
+                response = self.client.get('/visits', params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn("error", response.json())
+
+    def test_every_combination_has_its_index(self):
+        indexes = {index.name: index.fields for index in Visit._meta.indexes}
+        columns = {"status": "status", "hospital": "hospital", "department": "department", "doctor": "doctor", "patient": "patient"}
+        for combination, name in VISIT_FILTER_INDEXES.items():
+            with self.subTest(combination=sorted(combination)):
+                fields = indexes[name]
+                self.assertEqual(set(fields[:-1]), {columns[c] for c in combination})
+                self.assertEqual(fields[-1], 'timestamp')
+
+    def test_index_range_scans(self):
+        # one query for the page( plus the session's user ), and the planner goes through the combination's index
+        ids = {"status": "admitted", "hospital": self.hospital.id, "department": self.er.id,
+               "doctor": self.doctor.id, "patient": self.patient.id}
+        for combination, name in VISIT_FILTER_INDEXES.items():
+            for ordering in ('timestamp', '-timestamp'):
+                params = {c: str(ids[c]) for c in combination}
+                params.update({'from': (self.today - timedelta(days=3)).isoformat(), 'ordering': ordering})
+                # permissions are cached after the first request
+                self.client.get('/visits', params)
+                with self.subTest(combination=sorted(combination), ordering=ordering):
+                    queryset, keys = filter_visits(visit_list_queryset(), params)
+                    plan = queryset.order_by(*keys)[:100].explain()
+                    self.assertIn(name, plan)
+                    self.assertNotIn("TEMP B-TREE", plan)
+                    with self.assertNumQueries(2):
+                        self.client.get('/visits', params)
+
+class PatientSearchTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        # a rebuild thread has its own connection, which can't see the rows of the test's transaction
+        patcher = mock.patch.object(search, 'BACKGROUND_RELOAD', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patient_index.clear()
+        self.addCleanup(patient_index.clear)
+        self.patients = {
+            name: Patient.objects.create(name=name, addr="x", email=email)
+            for name, email in [
+                ("Jon Smith", "jsmith@example.com"),
+                ("Jonathan Smithers", "jonathan@example.com"),
+                ("Jane Doe", "jdoe@example.com"),
+                ("José Álvarez", "jose.alvarez@example.com"),
+            ]
+        }
+
+        self.client = Client()
+        user = User.objects.create_user(username="search-staff", password="pass", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='view_patient'))
+        self.client.login(username="search-staff", password="pass")
+
+    def names(self, query, limit=20):
+        return [Patient.objects.get(pk=pk).name for pk, _ in patient_index.search(query, limit)]
+
+    def test_ranked_fuzzy_matches(self):
+        self.assertEqual(self.names("jon smith")[:2], ["Jon Smith", "Jonathan Smithers"])
+        # misspelled, partial, without the accents, by email
+        self.assertEqual(self.names("jonh smiht")[0], "Jon Smith")
+        self.assertEqual(self.names("jonath")[0], "Jonathan Smithers")
+        self.assertEqual(self.names("jose alvarez"), ["José Álvarez"])
+        self.assertEqual(self.names("jdoe"), ["Jane Doe"])
+        self.assertEqual(self.names("zzqx"), [])
+        self.assertEqual(len(self.names("smith", limit=1)), 1)
+
+    def test_best_match_survives_a_crowded_bucket(self):
+        # ten patients share the query's rarest trigrams and come first, the one sharing all of them
+        # comes after them( the cut used to go by first seen, not by count )
+        rows = [(pk, f"Xyz Filler{pk}", f"x{pk}@example.com") for pk in range(1, 11)]
+        rows += [(11, "Xyz Abc", "target@example.com")]
+        rows += [(pk, f"Abc Other{pk}", f"a{pk}@example.com") for pk in range(12, 40)]
+        index = search.PatientSearchIndex()
+        index.load(rows)
+        with mock.patch.object(search, 'CANDIDATES', 2):
+            self.assertEqual(index.search("xyz abc")[0][0], 11)
+
+    def test_follows_writes(self):
+        patient_index.search("warm up")
+        with self.captureOnCommitCallbacks(execute=True):
+            added = Patient.objects.create(name="Priya Raman", addr="x", email="praman@example.com")
+        self.assertEqual(self.names("priya"), ["Priya Raman"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            added.name, added.email = "Priya Krishnan", "pkrishnan@example.com"
+            added.save()
+        self.assertEqual(self.names("krishnan"), ["Priya Krishnan"])
+        self.assertEqual(self.names("raman"), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patients["Jane Doe"].delete()
+        self.assertEqual(self.names("jane doe"), [])
+
+    def test_reloads_after_other_workers_write(self):
+        patient_index.search("warm up")
+        # a bulk write elsewhere, no signals here, just the shared generation
+        Patient.objects.filter(pk=self.patients["Jane Doe"].pk).update(name="Jane Moreau")
+        invalidate_model(Patient)
+        self.assertEqual(self.names("moreau"), [])
+        with mock.patch.object(search, 'CHECK_INTERVAL', 0), mock.patch.object(search, 'RELOAD_INTERVAL', 0):
+            self.assertEqual(self.names("moreau"), ["Jane Moreau"])
+
+    def test_foreign_write_not_absorbed(self):
+        patient_index.search("warm up")
+        # another worker renames a patient( its signal bumps the shared generation ) before our own
+        # write commits, adopting the generation then must not swallow the rename
+        Patient.objects.filter(pk=self.patients["Jane Doe"].pk).update(name="Jane Moreau")
+        cache.incr(_list_gen_key(Patient))
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(name="Priya Raman", addr="x", email="praman@example.com")
+        with mock.patch.object(search, 'RELOAD_INTERVAL', 0):
+            self.assertEqual(self.names("moreau"), ["Jane Moreau"])
+
+    def test_other_workers_new_patient_found_before_rebuild(self):
+        patient_index.search("warm up")
+        # registered on another worker( no signal here ), long before this one may rebuild
+        Patient.objects.bulk_create([Patient(name="Priya Raman", addr="x", email="praman@example.com")])
+        invalidate_model(Patient)
+        with mock.patch.object(search, 'CHECK_INTERVAL', 0), mock.patch.object(search, 'RELOAD_INTERVAL', 3600):
+            self.assertEqual(self.names("priya raman"), ["Priya Raman"])
+            self.assertEqual(self.names("jon smith")[:2], ["Jon Smith", "Jonathan Smithers"])
+
+    def test_rebuild_in_background(self):
+        patient_index.search("warm up")
+        started, release = threading.Event(), threading.Event()
+        rows = [(pk, "Jane Moreau" if name == "Jane Doe" else name, patient.email) for name, patient in self.patients.items()
+                for pk in [patient.pk]]
+
+        def slow_rows():
+            started.set()
+            release.wait(5)
+            yield from rows
+
+        Patient.objects.filter(pk=self.patients["Jane Doe"].pk).update(name="Jane Moreau")
+        invalidate_model(Patient)
+        with mock.patch.object(search, 'BACKGROUND_RELOAD', True), mock.patch.object(search, 'CHECK_INTERVAL', 0), \
+                mock.patch.object(search, 'RELOAD_INTERVAL', 0), mock.patch.object(patient_index, '_rows', slow_rows):
+            # the old copy answers while the new one is built
+            jane = self.patients["Jane Doe"].pk
+            self.assertEqual(patient_index.search("jane doe")[0][0], jane)
+            self.assertTrue(started.wait(5))
+            self.assertEqual(patient_index.search("jane doe")[0][0], jane)
+            # a write meanwhile ends up in both copies
+            patient_index.set_patient(self.patients["Jon Smith"].pk, "Jon Krishnan", "jsmith@example.com")
+            release.set()
+            self.join_rebuild()
+            self.assertEqual(self.names("moreau"), ["Jane Moreau"])
+            self.assertEqual(patient_index.search("jon krishnan")[0][0], self.patients["Jon Smith"].pk)
+
+    def test_database_until_built(self):
+        release = threading.Event()
+
+        def slow_rows():
+            release.wait(5)
+            return iter(())
+
+        with mock.patch.object(search, 'BACKGROUND_RELOAD', True), mock.patch.object(patient_index, '_rows', slow_rows):
+            # the first search starts the build and doesn't wait for it
+            self.assertEqual(self.names("smith")[:2], ["Jon Smith", "Jonathan Smithers"])
+            self.assertEqual(self.names("jdoe"), ["Jane Doe"])
+            release.set()
+            self.join_rebuild()
+
+    def join_rebuild(self):
+        for thread in threading.enumerate():
+            if thread.name == "patient-search-reload":
+                thread.join(5)
+
+    def test_view(self):
+        response = self.client.get('/patients/search', {'q': 'jon smth', 'limit': 1})
+        self.assertEqual(response.status_code, 200)
+        [match] = response.json()
+        self.assertEqual((match["id"], match["name"], match["email"]), (self.patients["Jon Smith"].id, "Jon Smith", "jsmith@example.com"))
+        self.assertGreater(match["score"], 0)
+
+        self.assertEqual(self.client.get('/patients/search', {'q': 'j'}).status_code, 400)
+        self.assertEqual(self.client.get('/patients/search', {'q': 'jon', 'limit': 'x'}).status_code, 400)
+
+        User.objects.create_user(username="search-nobody", password="pass", is_staff=True)
+        client = Client()
+        client.login(username="search-nobody", password="pass")
+        self.assertEqual(client.get('/patients/search', {'q': 'jon'}).status_code, 403)
+
+class AsyncPatientViewTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        cu = PatientSerializer.cu
+        hospital = Hospital.objects.create(name="Async Hospital", addr="x")
+        department = Department.objects.create(name="Async Department")
+        doctor = Doctor.objects.create(name="Dr. Async", hospital=hospital, department=department)
+        self.patient = Patient.objects.create(
+            name="Async Patient", dob="1990-05-01", addr="x", email="async@example.com",
+            phone=cu.encrypt("9876543210"), phone_index=cu.blind_index("9876543210"),
+        )
+        for _ in range(2):
+            Visit.objects.create(patient=self.patient, doctor=doctor, hospital=hospital, department=department)
+        self.other = Patient.objects.create(name="Other Patient", addr="x", email="other@example.com")
+
+        self.client = Client()
+        user = User.objects.create_user(username="async-staff", password="pass", is_staff=True)
+        user.user_permissions.add(
+            Permission.objects.get(codename='view_visit'), Permission.objects.get(codename='view_patient')
+        )
+        self.client.login(username="async-staff", password="pass")
+
+    def test_same_answers_as_sync(self):
+        for path in (f'/visit/{self.patient.id}', f'/patient/status/{self.patient.id}', f'/visit/{self.other.id}'):
+            sync, async_ = self.client.get(path), self.client.get('/async' + path)
+            self.assertEqual(async_.status_code, sync.status_code)
+            self.assertEqual(async_.content, sync.content)
+        self.assertEqual(self.client.get(f'/async/visit/{self.patient.id}').json()["patient"]["phone"], "9876543210")
+
+    def test_only_own_patient(self):
+        owner = self.patient.user_id
+        owner.set_password("pass")
+        owner.save()
+        owner.user_permissions.add(Permission.objects.get(codename='view_patient'))
+        client = Client()
+        client.login(username=owner.username, password="pass")
+        self.assertEqual(client.get(f'/async/patient/status/{self.patient.id}').status_code, 200)
+        self.assertEqual(client.get(f'/async/patient/status/{self.other.id}').status_code, 403)
+        self.assertEqual(client.get('/async/patient/status/0').status_code, 403)
+
+class PatientCurrentVisitTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        self.hospital = Hospital.objects.create(name="Pointer Hospital", addr="x")
+        self.department = Department.objects.create(name="Pointer Department")
+        self.doctor = Doctor.objects.create(name="Dr. Pointer", hospital=self.hospital, department=self.department)
+        self.patient = Patient.objects.create(name="Pointer Patient", addr="x", email="pointer@example.com")
+
+        self.client = Client()
+        user = User.objects.create_user(username="pointer-staff", password="pass", is_staff=True)
+        user.user_permissions.add(*Permission.objects.filter(
+            codename__in=['view_patient', 'change_patient', 'view_visit', 'change_visit']
+        ))
+        self.client.login(username="pointer-staff", password="pass")
+
+    def visit(self, **kwargs):
+        return Visit.objects.create(
+            patient=self.patient, doctor=self.doctor, hospital=self.hospital, department=self.department, **kwargs
+        )
+
+    def post_visit(self):
+        return self.client.post('/visits', data=json.dumps({
+            "patient": "Pointer Patient", "doctor": "Dr. Pointer",
+            "hospital": "Pointer Hospital", "department": "Pointer Department",
+        }), content_type='application/json')
+
+    def pointer(self):
+        return Patient.objects.values_list('current_visit', 'current_status').get(pk=self.patient.pk)
+
+    def test_follows_visits(self):
+        self.assertEqual(self.pointer(), (None, None))
+        first = self.visit(status=Visit.Status.DISCHARGED)
+        second = self.visit()
+        self.assertEqual(self.pointer(), (second.id, "waiting"))
+
+        # a change to an older visit leaves the pointer alone
+        first.status = Visit.Status.ADMITTED
+        first.save()
+        self.assertEqual(self.pointer(), (second.id, "waiting"))
+
+        second.delete()
+        self.assertEqual(self.pointer(), (first.id, "admitted"))
+
+    def test_stale_patient_save_keeps_pointer(self):
+        stale = Patient.objects.get(pk=self.patient.pk)
+        visit = self.visit()
+        stale.addr = "new address"
+        stale.save()
+        self.assertEqual(self.pointer(), (visit.id, "waiting"))
+        self.assertEqual(Patient.objects.get(pk=self.patient.pk).addr, "new address")
+
+    def test_admission_and_status(self):
+        self.assertEqual(self.client.get(f'/patient/status/{self.patient.id}').status_code, 404)
+        self.assertEqual(self.post_visit().status_code, 201)
+        response = self.post_visit()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("still admitted or waiting", response.json()["error"])
+
+        response = self.client.patch(f'/patient/status/{self.patient.id}', data=json.dumps({"status": "admitted"}), content_type='application/json')
+        self.assertEqual(response.json()["status"], "admitted")
+        status = self.client.get(f'/patient/status/{self.patient.id}').json()
+        self.assertEqual((status["status"], status["visit_id"]), ("admitted", self.pointer()[0]))
+        self.assertEqual(self.client.get(f'/async/patient/status/{self.patient.id}').json(), status)
+
+        self.client.patch(f'/patient/status/{self.patient.id}', data=json.dumps({"status": "discharged"}), content_type='application/json')
+        response = self.client.patch(f'/patient/status/{self.patient.id}', data=json.dumps({"status": "admitted"}), content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(self.post_visit().status_code, 201)
+        self.assertEqual(Visit.objects.filter(patient=self.patient).count(), 2)
+
+    def test_backfill(self):
+        self.visit(status=Visit.Status.DISCHARGED)
+        latest = self.visit(status=Visit.Status.ADMITTED)
+        Patient.objects.update(current_visit=None, current_status=None)
+        call_command('backfill_current_visit', chunk_size=1, stdout=io.StringIO())
+        self.assertEqual(self.pointer(), (latest.id, "admitted"))
+
+class OccupancyTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        patcher = mock.patch.object(occupancy, '_local', occupancy.LocalOccupancy())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # ids get reused between tests, don't let the names of earlier ones linger
+        name_index.clear()
+
+        self.hospital = Hospital.objects.create(name="Board Hospital", addr="x")
+        self.other_hospital = Hospital.objects.create(name="Other Board Hospital", addr="x")
+        self.er = Department.objects.create(name="Board ER")
+        self.icu = Department.objects.create(name="Board ICU")
+        self.doctor = Doctor.objects.create(name="Dr. Board", hospital=self.hospital, department=self.er)
+        self.patients = [
+            Patient.objects.create(name=f"Board Patient {i}", addr="x", email=f"board{i}@example.com") for i in range(3)
+        ]
+
+        self.client = Client()
+        user = User.objects.create_user(username="board-staff", password="pass", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='view_visit'))
+        self.client.login(username="board-staff", password="pass")
+
+    def visit(self, patient, department, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Visit.objects.create(patient=patient, doctor=self.doctor, hospital=self.hospital, department=department, **kwargs)
+
+    def counts(self, hospital=None):
+        board = occupancy.hospital_board((hospital or self.hospital).id)
+        return {d["id"]: (d["waiting"], d["admitted"]) for d in board["departments"] if d["waiting"] or d["admitted"]}
+
+    def test_follows_visits(self):
+        first = self.visit(self.patients[0], self.er)
+        self.visit(self.patients[1], self.er, status=Visit.Status.ADMITTED)
+        third = self.visit(self.patients[2], self.icu)
+        self.visit(self.patients[2], self.icu, status=Visit.Status.DISCHARGED)
+        self.assertEqual(self.counts(), {self.er.id: (1, 1), self.icu.id: (1, 0)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.status = Visit.Status.ADMITTED
+            first.save()
+            third.hospital = self.other_hospital
+            third.save()
+        self.assertEqual(self.counts(), {self.er.id: (0, 2)})
+        self.assertEqual(self.counts(self.other_hospital), {self.icu.id: (1, 0)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(self.counts(), {self.er.id: (0, 1)})
+
+    def test_rolled_back_visit_not_counted(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Visit.objects.create(patient=self.patients[0], doctor=self.doctor, hospital=self.hospital, department=self.er)
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.counts(), {})
+
+    def test_reconcile(self):
+        self.visit(self.patients[0], self.er)
+        self.visit(self.patients[1], self.icu, status=Visit.Status.ADMITTED)
+        occupancy.store().apply({(self.hospital.id, self.er.id, "waiting"): 5, (self.other_hospital.id, self.er.id, "admitted"): 1})
+
+        result = tasks.reconcile_occupancy.delay().get()
+        self.assertEqual(result["corrected"], [self.hospital.id, self.other_hospital.id])
+        self.assertEqual(self.counts(), {self.er.id: (1, 0), self.icu.id: (0, 1)})
+        self.assertEqual(self.counts(self.other_hospital), {})
+        self.assertEqual(occupancy.reconcile()["corrected"], [])
+
+    def test_board_endpoint(self):
+        self.visit(self.patients[0], self.er)
+        self.visit(self.patients[1], self.icu, status=Visit.Status.ADMITTED)
+        response = self.client.get(f'/hospital/{self.hospital.id}/occupancy')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "hospital": {"id": self.hospital.id, "name": "Board Hospital"},
+            "departments": [
+                {"id": self.er.id, "waiting": 1, "admitted": 0, "name": "Board ER"},
+                {"id": self.icu.id, "waiting": 0, "admitted": 1, "name": "Board ICU"},
+            ],
+            "waiting": 1,
+            "admitted": 1,
+        })
+        self.assertEqual(self.client.get('/hospital/0/occupancy').status_code, 404)
+
+class PatientBulkTests(TestCase):
+    def setUp(self):
+        self.group = Group.objects.create(name="PatientUser")
+        self.client = Client()
+        user = User.objects.create_user(username="bulk-staff", password="pass", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='add_patient'))
+        self.client.login(username="bulk-staff", password="pass")
+
+    def post(self, rows):
+        return self.client.post('/patients/bulk', data=json.dumps(rows), content_type='application/json')
+
+    def test_registers_patients_and_users(self):
+        rows = [{"name": f"Bulk {i}", "email": f"bulk{i}@example.com", "addr": "x", "phone": f"98765432{i:02d}"} for i in range(5)]
+        response = self.post(rows)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["summary"]["created"], 5)
+
+        for result in response.json()["results"]:
+            patient = Patient.objects.get(pk=result["id"])
+            self.assertEqual(patient.user_id_id, result["user_id"])
+            self.assertEqual(patient.user_id.username, patient.name)
+            self.assertEqual(list(patient.user_id.groups.all()), [self.group])
+            self.assertEqual(PatientSerializer.cu.decrypt(patient.phone), rows[result["row"]]["phone"])
+            self.assertFalse(patient.user_id.has_usable_password())
+            self.assertTrue(default_token_generator.check_token(patient.user_id, result["activation"]["token"]))
+
+    def test_duplicates_are_reported(self):
+        self.post([{"name": "Taken", "email": "taken@example.com", "addr": "x", "phone": "9876543210"}])
+        response = self.post([
+            {"name": "Taken", "email": "other@example.com", "addr": "x"},
+            {"name": "Fresh", "email": "taken@example.com", "addr": "x"},
+            {"name": "Phone", "email": "phone@example.com", "addr": "x", "phone": "9876543210"},
+            {"name": "Twice", "email": "twice@example.com", "addr": "x"},
+            {"name": "Twice", "email": "twice2@example.com", "addr": "x"},
+            {"name": "Bad", "email": "not-an-email", "addr": "x"},
+        ])
+        statuses = [result["status"] for result in response.json()["results"]]
+        self.assertEqual(statuses, ["error", "error", "error", "created", "error", "error"])
+        self.assertEqual(Patient.objects.count(), 2)
+
+    def test_duplicates_ignore_case(self):
+        self.post([{"name": "Taken", "email": "taken@example.com", "addr": "x"}])
+        response = self.post([
+            {"name": "TAKEN", "email": "fresh@example.com", "addr": "x"},
+            {"name": "Fresh", "email": "Taken@Example.com", "addr": "x"},
+            {"name": "Alice", "email": "alice@example.com", "addr": "x"},
+            {"name": "alice", "email": "alice2@example.com", "addr": "x"},
+            {"name": "Bob", "email": "BOB@example.com", "addr": "x"},
+            {"name": "Robert", "email": "bob@example.com", "addr": "x"},
+        ])
+        statuses = [result["status"] for result in response.json()["results"]]
+        self.assertEqual(statuses, ["error", "error", "created", "error", "created", "error"])
+
+    def test_unforeseen_clash_is_reported_per_row(self):
+        with mock.patch.object(Patient.objects, 'bulk_create', side_effect=IntegrityError("duplicate entry")):
+            response = self.post([{"name": "Clash", "email": "clash@example.com", "addr": "x"}])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"][0]["status"], "error")
+        self.assertFalse(User.objects.filter(username="Clash").exists())
+
+    def test_phone_fits_its_column(self):
+        longest, too_long = "+" * 21 + "9876543210", "91 " * 10 + "9876543210"
+        response = self.post([
+            {"name": "Longest", "email": "longest@example.com", "addr": "x", "phone": longest},
+            {"name": "Too Long", "email": "toolong@example.com", "addr": "x", "phone": too_long},
+        ])
+        self.assertEqual([result["status"] for result in response.json()["results"]], ["created", "error"])
+        phone = Patient.objects.get(name="Longest").phone
+        self.assertLessEqual(len(phone), Patient._meta.get_field('phone').max_length)
+        self.assertEqual(PatientSerializer.cu.decrypt(phone), longest)
+        with self.assertRaises(ValidationError):
+            PatientSerializer().validate_phone(too_long)
+
+class PatientActivationTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        self.patient = Patient.objects.create(name="Activate Me", addr="x", email="activate@example.com")
+        self.user = User.objects.get(pk=self.patient.user_id_id)
+
+    def activate(self, password, activation=None):
+        activation = activation or activation_token(self.user)
+        return Client().post('/patients/activate', data=json.dumps({**activation, "password": password}), content_type='application/json')
+
+    def test_new_user_has_no_password(self):
+        self.assertFalse(self.user.has_usable_password())
+
+    def test_activate(self):
+        activation = activation_token(self.user)
+        self.assertEqual(self.activate("123", activation).status_code, 400)
+
+        response = self.activate("a-much-better-password", activation)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Client().login(username="Activate Me", password="a-much-better-password"))
+
+        # the token dies with the unusable password
+        self.assertEqual(self.activate("another-good-password", activation).status_code, 400)
+
+    def test_invalid_token(self):
+        response = self.activate("a-much-better-password", {"uid": activation_token(self.user)["uid"], "token": "nope"})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.get(pk=self.user.pk).has_usable_password())
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def send_many(self, messages):
+        self.sent += [message["to"] for message in messages]
+        return [{"to": message["to"], "status": "sent"} for message in messages]
+
+# the connection breaks after the first message of every batch, the ones after it come back
+# to be retried
+class BreakingTransport(FakeTransport):
+    def send_many(self, messages):
+        results = super().send_many(messages[:1])
+        return results + [{"to": message["to"], "status": "failed", "error": "gone", "retry": True} for message in messages[1:]]
+
+class DownTransport(FakeTransport):
+    def send_many(self, messages):
+        return [{"to": message["to"], "status": "failed", "error": "down", "retry": True} for message in messages]
+
+class PatientNotificationTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        for i in range(7):
+            Patient.objects.create(name=f"Notify {i}", addr="x", email=f"notify{i}@example.com")
+        self.transport = FakeTransport()
+        for patcher in (
+            mock.patch('patient.tasks.get_transport', return_value=self.transport),
+            mock.patch('patient.tasks.CHUNK_SIZE', 2),
+            mock.patch('patient.tasks.CONCURRENCY', 2),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_sends_every_patient_once_in_chunks(self):
+        result = tasks.send_patient_notifications.apply().get()
+        run = NotificationRun.objects.get(pk=result["run"])
+        self.assertEqual(run.status, NotificationRun.Status.DONE)
+        self.assertEqual(sorted(self.transport.sent), sorted(Patient.objects.values_list('email', flat=True)))
+        self.assertEqual(tasks.progress(run.pk), {"chunks": 4, "pending": 0, "claimed": 0, "done": 4, "sent": 7, "failed": 0})
+
+        # a second trigger the same day doesn't send again
+        tasks.send_patient_notifications.apply()
+        self.assertEqual(len(self.transport.sent), 7)
+
+    def test_outage_backs_off(self):
+        self.transport.send_many = DownTransport().send_many
+        run = NotificationRun.objects.create(kind=tasks.DAILY, scheduled_for=timezone.localdate(), chunk_size=2)
+        tasks.plan_run(run)
+        with mock.patch.object(tasks.dispatch_notification_run, 'apply_async') as later:
+            tasks.dispatch_notification_run.apply(args=(run.pk,))
+        # every chunk was tried once and waits, the run comes back when the first may go again
+        self.assertEqual(set(run.chunks.values_list('status', 'attempts')), {(NotificationChunk.Status.PENDING, 1)})
+        self.assertGreater(later.call_args.kwargs["countdown"], tasks.RETRY_DELAY - 5)
+        run.refresh_from_db()
+        self.assertEqual(run.status, NotificationRun.Status.SENDING)
+        self.assertFalse(tasks._claimable(run.pk).exists())
+
+    def test_broken_connection_retries_the_rest(self):
+        self.transport = BreakingTransport()
+        with mock.patch('patient.tasks.get_transport', return_value=self.transport), mock.patch('patient.tasks.RETRY_DELAY', 0):
+            result = tasks.send_patient_notifications.apply().get()
+        self.assertEqual(sorted(self.transport.sent), sorted(Patient.objects.values_list('email', flat=True)))
+        self.assertEqual(tasks.progress(result["run"]), {"chunks": 4, "pending": 0, "claimed": 0, "done": 4, "sent": 7, "failed": 0})
+
+    def test_give_up_counts_patients(self):
+        # a gap in the ids isn't a patient that failed
+        Patient.objects.get(email="notify1@example.com").delete()
+        self.transport.send_many = DownTransport().send_many
+        with mock.patch('patient.tasks.RETRY_DELAY', 0), mock.patch('patient.tasks.MAX_ATTEMPTS', 2):
+            result = tasks.send_patient_notifications.apply().get()
+        progress = tasks.progress(result["run"])
+        self.assertEqual((progress["done"], progress["sent"], progress["failed"]), (progress["chunks"], 0, 6))
+        self.assertEqual(set(NotificationChunk.objects.values_list('attempts', flat=True)), {2})
+
+    def test_resume_skips_finished_chunks(self):
+        run = NotificationRun.objects.create(kind=tasks.DAILY, scheduled_for=timezone.localdate(), chunk_size=2)
+        tasks.plan_run(run)
+        chunks = list(run.chunks.order_by('first_id'))
+        stale = timezone.now() - timedelta(seconds=tasks.LEASE + 60)
+        # a worker finished the first chunk and died while sending the second
+        NotificationChunk.objects.filter(pk=chunks[0].pk).update(status=NotificationChunk.Status.DONE, sent=2, claimed_at=stale)
+        NotificationChunk.objects.filter(pk=chunks[1].pk).update(status=NotificationChunk.Status.CLAIMED, claimed_at=stale)
+        NotificationRun.objects.filter(pk=run.pk).update(created_at=stale)
+
+        self.assertEqual(tasks.resume_notification_runs.apply().get(), {"resumed": [run.pk]})
+        first_chunk = set(Patient.objects.filter(id__lte=chunks[0].last_id).values_list('email', flat=True))
+        self.assertEqual(len(self.transport.sent), 5)
+        self.assertFalse(first_chunk & set(self.transport.sent))
+        run.refresh_from_db()
+        self.assertEqual(run.status, NotificationRun.Status.DONE)
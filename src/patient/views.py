@@ -2,23 +2,38 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
-from datetime import datetime
+from django.http import Http404
+from django.db import transaction
+from datetime import datetime, timedelta, time as dt_time
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from .models import *
 from hospital.models import *
+from hospital.index import name_index
 from doctor.models import *
 from .serializer import *
+from . import occupancy
+from .search import patient_index
+from .services import register_patients, activation_token, activate, InvalidActivation, MAX_ROWS
+from hospital.ingest import iter_records
 from utils.tasks import send_email_task
 from dotenv import load_dotenv
 from functools import wraps
-from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from django.contrib.auth.decorators import permission_required
 from django.utils.decorators import method_decorator
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 from utils.crypto import CryptUtils
 from django.core.cache import cache
+from utils.cache import detail_key, CACHE_TTL
+from utils.pagination import KeysetPaginator, InvalidCursor, cached_page
+from utils.streaming import stream_format, stream_response
+from utils.async_views import AsyncReadView, json_response
+from itertools import islice
 import json
 import re
 import os
+import io
 import time
 
 # tries to match user_id and caller patient_id
@@ -35,6 +50,16 @@ def check_authorisation(func):
 
     return wrapper
 
+# check_authorisation for the async views, returns the patient( from queryset )
+async def acheck_authorisation(request, pk, queryset=Patient.objects):
+    try:
+        patient = await queryset.aget(pk=pk)
+    except Patient.DoesNotExist:
+        raise PermissionDenied("Patient not found.")
+    if not request.user.is_staff and patient.user_id_id != request.user.id:
+        raise PermissionDenied("You are not authorised to access this patient's information.")
+    return patient
+
 class PatientList(APIView):
     permission_classes = [IsAuthenticated, IsAdminUser]
 
@@ -42,22 +67,20 @@ class PatientList(APIView):
     def get(self, request):
         if not request.user.is_staff:
             return Response("You are not allowed", status=status.HTTP_403_FORBIDDEN)
-        
-        start_time_cache = time.time()
-        cached_data = cache.get('patient_list')
-        print("cached data", cached_data)
-        end_time_cache = time.time()
-        if cached_data is not None:
-            print(f"Cache hit: {(end_time_cache - start_time_cache)*1000} ms")
-            return Response(cached_data, status=status.HTTP_200_OK)
 
-        start_time_db = time.time()
-        patients = Patient.objects.all()
-        serializer = PatientSerializer(patients, many=True)
-        end_time_db = time.time()
-        print(f"Database hit: {(end_time_db - start_time_db)*1000} ms")
-        cache.set('patient_list', serializer.data, timeout=60*10)
-        return Response(serializer.data)
+        # ?stream=1 / ?stream=ndjson exports every patient instead of a page
+        fmt = stream_format(request)
+        if fmt:
+            return stream_response(patient_projection.queryset(Patient.objects.order_by('id')), patient_projection.serialize, fmt)
+        
+        try:
+            paginator = KeysetPaginator(request, Patient)
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        data, next_cursor = cached_page(
+            paginator, Patient, patient_projection.queryset(Patient.objects.all()), patient_projection.serialize
+        )
+        return Response(data, status=status.HTTP_200_OK, headers=paginator.get_headers(next_cursor))
     
     @method_decorator(permission_required('patient.change_patient', raise_exception=True))
     def post(self, request):
@@ -68,6 +91,9 @@ class PatientList(APIView):
 
         serializer = PatientSerializer(data=request.data)
         phone, email = request.data["phone"], request.data["email"]
+        # the encrypted number has to fit its column
+        if len(str(phone).encode()) > PHONE_MAX_LENGTH:
+            return Response(f"A phone number can be at most {PHONE_MAX_LENGTH} characters", status=status.HTTP_400_BAD_REQUEST)
         if not bool(re.fullmatch(r"((\+*)((0[ -]*)*|((91 )*))((\d{12})+|(\d{10})+))|\d{5}([- ]*)\d{6}", phone)):
             return Response("Enter a valid phone number", status=status.HTTP_400_BAD_REQUEST)
         serializer.validate_phone(phone)
@@ -75,9 +101,12 @@ class PatientList(APIView):
         if serializer.is_valid():
             serializer.save()
             name = request.data.get("name", "undefined")
+            # the account has no password until the patient activates it with this token
+            activation = activation_token(serializer.instance.user_id)
             result = send_email_task.delay(
                 "Patient Registered!",
-                f"Hello, {name}!\nYou have succesfully registered as a patient. Here are your details - \n {serializer.data}",
+                f"Hello, {name}!\nYou have succesfully registered as a patient. Here are your details - \n {serializer.data}"
+                f"\n\nSet your password at /patients/activate with uid {activation['uid']} and token {activation['token']}",
                 os.getenv("RECEIVER_MAIL")
             )
             serializer.data["task_id"] = result.id
@@ -86,6 +115,69 @@ class PatientList(APIView):
         
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+# bulk registration, takes a JSON array or NDJSON( application/x-ndjson ) body of
+# {"name", "email", "addr", "phone", "dob"} rows and creates the patients and their users in one go
+class PatientBulkList(APIView):
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+    @method_decorator(permission_required('patient.add_patient', raise_exception=True))
+    def post(self, request):
+        try:
+            rows = list(islice(iter_records(request.stream or io.BytesIO(), request.content_type or ""), MAX_ROWS + 1))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > MAX_ROWS:
+            return Response({"error": f"At most {MAX_ROWS} patients per request"}, status=status.HTTP_400_BAD_REQUEST)
+
+        summary, results = register_patients(
+            rows,
+            actor_id=getattr(getattr(request, 'jwt_user', None), 'id', None) or request.user.id,
+            ip_address=getattr(request, 'client_ip', None),
+        )
+        return Response({"summary": summary, "results": results}, status=status.HTTP_200_OK)
+
+# first password of a patient account, {"uid", "token", "password"} from the registration mail
+class PatientActivateView(APIView):
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        try:
+            activate(request.data.get("uid", ""), request.data.get("token", ""), request.data.get("password", ""))
+        except InvalidActivation as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except ValidationError as e:
+            return Response({"password": e.messages}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"message": "Account activated, you can log in now"}, status=status.HTTP_200_OK)
+
+# fuzzy lookup for the front desk, ?q=<part of a name or email>&limit=, best matches first
+SEARCH_MAX_LIMIT = 100
+
+class PatientSearchView(APIView):
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+    @method_decorator(permission_required('patient.view_patient', raise_exception=True))
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if len(query) < 2:
+            return Response({"error": "'q' needs at least 2 characters"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 20)), SEARCH_MAX_LIMIT))
+        except ValueError:
+            return Response({"error": "limit must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        matches = patient_index.search(query, limit)
+        # the index only knows names, the rows come from the database( and one deleted by another
+        # worker since the last reload drops out here )
+        rows = Patient.objects.only('name', 'email', 'dob', 'current_status').in_bulk([pk for pk, _ in matches])
+        return Response([{
+            "id": pk,
+            "name": rows[pk].name,
+            "email": rows[pk].email,
+            "dob": rows[pk].dob,
+            "current_status": rows[pk].current_status,
+            "score": score,
+        } for pk, score in matches if pk in rows], status=status.HTTP_200_OK)
+
 class PatientView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -98,8 +190,9 @@ class PatientView(APIView):
     @method_decorator(permission_required('patient.view_patient', raise_exception=True))
     @method_decorator(check_authorisation)
     def get(self, request, pk):
+        key = detail_key(Patient, pk)
         start_time_cache = time.time()
-        cache_data = cache.get(f'patient_{pk}')
+        cache_data = cache.get(key)
         end_time_cache = time.time()
         if cache_data is not None:
             print(f"Cache hit: {(end_time_cache - start_time_cache)*1000} ms")
@@ -109,7 +202,7 @@ class PatientView(APIView):
         if not visit:
             return Response(status.HTTP_400_BAD_REQUEST)
         serializer = PatientSerializer(visit)
-        cache.set(f'patient_{pk}', serializer.data, timeout=60*10)
+        cache.set(key, serializer.data, timeout=CACHE_TTL)
         end_time_db = time.time()
         print(f"Database hit: {(end_time_db - start_time_db)*1000} ms")
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -146,29 +239,114 @@ class PatientView(APIView):
         visit.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+# the joined names come straight out of values_list, no model instances per visit
+VISIT_LIST_COLUMNS = ('id', 'patient__name', 'hospital__name', 'department__name', 'doctor__name', 'timestamp', 'status')
+
+def visit_list_queryset():
+    return Visit.objects.values_list(*VISIT_LIST_COLUMNS, named=True)
+
+# GET /visits equality filters, query parameter -> column
+VISIT_FILTERS = {"status": "status", "hospital": "hospital_id", "department": "department_id", "doctor": "doctor_id", "patient": "patient_id"}
+VISIT_ORDERINGS = {"timestamp": ('timestamp', 'id'), "-timestamp": ('-timestamp', '-id')}
+
+class InvalidFilter(ValueError):
+    pass
+
+# (aware datetime, whether it was a plain date) of the 'from'/'to' parameter
+def _visit_time(params, name):
+    value = params[name]
+    try:
+        # a date first, parse_datetime takes "2024-01-31" as well( as midnight )
+        day = parse_date(value)
+        if day is not None:
+            moment, whole_day = datetime.combine(day, dt_time.min), True
+        else:
+            moment, whole_day = parse_datetime(value), False
+            if moment is None:
+                raise ValueError
+    except ValueError:
+        raise InvalidFilter(f"'{name}' must be a date or a datetime( ISO 8601 )")
+    return (timezone.make_aware(moment) if timezone.is_naive(moment) else moment), whole_day
+
+# ?from=&to=&status=&hospital=&department=&doctor=&patient=&ordering=[-]timestamp, only the filter
+# combinations VISIT_FILTER_INDEXES has an index for are taken, anything else would scan the table.
+# returns the filtered queryset and the keys to order/paginate it by
+def filter_visits(queryset, params):
+    filters = {}
+    for name, column in VISIT_FILTERS.items():
+        value = params.get(name)
+        if value is None:
+            continue
+        if name == 'status':
+            if value not in Visit.Status.values:
+                raise InvalidFilter(f"'status' must be one of {', '.join(Visit.Status.values)}")
+        elif not (value.isascii() and value.isdigit()):
+            raise InvalidFilter(f"'{name}' must be an id")
+        filters[column] = value
+
+    names = frozenset(name for name in VISIT_FILTERS if name in params)
+    if names not in VISIT_FILTER_INDEXES:
+        supported = sorted(' + '.join(sorted(combination)) for combination in VISIT_FILTER_INDEXES if combination)
+        raise InvalidFilter(f"can't filter by {' + '.join(sorted(names))} together, supported: {'; '.join(supported)}")
+
+    if params.get('from'):
+        filters['timestamp__gte'] = _visit_time(params, 'from')[0]
+    if params.get('to'):
+        moment, whole_day = _visit_time(params, 'to')
+        # a plain date means up to the end of that day
+        if whole_day:
+            filters['timestamp__lt'] = moment + timedelta(days=1)
+        else:
+            filters['timestamp__lte'] = moment
+
+    ordering = params.get('ordering', 'timestamp')
+    if ordering not in VISIT_ORDERINGS:
+        raise InvalidFilter(f"'ordering' must be one of {', '.join(VISIT_ORDERINGS)}")
+    return queryset.filter(**filters), VISIT_ORDERINGS[ordering]
+
+def serialize_visits(rows):
+    return [{
+        "id": row.id,
+        "patient_name": row.patient__name,
+        "hospital_name": row.hospital__name,
+        "department_name": row.department__name,
+        "doctor_name": row.doctor__name,
+        "visit_date": row.timestamp,
+        "status": row.status
+    } for row in rows]
+
+# a new visit needs the latest one( Patient.current_status ) to be over
+def can_admit(current_status):
+    return current_status in (None, Visit.Status.DISCHARGED)
+
+def still_admitted():
+    return Response(
+        {"error": "Patient cannot create a new visit while still admitted or waiting"},
+        status=status.HTTP_400_BAD_REQUEST,
+    )
+
 class VisitList(APIView):
     permission_classes = [IsAuthenticated, IsAdminUser] 
 
     # replace all patient, hospital, department, doctor ids with actual names
     @method_decorator(permission_required('patient.view_visit', raise_exception=True))
     def get(self, request):
-        visits = Visit.objects.select_related(
-            'patient', 'hospital', 'department', 'doctor'
-        ).all()
-
-        visit_data = []
-        for visit in visits:
-            visit_data.append({
-                "id": visit.id,
-                "patient_name": visit.patient.name,
-                "hospital_name": visit.hospital.name,
-                "department_name": visit.department.name,
-                "doctor_name": visit.doctor.name,
-                "visit_date": visit.timestamp,
-                "status": visit.status
-            })
-
-        return Response(visit_data, status=status.HTTP_200_OK)
+        try:
+            queryset, keys = filter_visits(visit_list_queryset(), request.query_params)
+        except InvalidFilter as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        fmt = stream_format(request)
+        if fmt:
+            return stream_response(queryset.order_by(*keys), serialize_visits, fmt)
+
+        try:
+            paginator = KeysetPaginator(request, Visit, keys=keys)
+        except InvalidCursor as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        visits, next_cursor = paginator.get_page(paginator.paginate_queryset(queryset))
+
+        return Response(serialize_visits(visits), status=status.HTTP_200_OK, headers=paginator.get_headers(next_cursor))
     
     @method_decorator(permission_required('patient.change_visit', raise_exception=True))
     def post(self, request):
@@ -180,31 +358,36 @@ class VisitList(APIView):
         model_mapping = {
             "patient": Patient,
             "doctor": Doctor,
-            "hospital": Hospital,
-            "department": Department,
+        }
+        index_mapping = {
+            "hospital": name_index.hospital_id,
+            "department": name_index.department_id,
         }
 
         try:
+            found = {}
             for key, model in model_mapping.items():
 
-                obj = get_object_or_404(model, name=data.get(key))
-                data[key] = obj.id
+                found[key] = get_object_or_404(model, name=data.get(key))
+                data[key] = found[key].id
 
-            # dont record a visit of the patient if they haven't been discharged from other places yet
-            patient_id = data["patient"]
-            last_visit = Visit.objects.filter(patient_id=patient_id).order_by('-timestamp').first()
-            if last_visit and last_visit.status != Visit.Status.DISCHARGED:
-                return Response(
-                    {"error": "Patient cannot create a new visit while still admitted or waiting"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+            # hospitals and departments come out of the process-local name index
+            for key, lookup in index_mapping.items():
+                data[key] = lookup(data.get(key))
+                if data[key] is None:
+                    raise Http404(f"No {key.capitalize()} matches the given query.")
+
+            # dont record a visit of the patient if they haven't been discharged from other places yet,
+            # the status of their latest visit came with the patient row
+            if not can_admit(found["patient"].current_status):
+                return still_admitted()
 
             # check if the doctor is linked to the hospital and department
             hospital_id = data["hospital"]
             department_id = data["department"]
             doctor_id = data["doctor"]
             doctor = Doctor.objects.get(id=doctor_id)
-            if not doctor.hospital.id==hospital_id or not doctor.department.id==department_id:
+            if not doctor.hospital_id==hospital_id or not doctor.department_id==department_id:
                 return Response(
                     {"error": "Doctor does not belong to the specified hospital or department"},
                     status=status.HTTP_400_BAD_REQUEST,
@@ -214,10 +397,16 @@ class VisitList(APIView):
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         serializer = VisitSerializer(data=data)
-        if serializer.is_valid():
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        # checked again with the patient row locked until the visit is in, two requests can't both
+        # get past the check above
+        with transaction.atomic():
+            current_status = Patient.objects.select_for_update().values_list('current_status', flat=True).get(pk=data["patient"])
+            if not can_admit(current_status):
+                return still_admitted()
             serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
     
 class VisitView(APIView):
     permission_classes = [IsAuthenticated]
@@ -293,11 +482,11 @@ class StatusView(APIView):
     @method_decorator(check_authorisation)
     def get(self, request, pk):
         try:
-            patient = get_object_or_404(Patient, pk=pk)
+            patient = get_object_or_404(Patient.objects.select_related('current_visit'), pk=pk)
         except Patient.DoesNotExist:
             return Response({"error": "Patient not found"}, status=status.HTTP_400_BAD_REQUEST)
     
-        latest_visit = Visit.objects.filter(patient=patient).order_by('-timestamp').first()
+        latest_visit = patient.current_visit
         if not latest_visit:
             return Response({"message": "No visits found for this patient"}, status=status.HTTP_404_NOT_FOUND)
             
@@ -310,23 +499,82 @@ class StatusView(APIView):
     @method_decorator(permission_required('patient.change_patient', raise_exception=True))
     @method_decorator(check_authorisation)
     def patch(self, request, pk):
-        try:
-            patient = get_object_or_404(Patient, pk        # Get the latest active visit (not discharged)
-=pk)
-        except Patient.DoesNotExist:
-            return Response({"error": "Patient not found"}, status=status.HTTP_400_BAD_REQUEST)
-
-        visit = Visit.objects.filter(patient=patient).exclude(status=Visit.Status.DISCHARGED).order_by('-timestamp').first()
-        if not visit:
-            return Response({"error": "No active visits found for this patient"}, status=status.HTTP_404_NOT_FOUND)
         new_status = request.data.get("status")
         if not new_status or new_status not in Visit.Status.values:
             return Response({"error": "Invalid status value"}, status=status.HTTP_400_BAD_REQUEST)
-        visit.status = new_status
-        visit.save()
+
+        # the active visit is the current one unless that is over already, the patient row stays
+        # locked so a visit can't be admitted in between
+        with transaction.atomic():
+            try:
+                patient = Patient.objects.select_for_update().get(pk=pk)
+            except Patient.DoesNotExist:
+                return Response({"error": "Patient not found"}, status=status.HTTP_400_BAD_REQUEST)
+
+            if can_admit(patient.current_status):
+                return Response({"error": "No active visits found for this patient"}, status=status.HTTP_404_NOT_FOUND)
+            visit = Visit.objects.get(pk=patient.current_visit_id)
+            visit.status = new_status
+            visit.save()
 
         return Response({
             "status": visit.status,
             "visit_id": visit.id,
             "timestamp": visit.timestamp
-        }, status=status.HTTP_200_OK)
\ No newline at end of file
+        }, status=status.HTTP_200_OK)
+
+# the waiting/admitted board of one hospital, read from the live counters( patient/occupancy.py )
+# in one round trip instead of a GROUP BY over the visits
+class HospitalOccupancyView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @method_decorator(permission_required('patient.view_visit', raise_exception=True))
+    def get(self, request, pk):
+        hospital_name = name_index.hospital_name(pk)
+        if hospital_name is None:
+            return Response({"error": "Hospital not found"}, status=status.HTTP_404_NOT_FOUND)
+
+        board = occupancy.hospital_board(pk)
+        for department in board["departments"]:
+            department["name"] = name_index.department_name(department["id"])
+        return Response({"hospital": {"id": pk, "name": hospital_name}, **board}, status=status.HTTP_200_OK)
+
+# async versions of the read endpoints, under /async/( utils/async_views.py )
+
+class AsyncStatusView(AsyncReadView):
+    permission = 'patient.view_patient'
+
+    async def get(self, request, pk):
+        patient = await acheck_authorisation(request, pk, Patient.objects.select_related('current_visit'))
+        latest_visit = patient.current_visit
+        if not latest_visit:
+            return json_response({"message": "No visits found for this patient"}, status=status.HTTP_404_NOT_FOUND)
+
+        return json_response({
+            "status": latest_visit.status,
+            "visit_id": latest_visit.id,
+            "timestamp": latest_visit.timestamp
+        })
+
+class AsyncVisitView(AsyncReadView):
+    permission = 'patient.view_visit'
+    cu = VisitView.cu
+    get_age = VisitView.get_age
+
+    async def get(self, request, pk):
+        patient = await acheck_authorisation(request, pk)
+        visits = [visit async for visit in Visit.objects.filter(patient_id=pk).order_by('-timestamp')]
+        if not visits:
+            return json_response({"message": "No visits found for this patient"}, status=status.HTTP_404_NOT_FOUND)
+
+        return json_response({
+            "patient": {
+                "id": patient.id,
+                "name": patient.name,
+                "email": patient.email,
+                "address": patient.addr,
+                "phone": self.cu.decrypt(patient.phone),
+                "age": self.get_age(patient.dob)
+            },
+            "visits": VisitSerializer(visits, many=True).data
+        })
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from reporting import rollup
+
+# the first fill of the rollups goes through every visit, run it here instead of waiting for beat
+# to get through it MAX_BATCHES at a time. safe to run next to the scheduled job, they take turns
+class Command(BaseCommand):
+    help = "Folds the visits changed since the last run into the daily reporting rollups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=rollup.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        done = 0
+        while True:
+            count = rollup.process_batch(options['batch_size'])
+            if count == 0:
+                break
+            done += count
+            self.stdout.write(f"folded in {done} visit changes")
+        self.stdout.write(self.style.SUCCESS(f"done, {done} visit changes folded in"))
@@ -0,0 +1,69 @@
+from django.db import models
+from django.utils import timezone
+
+# daily rollups of the visits table for the reports api, kept up to date by reporting.rollup from
+# the visits changed since its watermark. hospital/department/doctor are plain ids, a deleted
+# hospital doesn't take its history with it
+
+# visits per day( of the visit ), hospital, department, doctor and current status
+class DailyVisitRollup(models.Model):
+    day = models.DateField()
+    hospital_id = models.IntegerField(null=True)
+    department_id = models.IntegerField(null=True)
+    doctor_id = models.IntegerField(null=True)
+    status = models.CharField(max_length=10)
+    visits = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'hospital_id', 'department_id', 'doctor_id', 'status')
+        indexes = [
+            models.Index(fields=['hospital_id', 'day'], name='visit_rollup_hospital_day_idx'),
+        ]
+
+# admissions and discharges per day they happened( VisitTransition ), under the visit's current
+# hospital, department and doctor
+class DailyAdmissionRollup(models.Model):
+    day = models.DateField()
+    hospital_id = models.IntegerField(null=True)
+    department_id = models.IntegerField(null=True)
+    doctor_id = models.IntegerField(null=True)
+    admissions = models.IntegerField(default=0)
+    discharges = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'hospital_id', 'department_id', 'doctor_id')
+        indexes = [
+            models.Index(fields=['hospital_id', 'day'], name='admission_rollup_hosp_day_idx'),
+        ]
+
+# where each visit is counted right now, so a change can be taken out of the old rollup row
+class VisitLedger(models.Model):
+    visit_id = models.IntegerField(primary_key=True)
+    day = models.DateField()
+    hospital_id = models.IntegerField(null=True)
+    department_id = models.IntegerField(null=True)
+    doctor_id = models.IntegerField(null=True)
+    status = models.CharField(max_length=10)
+    # the day its admission/discharge was counted on, if it was
+    admitted_on = models.DateField(null=True)
+    discharged_on = models.DateField(null=True)
+
+# visits deleted since the last run, written in the deleting transaction( reporting/signals.py )
+class DeletedVisit(models.Model):
+    visit_id = models.IntegerField(primary_key=True)
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+# a visit becoming admitted or discharged, written by Visit.save in the changing transaction( the
+# old status is known there ) and consumed by the next run like the tombstones. a visit admitted
+# and discharged between two runs still counts its admission, on the day it happened
+class VisitTransition(models.Model):
+    visit_id = models.IntegerField()
+    status = models.CharField(max_length=10)
+    at = models.DateTimeField(default=timezone.now)
+
+# how far the job got, (updated_at, id) of the last visit it folded in
+class RollupWatermark(models.Model):
+    name = models.CharField(max_length=32, primary_key=True)
+    updated_at = models.DateTimeField(null=True)
+    last_id = models.IntegerField(default=0)
+    ran_at = models.DateTimeField(null=True)
@@ -0,0 +1,167 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from collections import Counter
+from datetime import timedelta
+from patient.models import Visit
+from utils.logger import log, Level
+from .models import DailyVisitRollup, DailyAdmissionRollup, VisitLedger, DeletedVisit, VisitTransition, RollupWatermark
+
+# visits folded in per transaction, and how many of those one run may do before leaving the rest
+# to the next one( the first run goes through the whole table )
+BATCH_SIZE = getattr(settings, 'REPORTING_BATCH_SIZE', 5000)
+MAX_BATCHES = getattr(settings, 'REPORTING_MAX_BATCHES', 50)
+# a transaction can commit a visit with an updated_at older than one already seen, visits younger
+# than this are left for the next run so the watermark doesn't pass them
+LAG = getattr(settings, 'REPORTING_WATERMARK_LAG', 60)
+WATERMARK = 'visits'
+
+VISIT_COLUMNS = ('id', 'timestamp', 'updated_at', 'hospital_id', 'department_id', 'doctor_id', 'status')
+DIMENSIONS = ('day', 'hospital_id', 'department_id', 'doctor_id')
+
+def _day(value):
+    return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+
+# rollup rows for the keys, read under the job's lock and written back with two bulk queries
+def _apply(model, deltas, fields):
+    deltas = {key: values for key, values in deltas.items() if any(values)}
+    if not deltas:
+        return
+    dimensions = DIMENSIONS + (('status',) if model is DailyVisitRollup else ())
+    days = {key[0] for key in deltas}
+    hospitals = {key[1] for key in deltas}
+    hospital_filter = Q(hospital_id__in=hospitals - {None})
+    if None in hospitals:
+        hospital_filter |= Q(hospital_id__isnull=True)
+
+    existing = {
+        tuple(getattr(row, d) for d in dimensions): row
+        for row in model.objects.filter(hospital_filter, day__in=days)
+    }
+    changed, created = [], []
+    for key, values in deltas.items():
+        row = existing.get(key)
+        if row is None:
+            row = model(**dict(zip(dimensions, key)))
+            created.append(row)
+        else:
+            changed.append(row)
+        for field, delta in zip(fields, values):
+            setattr(row, field, getattr(row, field) + delta)
+    model.objects.bulk_update(changed, fields)
+    model.objects.bulk_create(created)
+
+class _Deltas:
+    def __init__(self):
+        self.visits = Counter()
+        self.events = {}
+
+    def event(self, key, admissions=0, discharges=0):
+        a, d = self.events.get(key, (0, 0))
+        self.events[key] = (a + admissions, d + discharges)
+
+    # takes a ledger entry out of every rollup it is counted in
+    def remove(self, entry):
+        dims = (entry.hospital_id, entry.department_id, entry.doctor_id)
+        self.visits[(entry.day, *dims, entry.status)] -= 1
+        if entry.admitted_on:
+            self.event((entry.admitted_on, *dims), admissions=-1)
+        if entry.discharged_on:
+            self.event((entry.discharged_on, *dims), discharges=-1)
+
+    def save(self):
+        _apply(DailyVisitRollup, {key: (delta,) for key, delta in self.visits.items()}, ('visits',))
+        _apply(DailyAdmissionRollup, self.events, ('admissions', 'discharges'))
+
+# the visits changed since the watermark, folded into the rollups: each one leaves the row its
+# ledger entry says it was counted in and joins the one it belongs to now. admissions and
+# discharges come from the VisitTransition rows Visit.save wrote, a visit's first one of each is
+# counted on the day it happened. returns the number of visits done, 0 when caught up
+def process_batch(batch_size=None):
+    batch_size = batch_size or BATCH_SIZE
+    with transaction.atomic():
+        RollupWatermark.objects.get_or_create(name=WATERMARK)
+        # one job at a time, a second run waits here and then carries on from where this one stopped
+        watermark = RollupWatermark.objects.select_for_update().get(name=WATERMARK)
+
+        cutoff = timezone.now() - timedelta(seconds=LAG)
+        visits = Visit.objects.filter(updated_at__lte=cutoff)
+        if watermark.updated_at is not None:
+            visits = visits.filter(
+                Q(updated_at__gt=watermark.updated_at) | Q(updated_at=watermark.updated_at, id__gt=watermark.last_id)
+            )
+        rows = {row.id: row for row in visits.order_by('updated_at', 'id').values_list(*VISIT_COLUMNS, named=True)[:batch_size]}
+        deleted = list(DeletedVisit.objects.values_list('visit_id', flat=True)[:batch_size])
+        transitions = list(VisitTransition.objects.filter(at__lte=cutoff).order_by('id')[:batch_size])
+        if not rows and not deleted and not transitions:
+            RollupWatermark.objects.filter(pk=WATERMARK).update(ran_at=timezone.now())
+            return 0
+
+        ledger = VisitLedger.objects.in_bulk(list(rows) + deleted + [t.visit_id for t in transitions])
+        # a transition of a visit the job hasn't folded in yet( further along the watermark ) waits
+        # for it, one of a visit that is gone is dropped
+        pending = {t.visit_id for t in transitions} - set(rows) - set(ledger)
+        waiting = set(Visit.objects.filter(pk__in=pending).values_list('id', flat=True)) - set(deleted)
+        done = [t for t in transitions if t.visit_id not in waiting]
+        happened = {}
+        for transition in done:
+            happened.setdefault((transition.visit_id, transition.status), _day(transition.at))
+
+        deltas = _Deltas()
+        changed, created = [], []
+        for visit_id in (set(rows) | {t.visit_id for t in done}) - set(deleted):
+            row, entry = rows.get(visit_id), ledger.get(visit_id)
+            if entry is None:
+                if row is None:
+                    continue  # gone
+                entry = VisitLedger(visit_id=visit_id)
+                created.append(entry)
+            else:
+                deltas.remove(entry)
+                changed.append(entry)
+
+            if row is not None:
+                entry.day = _day(row.timestamp)
+                entry.hospital_id, entry.department_id, entry.doctor_id = row.hospital_id, row.department_id, row.doctor_id
+                entry.status = row.status
+            if entry.admitted_on is None:
+                entry.admitted_on = happened.get((visit_id, Visit.Status.ADMITTED))
+            if entry.discharged_on is None:
+                entry.discharged_on = happened.get((visit_id, Visit.Status.DISCHARGED))
+
+            dims = (entry.hospital_id, entry.department_id, entry.doctor_id)
+            deltas.visits[(entry.day, *dims, entry.status)] += 1
+            if entry.admitted_on:
+                deltas.event((entry.admitted_on, *dims), admissions=1)
+            if entry.discharged_on:
+                deltas.event((entry.discharged_on, *dims), discharges=1)
+
+        for visit_id in deleted:
+            if visit_id in ledger:
+                deltas.remove(ledger[visit_id])
+
+        deltas.save()
+        VisitLedger.objects.bulk_update(changed, ['day', 'hospital_id', 'department_id', 'doctor_id', 'status', 'admitted_on', 'discharged_on'])
+        VisitLedger.objects.bulk_create(created)
+        VisitLedger.objects.filter(visit_id__in=deleted).delete()
+        DeletedVisit.objects.filter(visit_id__in=deleted).delete()
+        VisitTransition.objects.filter(id__in=[t.id for t in done]).delete()
+
+        update = {"ran_at": timezone.now()}
+        if rows:
+            last = list(rows.values())[-1]
+            update.update(updated_at=last.updated_at, last_id=last.id)
+        RollupWatermark.objects.filter(pk=WATERMARK).update(**update)
+    return len(set(rows) | set(deleted) | {t.visit_id for t in done})
+
+def update_rollups(max_batches=None, batch_size=None):
+    done, batches = 0, 0
+    for batches in range(1, (max_batches or MAX_BATCHES) + 1):
+        count = process_batch(batch_size)
+        done += count
+        if count == 0:
+            break
+    watermark = RollupWatermark.objects.filter(pk=WATERMARK).values_list('updated_at', flat=True).first()
+    log(Level.INFO, f"Visit rollups: {done} changes folded in over {batches} batches, watermark at {watermark}")
+    return {"visits": done, "batches": batches, "watermark": watermark}
@@ -0,0 +1,8 @@
+from celery import shared_task
+from . import rollup
+
+# folds the visits changed since the last run into the daily rollups, see reporting/rollup.py
+@shared_task
+def update_rollups():
+    result = rollup.update_rollups()
+    return {**result, "watermark": result["watermark"] and result["watermark"].isoformat()}
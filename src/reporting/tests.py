@@ -0,0 +1,225 @@
+from django.test import TestCase, Client
+from django.contrib.auth.models import User, Group, Permission
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from patient.models import Patient, Visit
+from hospital.models import Hospital, Department
+from doctor.models import Doctor
+from .models import DailyVisitRollup, DailyAdmissionRollup, VisitLedger, DeletedVisit, VisitTransition, RollupWatermark
+from . import rollup
+
+class RollupTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        # visits are folded in as soon as they're saved
+        patcher = mock.patch.object(rollup, 'LAG', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.hospital = Hospital.objects.create(name="Report Hospital", addr="x")
+        self.other_hospital = Hospital.objects.create(name="Other Report Hospital", addr="x")
+        self.er = Department.objects.create(name="Report ER")
+        self.doctor = Doctor.objects.create(name="Dr. Report", hospital=self.hospital, department=self.er)
+        self.patient = Patient.objects.create(name="Report Patient", addr="x", email="report@example.com")
+        self.today = timezone.localdate()
+
+    def visit(self, **kwargs):
+        kwargs.setdefault('hospital', self.hospital)
+        return Visit.objects.create(patient=self.patient, doctor=self.doctor, department=self.er, **kwargs)
+
+    def visits(self):
+        return {
+            (row.hospital_id, row.status): row.visits
+            for row in DailyVisitRollup.objects.filter(day=self.today) if row.visits
+        }
+
+    def events(self, hospital=None):
+        row = DailyAdmissionRollup.objects.filter(day=self.today, hospital_id=(hospital or self.hospital).id).first()
+        return (row.admissions, row.discharges) if row else (0, 0)
+
+    def test_incremental(self):
+        first = self.visit()
+        self.visit(status=Visit.Status.ADMITTED)
+        self.assertEqual(rollup.update_rollups()["visits"], 2)
+        self.assertEqual(self.visits(), {(self.hospital.id, 'waiting'): 1, (self.hospital.id, 'admitted'): 1})
+        self.assertEqual(self.events(), (1, 0))
+
+        # nothing changed, nothing to do
+        self.assertEqual(rollup.update_rollups()["visits"], 0)
+
+        # only the changed visit is read again, and moves out of its old row
+        first.status = Visit.Status.ADMITTED
+        first.save()
+        self.assertEqual(rollup.update_rollups()["visits"], 1)
+        self.assertEqual(self.visits(), {(self.hospital.id, 'admitted'): 2})
+        self.assertEqual(self.events(), (2, 0))
+
+        first.status = Visit.Status.DISCHARGED
+        first.hospital = self.other_hospital
+        first.save()
+        rollup.update_rollups()
+        self.assertEqual(self.visits(), {(self.hospital.id, 'admitted'): 1, (self.other_hospital.id, 'discharged'): 1})
+        # the admission moves with the visit, it's counted once
+        self.assertEqual(self.events(), (1, 0))
+        self.assertEqual(self.events(self.other_hospital), (1, 1))
+
+    def test_transitions_between_runs(self):
+        visit = self.visit()
+        rollup.update_rollups()
+        # admitted and discharged before the job runs again, the admission still counts
+        visit.status = Visit.Status.ADMITTED
+        visit.save()
+        visit.status = Visit.Status.DISCHARGED
+        visit.save()
+        self.assertEqual(rollup.update_rollups()["visits"], 1)
+        self.assertEqual(self.events(), (1, 1))
+        self.assertFalse(VisitTransition.objects.exists())
+
+        # saved without its status loaded, the old one is read first
+        deferred = Visit.objects.only('id').get(pk=self.visit().pk)
+        deferred.status = Visit.Status.ADMITTED
+        deferred.save()
+        deferred = Visit.objects.only('id').get(pk=deferred.pk)
+        deferred.status = Visit.Status.ADMITTED
+        deferred.save()
+        self.assertEqual(VisitTransition.objects.filter(visit_id=deferred.pk).count(), 1)
+
+    def test_transition_counted_on_its_day(self):
+        yesterday = self.today - timedelta(days=1)
+        visit = self.visit(status=Visit.Status.ADMITTED)
+        VisitTransition.objects.filter(visit_id=visit.pk).update(at=timezone.now() - timedelta(days=1))
+        rollup.update_rollups()
+        self.assertEqual(self.events(), (0, 0))
+        row = DailyAdmissionRollup.objects.get(day=yesterday, hospital_id=self.hospital.id)
+        self.assertEqual((row.admissions, row.discharges), (1, 0))
+        self.assertEqual(VisitLedger.objects.get(visit_id=visit.pk).admitted_on, yesterday)
+
+    def test_batches(self):
+        for _ in range(5):
+            self.visit()
+        result = rollup.update_rollups(batch_size=2)
+        self.assertEqual((result["visits"], result["batches"]), (5, 4))
+        self.assertEqual(self.visits(), {(self.hospital.id, 'waiting'): 5})
+        self.assertEqual(VisitLedger.objects.count(), 5)
+
+        # a run stops after max_batches and leaves the rest to the next one
+        for _ in range(3):
+            self.visit()
+        self.assertEqual(rollup.update_rollups(max_batches=1, batch_size=2)["visits"], 2)
+        self.assertEqual(rollup.update_rollups(batch_size=2)["visits"], 1)
+        self.assertEqual(self.visits(), {(self.hospital.id, 'waiting'): 8})
+
+    def test_deleted_visit(self):
+        visit = self.visit(status=Visit.Status.ADMITTED)
+        self.visit()
+        rollup.update_rollups()
+
+        visit_id = visit.id
+        visit.delete()
+        self.assertTrue(DeletedVisit.objects.filter(visit_id=visit_id).exists())
+        self.assertEqual(rollup.update_rollups()["visits"], 1)
+        self.assertEqual(self.visits(), {(self.hospital.id, 'waiting'): 1})
+        self.assertEqual(self.events(), (0, 0))
+        self.assertFalse(DeletedVisit.objects.exists())
+        self.assertFalse(VisitLedger.objects.filter(visit_id=visit_id).exists())
+
+        # deleted before the job ever saw it
+        self.visit().delete()
+        rollup.update_rollups()
+        self.assertEqual(self.visits(), {(self.hospital.id, 'waiting'): 1})
+
+    def test_watermark_lag(self):
+        self.visit()
+        with mock.patch.object(rollup, 'LAG', 60):
+            self.assertEqual(rollup.update_rollups()["visits"], 0)
+        self.assertEqual(rollup.update_rollups()["visits"], 1)
+        self.assertIsNotNone(RollupWatermark.objects.get(pk=rollup.WATERMARK).updated_at)
+
+    def test_rollup_writes_not_audited(self):
+        from utils.models import Log
+
+        self.visit()
+        before = Log.objects.count()
+        rollup.update_rollups()
+        self.assertEqual(Log.objects.count(), before)
+
+class ReportViewTests(TestCase):
+    def setUp(self):
+        Group.objects.create(name="PatientUser")
+        patcher = mock.patch.object(rollup, 'LAG', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.hospital = Hospital.objects.create(name="Report View Hospital", addr="x")
+        self.other_hospital = Hospital.objects.create(name="Other Report View Hospital", addr="x")
+        self.er = Department.objects.create(name="Report View ER")
+        self.doctor = Doctor.objects.create(name="Dr. Report View", hospital=self.hospital, department=self.er)
+        self.patient = Patient.objects.create(name="Report View Patient", addr="x", email="reportview@example.com")
+
+        self.today = timezone.localdate()
+        self.yesterday = self.today - timedelta(days=1)
+        for hospital, status, days_ago in [
+            (self.hospital, Visit.Status.WAITING, 0),
+            (self.hospital, Visit.Status.ADMITTED, 0),
+            (self.hospital, Visit.Status.WAITING, 1),
+            (self.other_hospital, Visit.Status.DISCHARGED, 1),
+        ]:
+            visit = Visit.objects.create(patient=self.patient, doctor=self.doctor, hospital=hospital, department=self.er, status=status)
+            Visit.objects.filter(pk=visit.pk).update(timestamp=timezone.now() - timedelta(days=days_ago))
+        rollup.update_rollups()
+
+        self.client = Client()
+        user = User.objects.create_user(username="report-staff", password="pass", is_staff=True)
+        user.user_permissions.add(Permission.objects.get(codename='view_visit'))
+        self.client.login(username="report-staff", password="pass")
+
+    def report(self, path='/reports/visits', **params):
+        params.setdefault('from', self.yesterday.isoformat())
+        params.setdefault('to', self.today.isoformat())
+        return self.client.get(path, params)
+
+    def test_visits_by_day(self):
+        response = self.report()
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["visits"], 4)
+        self.assertEqual(data["rows"], [
+            {"day": self.yesterday.isoformat(), "visits": 2},
+            {"day": self.today.isoformat(), "visits": 2},
+        ])
+        self.assertIsNotNone(data["as_of"])
+
+    def test_filters_and_groups(self):
+        data = self.report(hospital=self.hospital.id, group_by='status').json()
+        self.assertEqual(data["rows"], [{"status": "admitted", "visits": 1}, {"status": "waiting", "visits": 2}])
+
+        data = self.report(**{'from': self.today.isoformat(), 'group_by': 'hospital,status'}).json()
+        self.assertEqual(data["rows"], [
+            {"hospital": self.hospital.id, "status": "admitted", "visits": 1},
+            {"hospital": self.hospital.id, "status": "waiting", "visits": 1},
+        ])
+
+    def test_admissions(self):
+        data = self.report('/reports/admissions', group_by='hospital').json()
+        self.assertEqual((data["admissions"], data["discharges"]), (1, 1))
+        self.assertEqual(data["rows"], [
+            {"hospital": self.hospital.id, "admissions": 1, "discharges": 0},
+            {"hospital": self.other_hospital.id, "admissions": 0, "discharges": 1},
+        ])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/reports/visits').status_code, 400)
+        self.assertEqual(self.report(**{'from': 'yesterday'}).status_code, 400)
+        self.assertEqual(self.report(**{'from': self.today.isoformat(), 'to': self.yesterday.isoformat()}).status_code, 400)
+        self.assertEqual(self.report(**{'from': '2000-01-01'}).status_code, 400)
+        self.assertEqual(self.report(group_by='patient').status_code, 400)
+        # a digit to python, not to int()
+        self.assertEqual(self.report(hospital='²').status_code, 400)
+        self.assertEqual(self.report('/reports/admissions', group_by='status').status_code, 400)
+
+    def test_requires_permission(self):
+        User.objects.create_user(username="report-nobody", password="pass")
+        client = Client()
+        client.login(username="report-nobody", password="pass")
+        self.assertEqual(client.get('/reports/visits', {'from': self.today, 'to': self.today}).status_code, 403)
@@ -0,0 +1,97 @@
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
+from django.contrib.auth.decorators import permission_required
+from django.utils.decorators import method_decorator
+from django.db.models import Sum
+from datetime import date
+from .models import DailyVisitRollup, DailyAdmissionRollup, RollupWatermark
+from .rollup import WATERMARK
+
+# longest date range one report may ask for
+MAX_DAYS = getattr(settings, 'REPORT_MAX_DAYS', 366)
+
+# query parameter -> rollup column
+GROUPS = {"day": "day", "hospital": "hospital_id", "department": "department_id", "doctor": "doctor_id"}
+
+class InvalidReport(Exception):
+    pass
+
+def _date(request, name):
+    value = request.query_params.get(name)
+    if not value:
+        raise InvalidReport(f"'{name}' is required( YYYY-MM-DD )")
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise InvalidReport(f"'{name}' must be a date( YYYY-MM-DD )")
+
+# ?from=&to=[&hospital=&department=&doctor=][&group_by=day,hospital,...], both dates included
+def _report(request, model, fields, groups):
+    start, end = _date(request, 'from'), _date(request, 'to')
+    if end < start:
+        raise InvalidReport("'to' is before 'from'")
+    if (end - start).days >= MAX_DAYS:
+        raise InvalidReport(f"at most {MAX_DAYS} days per report")
+
+    rows = model.objects.filter(day__gte=start, day__lte=end)
+    for name in ('hospital', 'department', 'doctor'):
+        value = request.query_params.get(name)
+        if value is not None:
+            if not (value.isascii() and value.isdigit()):
+                raise InvalidReport(f"'{name}' must be an id")
+            rows = rows.filter(**{GROUPS[name]: int(value)})
+    if 'status' in groups and request.query_params.get('status'):
+        rows = rows.filter(status=request.query_params['status'])
+
+    group_by = [name for name in request.query_params.get('group_by', 'day').split(',') if name]
+    unknown = set(group_by) - set(groups)
+    if unknown:
+        raise InvalidReport(f"can't group by {', '.join(sorted(unknown))}, only by {', '.join(groups)}")
+    columns = [groups[name] for name in group_by]
+
+    sums = {field: Sum(field) for field in fields}
+    totals = rows.aggregate(**sums)
+    result = []
+    if columns:
+        for row in rows.values(*columns).annotate(**sums).order_by(*columns):
+            if any(row[field] for field in fields):
+                result.append({
+                    **{name: row[column] for name, column in zip(group_by, columns)},
+                    **{field: row[field] for field in fields},
+                })
+
+    watermark = RollupWatermark.objects.filter(pk=WATERMARK).values_list('updated_at', flat=True).first()
+    return Response({
+        "from": start,
+        "to": end,
+        # the rollups hold the visits changed up to this point
+        "as_of": watermark,
+        "group_by": group_by,
+        "rows": result,
+        **{field: totals[field] or 0 for field in fields},
+    }, status=status.HTTP_200_OK)
+
+# visits per day of the visit, by their current status
+class VisitReportView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @method_decorator(permission_required('patient.view_visit', raise_exception=True))
+    def get(self, request):
+        try:
+            return _report(request, DailyVisitRollup, ('visits',), {**GROUPS, "status": "status"})
+        except InvalidReport as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+# admissions and discharges per day they happened
+class AdmissionReportView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @method_decorator(permission_required('patient.view_visit', raise_exception=True))
+    def get(self, request):
+        try:
+            return _report(request, DailyAdmissionRollup, ('admissions', 'discharges'), GROUPS)
+        except InvalidReport as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
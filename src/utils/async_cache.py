@@ -0,0 +1,88 @@
+from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from .cache import _model_gen_key, _list_gen_key, _object_gen_key, _new_generation, _gen_timeout
+import asyncio
+import weakref
+
+# the cache for async views. django's own cache.aget()/aset() run the sync client in a thread, this
+# talks to redis with redis.asyncio on the event loop instead. keys and values go through
+# django-redis' own make_key/encode/decode, so both sides read and write the same entries.
+# a cache that isn't django-redis( locmem in tests ) falls back to django's async api
+class AsyncCache:
+    def __init__(self, backend=cache):
+        self.backend = backend
+        # redis.asyncio connections belong to the loop that opened them
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _redis_client(self):
+        client = getattr(self.backend, 'client', None)
+        if not hasattr(client, 'encode') or not hasattr(client, '_server'):
+            return None
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            import redis.asyncio
+
+            # reads and writes both go to the first( primary ) server
+            options = getattr(client, '_options', {})
+            self._clients[loop] = redis.asyncio.Redis.from_url(
+                client._server[0], **options.get('CONNECTION_POOL_KWARGS', {})
+            )
+        return self._clients[loop]
+
+    def _expiry(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.backend.default_timeout
+        return None if timeout is None else int(timeout * 1000)
+
+    async def get(self, key, default=None):
+        redis = self._redis_client()
+        if redis is None:
+            return await self.backend.aget(key, default)
+        value = await redis.get(self.backend.client.make_key(key))
+        return default if value is None else self.backend.client.decode(value)
+
+    async def get_many(self, keys):
+        redis = self._redis_client()
+        if redis is None:
+            return await self.backend.aget_many(keys)
+        if not keys:
+            return {}
+        values = await redis.mget([self.backend.client.make_key(key) for key in keys])
+        return {key: self.backend.client.decode(value) for key, value in zip(keys, values) if value is not None}
+
+    async def set(self, key, value, timeout=DEFAULT_TIMEOUT, nx=False):
+        redis = self._redis_client()
+        if redis is None:
+            if nx:
+                return await self.backend.aadd(key, value, timeout)
+            await self.backend.aset(key, value, timeout)
+            return True
+        px = self._expiry(timeout)
+        if px is not None and px <= 0:
+            return False
+        return bool(await redis.set(self.backend.client.make_key(key), self.backend.client.encode(value), px=px, nx=nx))
+
+    async def add(self, key, value, timeout=DEFAULT_TIMEOUT):
+        return await self.set(key, value, timeout, nx=True)
+
+acache = AsyncCache()
+
+# async twins of utils.cache generations()/list_key()/detail_key(), same keys
+async def agenerations(keys):
+    found = await acache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            gen = _new_generation()
+            found[key] = gen if await acache.add(key, gen, timeout=_gen_timeout(key)) else await acache.get(key, gen)
+    return [found[key] for key in keys]
+
+async def anamed_generation(name):
+    return (await agenerations([f"gen:{name}"]))[0]
+
+async def alist_key(model, *parts):
+    model_gen, list_gen = await agenerations([_model_gen_key(model), _list_gen_key(model)])
+    return ":".join([f"{model._meta.model_name}_list", f"g{model_gen}.{list_gen}", *map(str, parts)])
+
+async def adetail_key(model, pk, *parts):
+    model_gen, object_gen = await agenerations([_model_gen_key(model), _object_gen_key(model, pk)])
+    return ":".join([f"{model._meta.model_name}_{pk}", f"g{model_gen}.{object_gen}", *map(str, parts)])
@@ -0,0 +1,41 @@
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.views import View
+from rest_framework import exceptions, status
+from rest_framework.renderers import JSONRenderer
+from .authentication import CachedJWTAuthentication
+from .backends import ahas_perm
+
+_renderer = JSONRenderer()
+
+# same bytes DRF's Response would send
+def json_response(data, status=status.HTTP_200_OK, headers=None):
+    body = b'' if data is None else _renderer.render(data)
+    return HttpResponse(body, status=status, content_type='application/json', headers=headers)
+
+# base for the async read endpoints under /async/. DRF's APIView can't run async handlers, so this
+# does the parts of it those endpoints need: jwt( or session ) authentication, the model permission
+# the sync view requires and DRF's error bodies. the handlers are `async def get`
+class AsyncReadView(View):
+    permission = None
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            result = await CachedJWTAuthentication().aauthenticate(request)
+        except exceptions.AuthenticationFailed as e:
+            return json_response({"detail": e.detail}, status=status.HTTP_401_UNAUTHORIZED)
+        user = result[0] if result else await request.auser()
+        if not user.is_authenticated:
+            return json_response(
+                {"detail": exceptions.NotAuthenticated.default_detail}, status=status.HTTP_401_UNAUTHORIZED
+            )
+        request.user = user
+
+        try:
+            if self.permission and not await ahas_perm(user, self.permission):
+                raise PermissionDenied
+            return await super().dispatch(request, *args, **kwargs)
+        except PermissionDenied as e:
+            return json_response(
+                {"detail": str(e) or exceptions.PermissionDenied.default_detail}, status=status.HTTP_403_FORBIDDEN
+            )
@@ -0,0 +1,243 @@
+from django.conf import settings
+from django.db import close_old_connections, DataError, IntegrityError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .models import Log
+from .logger import log, Level
+import atexit
+import glob
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+# buffered: a background thread bulk inserts the records
+# celery:   the background thread hands each batch to utils.tasks.write_audit_logs_task
+# sync:     insert right away in the calling thread( old behaviour )
+MODE = getattr(settings, 'AUDIT_LOG_MODE', 'buffered')
+BATCH_SIZE = getattr(settings, 'AUDIT_BATCH_SIZE', 200)
+FLUSH_INTERVAL = getattr(settings, 'AUDIT_FLUSH_INTERVAL', 1.0)
+MAX_QUEUE = getattr(settings, 'AUDIT_MAX_QUEUE', 100000)
+# records that couldn't be written are appended here and replayed on the next successful flush
+SPOOL_PATH = getattr(settings, 'AUDIT_SPOOL_PATH', os.path.join('logs', 'audit_spool.jsonl'))
+# a spooled record the database keeps refusing on its own( its actor was deleted meanwhile ) is
+# moved here after this many replays instead of being retried forever
+MAX_REPLAYS = getattr(settings, 'AUDIT_MAX_REPLAYS', 3)
+REJECTED_PATH = getattr(settings, 'AUDIT_REJECTED_PATH', None)
+
+# what a single record can be refused for, anything else( the database went away ) is no reason to
+# give up on it
+RECORD_ERRORS = (IntegrityError, DataError, ValueError, TypeError, KeyError)
+
+_STOP = object()
+
+def to_json(record):
+    return {**record, "timestamp": record["timestamp"].isoformat()}
+
+def from_json(record):
+    record = {**record, "timestamp": parse_datetime(record["timestamp"])}
+    record.pop("replays", None)  # spool bookkeeping, not a Log field
+    return record
+
+def write_records(records):
+    Log.objects.bulk_create([Log(**record) for record in records])
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# the request thread only builds a dict and puts it on a queue, the insert happens in batches on a
+# background thread
+class AuditWriter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # sync mode flushes( and replays ) on the request threads, one replay at a time per process
+        self._replay_lock = threading.Lock()
+        self._replays = itertools.count()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def record(self, action, actor_id=None, ip_address=None, method=None, metadata=None):
+        record = {
+            "timestamp": timezone.now(),
+            "action": action,
+            "actor_id": actor_id,
+            "ip_address": ip_address,
+            "method": method,
+            "metadata": metadata or {},
+        }
+        if MODE == 'sync':
+            return self._flush([record])
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # never block a request on the audit log
+            self._spool([record])
+
+    def _ensure_started(self):
+        # forked workers( gunicorn --preload, celery prefork ) don't inherit the parent's thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=MAX_QUEUE)
+            self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0.001) if batch else FLUSH_INTERVAL)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            if MODE == 'celery':
+                from .tasks import write_audit_logs_task
+                write_audit_logs_task.delay([to_json(record) for record in batch])
+            else:
+                write_records(batch)
+        except Exception as e:
+            log(Level.ERROR, f"Audit log flush of {len(batch)} records failed, spooling: {e}")
+            self._spool(batch)
+            return
+        finally:
+            if threading.current_thread() is self._thread:
+                close_old_connections()
+        self._replay_spool()
+
+    def _spool(self, records, path=None):
+        path = path or SPOOL_PATH
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, 'a') as f:
+                f.write("".join(
+                    (record if isinstance(record, str) else json.dumps(to_json(record), default=str) + "\n")
+                    for record in records
+                ))
+        except OSError as e:
+            log(Level.CRITICAL, f"Audit records lost, couldn't spool {len(records)} records: {e}")
+
+    # the spool moved aside under a name of our own( so records spooled while we replay land in a
+    # fresh file ), plus what a worker that died halfway through a replay left behind
+    def _claim_spool(self):
+        claimed = []
+        for path in [SPOOL_PATH] + glob.glob(glob.escape(SPOOL_PATH) + ".*.replay"):
+            if path != SPOOL_PATH:
+                # <spool>.<pid>-<n>.replay
+                owner = path[len(SPOOL_PATH) + 1:-len(".replay")].partition("-")[0]
+                if not owner.isdigit() or (int(owner) != os.getpid() and _alive(int(owner))):
+                    continue
+            replaying = f"{SPOOL_PATH}.{os.getpid()}-{next(self._replays)}.replay"
+            try:
+                os.replace(path, replaying)
+            except FileNotFoundError:
+                continue  # another worker got to it first
+            claimed.append(replaying)
+        return claimed
+
+    def _replay_spool(self):
+        if not os.path.exists(SPOOL_PATH) and not glob.glob(glob.escape(SPOOL_PATH) + ".*.replay"):
+            return
+        with self._replay_lock:
+            claimed = self._claim_spool()
+            if not claimed:
+                return
+            records, broken = [], []
+            for path in claimed:
+                with open(path) as f:
+                    for line in filter(str.strip, f):
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            broken.append(line)  # cut short by a crash while spooling
+
+            written, kept, rejected = self._replay(records)
+            # whatever wasn't written goes back into the live spool for the next replay
+            if kept:
+                self._spool(kept)
+            if rejected or broken:
+                rejected_path = REJECTED_PATH or f"{SPOOL_PATH}.rejected"
+                self._spool(rejected + broken, rejected_path)
+                log(Level.ERROR, f"Moved {len(rejected) + len(broken)} spooled audit records to {rejected_path}")
+            for path in claimed:
+                os.remove(path)
+        if written:
+            log(Level.INFO, f"Replayed {written} spooled audit records")
+        if kept:
+            log(Level.ERROR, f"Replaying spooled audit records failed, {len(kept)} kept in the spool")
+
+    # spooled records( as json ) in batches, a batch that fails is retried one record at a time so
+    # one bad record doesn't hold back the rest. returns (written, to keep, to reject), kept and
+    # rejected as spool lines
+    def _replay(self, records):
+        written, kept, rejected = 0, [], []
+        for start in range(0, len(records), BATCH_SIZE):
+            batch = records[start:start + BATCH_SIZE]
+            try:
+                write_records([from_json(record) for record in batch])
+                written += len(batch)
+                continue
+            except Exception:
+                pass
+            for i, record in enumerate(batch):
+                try:
+                    write_records([from_json(record)])
+                    written += 1
+                except RECORD_ERRORS as e:
+                    record = {**record, "replays": record.get("replays", 0) + 1}
+                    line = json.dumps(record, default=str) + "\n"
+                    if record["replays"] >= MAX_REPLAYS:
+                        log(Level.ERROR, f"Spooled audit record {record.get('action')!r} refused {record['replays']} times: {e}")
+                        rejected.append(line)
+                    else:
+                        kept.append(line)
+                except Exception as e:
+                    # the database itself, keep this record and everything after it for next time
+                    log(Level.ERROR, f"Replaying spooled audit records stopped: {e}")
+                    rest = batch[i:] + records[start + BATCH_SIZE:]
+                    return written, kept + [json.dumps(record, default=str) + "\n" for record in rest], rejected
+        return written, kept, rejected
+
+    # flush whatever is still queued, registered to run at interpreter exit
+    def shutdown(self, timeout=5):
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            self._spool(leftover)
+
+audit = AuditWriter()
+atexit.register(audit.shutdown)
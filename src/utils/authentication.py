@@ -0,0 +1,91 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+from .cache import detail_key
+from .async_cache import acache, adetail_key
+from asgiref.sync import sync_to_async
+import time
+
+# what gets cached about a user, enough for permission checks and views. the password hash stays
+# out, it is left deferred and loaded from the database only if something reads it
+SNAPSHOT_FIELDS = (
+    'id', 'username', 'email', 'first_name', 'last_name',
+    'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined',
+)
+
+_MISSING = object()
+
+def _user_from_snapshot(snapshot):
+    # from_db wants the values in model field order, anything not given stays deferred
+    fields = [f.attname for f in User._meta.concrete_fields if f.attname in snapshot]
+    return User.from_db('default', fields, [snapshot[field] for field in fields])
+
+# jwt authentication that runs once per request and caches the user behind a token.
+# AuditLogMiddleware authenticates first and leaves the result on the request, DRF then picks it
+# up instead of validating the token and loading the user a second time
+class CachedJWTAuthentication(JWTAuthentication):
+    def authenticate(self, request):
+        django_request = getattr(request, '_request', request)
+        result = getattr(django_request, '_jwt_auth', _MISSING)
+        if result is not _MISSING:
+            return result
+        # failures raise before anything is stored, so DRF re-raises them and answers 401
+        result = super().authenticate(request)
+        django_request._jwt_auth = result
+        return result
+
+    # token claims -> user snapshot, keyed by the token's jti and expiring with the token. the key
+    # carries the user's cache generation, so saving or deleting the user( password change,
+    # deactivation ) drops every snapshot of them
+    def get_user(self, validated_token):
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if jti is None or user_id is None or api_settings.USER_ID_FIELD != 'id':
+            return super().get_user(validated_token)
+
+        key = detail_key(User, user_id, 'jwt', jti)
+        snapshot = cache.get(key)
+        if snapshot is not None:
+            return _user_from_snapshot(snapshot)
+
+        user = super().get_user(validated_token)
+        timeout = int(validated_token.get('exp', 0) - time.time())
+        if timeout > 0:
+            cache.set(key, {field: getattr(user, field) for field in SNAPSHOT_FIELDS}, timeout=timeout)
+        return user
+
+    # the same for async views, the snapshot comes from the async cache and only a miss touches
+    # the database( in a thread )
+    async def aauthenticate(self, request):
+        django_request = getattr(request, '_request', request)
+        result = getattr(django_request, '_jwt_auth', _MISSING)
+        if result is not _MISSING:
+            return result
+
+        header = self.get_header(request)
+        raw_token = self.get_raw_token(header) if header is not None else None
+        if raw_token is None:
+            result = None
+        else:
+            validated_token = self.get_validated_token(raw_token)
+            result = (await self.aget_user(validated_token), validated_token)
+        django_request._jwt_auth = result
+        return result
+
+    async def aget_user(self, validated_token):
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if jti is None or user_id is None or api_settings.USER_ID_FIELD != 'id':
+            return await sync_to_async(super().get_user)(validated_token)
+
+        key = await adetail_key(User, user_id, 'jwt', jti)
+        snapshot = await acache.get(key)
+        if snapshot is not None:
+            return _user_from_snapshot(snapshot)
+
+        user = await sync_to_async(super().get_user)(validated_token)
+        timeout = int(validated_token.get('exp', 0) - time.time())
+        if timeout > 0:
+            await acache.set(key, {field: getattr(user, field) for field in SNAPSHOT_FIELDS}, timeout=timeout)
+        return user
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from .cache import LRUCache, detail_key, invalidate_instance, named_generation, bump_named, CACHE_TTL
+from .async_cache import acache, adetail_key, anamed_generation
+from asgiref.sync import sync_to_async
+
+# bumped when a change can touch many users at once( group permissions, deleted groups/permissions )
+PERMISSIONS_GENERATION = "permissions"
+
+local_permissions = LRUCache(
+    maxsize=getattr(settings, 'PERMISSION_CACHE_LOCAL_SIZE', 4096),
+    ttl=getattr(settings, 'PERMISSION_CACHE_LOCAL_TTL', 5),
+)
+
+def permissions_key(user_id):
+    return detail_key(User, user_id, "perms", f"p{named_generation(PERMISSIONS_GENERATION)}")
+
+async def apermissions_key(user_id):
+    return await adetail_key(User, user_id, "perms", f"p{await anamed_generation(PERMISSIONS_GENERATION)}")
+
+def invalidate_user_permissions(user_id):
+    local_permissions.delete(user_id)
+    # the user's own generation is part of the key, bumping it drops the shared entry
+    invalidate_instance(User, user_id)
+
+def invalidate_all_permissions():
+    local_permissions.clear()
+    bump_named(PERMISSIONS_GENERATION)
+
+# ModelBackend with the permission sets cached, first in a process-local lru and then in the shared
+# cache, so has_perm on a fresh user object( every request ) costs no query in steady state.
+# utils/signals.py invalidates on group and permission changes
+class CachedPermissionBackend(ModelBackend):
+    def get_all_permissions(self, user_obj, obj=None):
+        if not user_obj.is_active or user_obj.is_anonymous or obj is not None:
+            return set()
+        if not hasattr(user_obj, '_perm_cache'):
+            user_obj._perm_cache = self._cached_permissions(user_obj)
+        return user_obj._perm_cache
+
+    def _cached_permissions(self, user_obj):
+        perms = local_permissions.get(user_obj.pk)
+        if perms is not None:
+            return perms
+
+        key = permissions_key(user_obj.pk)
+        perms = cache.get(key)
+        if perms is None:
+            perms = super().get_all_permissions(user_obj)
+            cache.set(key, perms, timeout=CACHE_TTL)
+        local_permissions.set(user_obj.pk, perms)
+        return perms
+
+# user.has_perm() for async views( the user model only gets ahas_perm in django 5.2 ), same lru and
+# shared cache entries as CachedPermissionBackend
+async def aget_all_permissions(user_obj):
+    if not user_obj.is_active or user_obj.is_anonymous:
+        return set()
+    if hasattr(user_obj, '_perm_cache'):
+        return user_obj._perm_cache
+
+    perms = local_permissions.get(user_obj.pk)
+    if perms is None:
+        key = await apermissions_key(user_obj.pk)
+        perms = await acache.get(key)
+        if perms is None:
+            perms = await sync_to_async(ModelBackend().get_all_permissions)(user_obj)
+            await acache.set(key, perms, timeout=CACHE_TTL)
+        local_permissions.set(user_obj.pk, perms)
+    user_obj._perm_cache = perms
+    return perms
+
+async def ahas_perm(user_obj, perm):
+    if not user_obj.is_active:
+        return False
+    return user_obj.is_superuser or perm in await aget_all_permissions(user_obj)
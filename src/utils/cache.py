@@ -0,0 +1,189 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from collections import OrderedDict, Counter
+import threading
+import time
+
+# cached values can live long because every write bumps a generation counter that is part of the
+# cache key, the old entries are simply never read again and age out on their own
+CACHE_TTL = getattr(settings, 'CACHE_TTL', 60*60*6)
+# there is a per-object generation for every row ever read or written, they expire instead of
+# piling up in redis. longer than CACHE_TTL, an object's generation only goes once the entries
+# cached under it are gone too( and a new one starts at the current time, see _new_generation )
+OBJECT_GEN_TTL = getattr(settings, 'CACHE_OBJECT_GEN_TTL', CACHE_TTL * 4)
+
+# key layout, per model:
+#   gen:<app.model>          bumped for bulk writes, invalidates every list and detail key of the model
+#   gen:<app.model>:list     bumped on any save/delete of the model, invalidates its list keys
+#   gen:<app.model>:<pk>     bumped on save/delete of one instance, invalidates its detail key
+
+def _label(model):
+    return model._meta.label_lower
+
+def _model_gen_key(model):
+    return f"gen:{_label(model)}"
+
+def _list_gen_key(model):
+    return f"gen:{_label(model)}:list"
+
+def _object_gen_key(model, pk):
+    return f"gen:{_label(model)}:{pk}"
+
+# a missing generation (never set or evicted) starts at the current time so it can't collide with
+# a generation that was handed out before the eviction
+def _new_generation():
+    return time.time_ns()
+
+# the per-object keys expire, the few per model and the named ones are kept
+def _gen_timeout(key):
+    part = key.split(':')[2:]
+    return OBJECT_GEN_TTL if part and part != ['list'] else None
+
+def generations(keys):
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            gen = _new_generation()
+            found[key] = gen if cache.add(key, gen, timeout=_gen_timeout(key)) else cache.get(key, gen)
+    return [found[key] for key in keys]
+
+def _write_keys(models):
+    keys = []
+    for model in models:
+        keys += [_model_gen_key(model), _list_gen_key(model)]
+    return keys
+
+# changes whenever anything in one of the models is written, for process-local structures that
+# need to notice writes made by other workers
+def write_generation(*models):
+    return tuple(generations(_write_keys(models)))
+
+# per generation key, how many of its bumps were save/delete signals of this process. a
+# process-local copy updated by those same signals( hospital.index, patient.search ) can tell its
+# own writes from another worker's by them. _own_lock only guards the counters, never a redis call:
+# an own bump is in _own_in_flight from before its incr until it is counted
+_own_bumps = Counter()
+_own_in_flight = Counter()
+_own_lock = threading.Lock()
+# reads of a snapshot retried while own bumps of its keys are under way, then it's given up on
+SNAPSHOT_TRIES = 5
+
+def _bump(key, own=False):
+    if own:
+        with _own_lock:
+            _own_in_flight[key] += 1
+    counted = False
+    try:
+        cache.incr(key)
+        counted = own
+    except ValueError:
+        # evicted, the new generation can't be told apart from a foreign write
+        cache.add(key, _new_generation(), timeout=_gen_timeout(key))
+    finally:
+        if own:
+            with _own_lock:
+                _own_in_flight[key] -= 1
+                if counted:
+                    _own_bumps[key] += 1
+
+def _own_counts(keys):
+    with _own_lock:
+        return tuple(_own_bumps[key] for key in keys), any(_own_in_flight[key] for key in keys)
+
+# (write_generation, own bumps) of the models. the generations are read between two looks at the
+# counters, and only kept when no own bump of these keys started or finished meanwhile, a bump
+# counted on one side but not the other would pass a foreign write off as our own. own bumps is
+# None when that never happened, such a snapshot matches no other
+def write_snapshot(*models):
+    keys = _write_keys(models)
+    for _ in range(SNAPSHOT_TRIES):
+        before, busy = _own_counts(keys)
+        generation = tuple(generations(keys))
+        after, still_busy = _own_counts(keys)
+        if not busy and not still_busy and before == after:
+            return generation, after
+    return generation, None
+
+# (whether every write since the snapshot was one of this process' own signals, current snapshot).
+# a generation that moved by exactly our own bumps was written by nobody else
+def only_own_writes(snapshot, *models):
+    current = write_snapshot(*models)
+    (generation, own), (new_generation, new_own) = snapshot, current
+    if own is None or new_own is None:
+        return False, current
+    expected = tuple(gen + new - old for gen, old, new in zip(generation, own, new_own))
+    return expected == new_generation, current
+
+# generations that aren't tied to one model, e.g. 'permissions'
+def named_generation(name):
+    return generations([f"gen:{name}"])[0]
+
+def bump_named(name):
+    _bump(f"gen:{name}")
+    transaction.on_commit(lambda: _bump(f"gen:{name}"))
+
+def list_key(model, *parts):
+    model_gen, list_gen = generations([_model_gen_key(model), _list_gen_key(model)])
+    return ":".join([f"{model._meta.model_name}_list", f"g{model_gen}.{list_gen}", *map(str, parts)])
+
+def detail_key(model, pk, *parts):
+    model_gen, object_gen = generations([_model_gen_key(model), _object_gen_key(model, pk)])
+    return ":".join([f"{model._meta.model_name}_{pk}", f"g{model_gen}.{object_gen}", *map(str, parts)])
+
+def _bump_instance(model, pk):
+    _bump(_list_gen_key(model), own=True)
+    if pk is not None:
+        _bump(_object_gen_key(model, pk))
+
+def invalidate_instance(model, pk):
+    # bump right away for this request and again after commit, otherwise a reader could cache the
+    # pre-commit row under the new generation
+    _bump_instance(model, pk)
+    transaction.on_commit(lambda: _bump_instance(model, pk))
+
+def invalidate_model(model):
+    _bump(_model_gen_key(model))
+    transaction.on_commit(lambda: _bump(_model_gen_key(model)))
+
+def invalidate_on_save(sender, instance, **kwargs):
+    invalidate_instance(sender, instance.pk)
+
+def invalidate_on_delete(sender, instance, **kwargs):
+    invalidate_instance(sender, instance.pk)
+
+# small process-local lru with a ttl, a first level in front of the shared cache for values that
+# are read on every request. entries can be up to ttl seconds stale for writes made in other workers
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,53 @@
+from celery import Task
+from contextlib import contextmanager
+from contextvars import ContextVar
+import uuid
+
+# who the current piece of work is for: the actor( user id ), the client ip and a request id. it lives
+# in a context variable, so it follows the request through sync views, async views and the threads
+# asgiref hands sync code to, and ContextTask carries it into celery tasks as a message header.
+# audit entries and log lines read it instead of needing the request
+FIELDS = ('actor_id', 'ip_address', 'request_id')
+TASK_HEADER = 'hms_context'
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+_context = ContextVar('hms_context', default=None)
+
+def get():
+    return _context.get() or {}
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+# adds values on top of the current context, undo with reset(token)
+def bind(**values):
+    return _context.set({**get(), **{k: v for k, v in values.items() if k in FIELDS}})
+
+def reset(token):
+    _context.reset(token)
+
+@contextmanager
+def bound(**values):
+    token = bind(**values)
+    try:
+        yield get()
+    finally:
+        reset(token)
+
+# base class of every task( hms/celery.py ). the caller's context goes out with the message and
+# the task runs inside it, on a worker as well as eagerly
+class ContextTask(Task):
+    def apply_async(self, args=None, kwargs=None, task_id=None, producer=None, link=None, link_error=None,
+                    shadow=None, **options):
+        values = get()
+        if values:
+            options['headers'] = {**(options.get('headers') or {}), TASK_HEADER: values}
+        return super().apply_async(args, kwargs, task_id, producer, link, link_error, shadow, **options)
+
+    def __call__(self, *args, **kwargs):
+        # a worker turns message headers into request attributes, apply() keeps them under headers
+        values = getattr(self.request, TASK_HEADER, None) or (self.request.headers or {}).get(TASK_HEADER)
+        if not values:
+            return super().__call__(*args, **kwargs)
+        with bound(**values):
+            return super().__call__(*args, **kwargs)
@@ -1,19 +1,81 @@
 from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
 from hashlib import sha256
 from Crypto.Util.Padding import pad, unpad
+import hmac
+
+BLOCK = AES.block_size
+# values encrypted with a random iv are stored as "v2:" + hex(iv + ciphertext), anything without
+# the prefix is an old value encrypted with the fixed iv
+VERSION_PREFIX = "v2:"
+
+def _xor(a: bytes, b: bytes):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
 
 class CryptUtils:
     def __init__(self, key: str):
         # hash the key as to not leak it
         self.key = sha256(key.encode()).digest()
-        self.iv = b'1234567890123456'
+        # separate key for the blind index, so an index value says nothing about the cipher key
+        self.index_key = sha256(b"blind-index:" + key.encode()).digest()
+        self.iv = b'1234567890123456' # only used to read values written before random ivs
+        # cbc is done by hand on top of one ecb cipher, so the key schedule is built once and a
+        # whole batch goes through a single aes call per block position
+        self.ecb = AES.new(self.key, AES.MODE_ECB)
 
     def encrypt(self, value: str):
-        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-        encrypted = cipher.encrypt(pad(value.encode(), AES.block_size))
-        return encrypted.hex()
+        return self.encrypt_many([value])[0]
 
     def decrypt(self, value: str):
-        cipher = AES.new(self.key, AES.MODE_CBC, self.iv)
-        decrypted = unpad(cipher.decrypt(bytes.fromhex(value)), AES.block_size)
-        return decrypted.decode()
+        return self.decrypt_many([value])[0]
+
+    # keyed hmac of the plain value, deterministic so it can be indexed and looked up, unlike the
+    # ciphertext
+    def blind_index(self, value: str):
+        return hmac.new(self.index_key, value.encode(), sha256).hexdigest()
+
+    def encrypt_many(self, values):
+        padded = [pad(value.encode(), BLOCK) if value is not None else None for value in values]
+        chains = [[get_random_bytes(BLOCK)] if data is not None else None for data in padded]
+
+        # block k of every value depends on block k-1 of the same value only, so all values advance
+        # one block per aes call
+        rounds = max((len(data) // BLOCK for data in padded if data is not None), default=0)
+        for r in range(rounds):
+            active = [i for i, data in enumerate(padded) if data is not None and len(data) > r * BLOCK]
+            blob = b"".join(_xor(padded[i][r * BLOCK:(r + 1) * BLOCK], chains[i][-1]) for i in active)
+            encrypted = self.ecb.encrypt(blob)
+            for j, i in enumerate(active):
+                chains[i].append(encrypted[j * BLOCK:(j + 1) * BLOCK])
+
+        return [VERSION_PREFIX + b"".join(chain).hex() if chain is not None else None for chain in chains]
+
+    def decrypt_many(self, values):
+        # lay every value out as iv + ciphertext back to back and decrypt the lot in one call,
+        # plain block k is then D(C[k]) xor C[k-1] across the whole buffer
+        segments, parts, offset = [], [], 0
+        for value in values:
+            if value is None:
+                segments.append(None)
+                continue
+            if value.startswith(VERSION_PREFIX):
+                raw = bytes.fromhex(value[len(VERSION_PREFIX):])
+            else:
+                raw = self.iv + bytes.fromhex(value)
+            parts.append(raw)
+            segments.append((offset, offset + len(raw)))
+            offset += len(raw)
+
+        if not parts:
+            return [None] * len(values)
+        blob = b"".join(parts)
+        plain = _xor(self.ecb.decrypt(blob), bytes(BLOCK) + blob[:-BLOCK])
+
+        decrypted = []
+        for segment in segments:
+            if segment is None:
+                decrypted.append(None)
+            else:
+                start, end = segment
+                decrypted.append(unpad(plain[start + BLOCK:end], BLOCK).decode())
+        return decrypted
@@ -1,31 +1,177 @@
-import smtplib
+from django.conf import settings
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from dotenv import load_dotenv
+from .logger import log, Level
+import atexit
 import os
+import smtplib
+import threading
+import time
 
-def send_email(subject, body, to_email):
-    smtp_host = "smtp.gmail.com"
-    smtp_port = 587  # Note: 465 for SSL, 587 for TLS( updated version of SSL )
-    sender_email = os.getenv("SENDER_EMAIL")
-    sender_password = os.getenv("SENDER_PASSWORD")
+load_dotenv()
+
+EMAIL_HOST = getattr(settings, 'EMAIL_HOST', 'smtp.gmail.com')
+EMAIL_PORT = getattr(settings, 'EMAIL_PORT', 587)  # Note: 465 for SSL, 587 for TLS( updated version of SSL )
+EMAIL_USE_TLS = getattr(settings, 'EMAIL_USE_TLS', True)
+EMAIL_TIMEOUT = getattr(settings, 'EMAIL_TIMEOUT', None) or 30
+# servers drop idle sessions and cap messages per session, start a fresh one before either bites
+EMAIL_IDLE_TIMEOUT = getattr(settings, 'EMAIL_IDLE_TIMEOUT', 60)
+EMAIL_MAX_PER_CONNECTION = getattr(settings, 'EMAIL_MAX_PER_CONNECTION', 100)
 
+def build_message(sender, subject, body, to_email):
     msg = MIMEMultipart()
-    msg["From"] = sender_email
+    msg["From"] = sender
     msg["To"] = to_email
     msg["Subject"] = subject
 
     # attach the email body to the message
     msg.attach(MIMEText(body, "plain"))
+    return msg
 
-    try:
-        server = smtplib.SMTP(smtp_host, smtp_port)
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, to_email, msg.as_string())
-        server.quit()
-        print("Email sent successfully!")
-    except Exception as e:
-        print(f"Error sending email: {e}")
+# errors worth trying again later( 4xx, dropped connections ), a 5xx or a bad address won't get
+# better on its own
+def _is_transient(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    if isinstance(error, smtplib.SMTPException):
+        return False
+    # socket level, refused/reset/timed out
+    return isinstance(error, OSError)
 
-load_dotenv()
+# the server answered and the session is still usable after these
+def _session_intact(error):
+    return isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException)) \
+        and not isinstance(error, smtplib.SMTPConnectError)
+
+# one authenticated smtp session per worker process, reused across messages and tasks instead of a
+# connect + starttls + login per email. the session is reopened when it has been idle too long, has
+# sent EMAIL_MAX_PER_CONNECTION messages or the server dropped it
+class SMTPTransport:
+    def __init__(self, host=EMAIL_HOST, port=EMAIL_PORT, username=None, password=None, use_tls=EMAIL_USE_TLS,
+                 timeout=EMAIL_TIMEOUT, idle_timeout=EMAIL_IDLE_TIMEOUT, max_per_connection=EMAIL_MAX_PER_CONNECTION):
+        self.host, self.port = host, port
+        self.username, self.password = username, password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_per_connection = max_per_connection
+        self.sender = username or getattr(settings, 'DEFAULT_FROM_EMAIL', None)
+        self._lock = threading.RLock()
+        self._server = None
+        self._sent = 0
+        self._used_at = 0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_tls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self._server, self._sent, self._used_at = server, 0, time.monotonic()
+
+    def _ensure_connected(self):
+        stale = self._server is not None and (
+            self._sent >= self.max_per_connection or time.monotonic() - self._used_at > self.idle_timeout
+        )
+        if stale:
+            self.close()
+        if self._server is None:
+            self._connect()
+
+    def close(self):
+        with self._lock:
+            if self._server is None:
+                return
+            try:
+                self._server.quit()
+            except Exception:
+                self._server.close()
+            self._server = None
+
+    def _send(self, message):
+        msg = build_message(self.sender, message["subject"], message["body"], message["to"])
+        # a dropped session shows up on the next command, reconnect once and send again
+        for attempt in range(2):
+            self._ensure_connected()
+            try:
+                refused = self._server.sendmail(self.sender, [message["to"]], msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # close the old socket too, the server may have only half closed it
+                self._drop()
+                if attempt:
+                    raise
+                continue
+            self._sent += 1
+            self._used_at = time.monotonic()
+            return refused
+
+    # sends every message over the shared session and reports each one on its own, a failed
+    # message doesn't stop the rest. messages are {"subject", "body", "to"} dicts
+    def send_many(self, messages):
+        results, broken = [], None
+        with self._lock:
+            for message in messages:
+                if broken is not None:
+                    # the server is unreachable even after a reconnect, don't wait on it once per message
+                    results.append({"to": message["to"], "status": "failed", "error": str(broken), "retry": _is_transient(broken)})
+                    continue
+                try:
+                    refused = self._send(message)
+                    if refused:
+                        raise smtplib.SMTPRecipientsRefused(refused)
+                    results.append({"to": message["to"], "status": "sent"})
+                except Exception as e:
+                    if isinstance(e, OSError) and not _session_intact(e):
+                        # the socket is in an unknown state, don't reuse it
+                        self._drop()
+                        broken = e
+                    results.append({"to": message["to"], "status": "failed", "error": str(e), "retry": _is_transient(e)})
+        return results
+
+    def send(self, message):
+        return self.send_many([message])[0]
+
+    def _drop(self):
+        if self._server is not None:
+            try:
+                self._server.close()
+            except Exception:
+                pass
+            self._server = None
+
+_transport = None
+_transport_pid = None
+_transport_lock = threading.Lock()
+
+# the transport of this process, a forked worker builds its own instead of sharing the parent's socket
+def get_transport():
+    global _transport, _transport_pid
+    if _transport_pid != os.getpid():
+        with _transport_lock:
+            if _transport_pid != os.getpid():
+                _transport = SMTPTransport(username=os.getenv("SENDER_EMAIL"), password=os.getenv("SENDER_PASSWORD"))
+                _transport_pid = os.getpid()
+    return _transport
+
+def _close_transport():
+    if _transport is not None and _transport_pid == os.getpid():
+        _transport.close()
+
+atexit.register(_close_transport)
+
+def send_email(subject, body, to_email):
+    result = get_transport().send({"subject": subject, "body": body, "to": to_email})
+    if result["status"] == "sent":
+        log(Level.INFO, f"Email sent to {to_email}")
+    else:
+        log(Level.ERROR, f"Error sending email to {to_email}: {result['error']}")
+    return result
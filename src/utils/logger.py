@@ -1,65 +1,161 @@
 import os
-import inspect
+import sys
+import json
+import queue
+import atexit
+import logging
+import threading
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from . import context
 
 class LogLevel:
     DEBUG = "DEBUG"
     INFO = "INFO"
     WARNING = "WARNING"
-    ERROR = "ERROR" 
+    ERROR = "ERROR"
     CRITICAL = "CRITICAL"
 
 
-LOG_DIR = "logs"
-LOG_FILE = os.path.join(LOG_DIR, f"app_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log")
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
+LOG_TO_CONSOLE = os.getenv("LOG_TO_CONSOLE", "1") == "1"
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 100 * 1024 * 1024))
+LOG_BUFFER_LINES = 256
+LOG_FLUSH_INTERVAL = 1.0
 
-# Ensure log directory exists
-os.makedirs(LOG_DIR, exist_ok=True)
+_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR,
+    "CRITICAL": logging.CRITICAL,
+}
+_threshold = _LEVELS.get(LOG_LEVEL, logging.DEBUG)
 
-def log(level, message):
-    # get the frame of the caller
-    frame = inspect.currentframe().f_back
-    
-    file_name = frame.f_code.co_filename  # get file name of where called
-    line_number = frame.f_lineno         # line number
-    function_name = frame.f_code.co_name # name of calling function
-
-    # check if called from class method
-    class_name = None
-    for cls in inspect.getouterframes(frame):
-        if cls.function != '<module>':
-            # if frame is not of type module( function ) and has self, then it is a class method
-            if 'self' in frame.f_locals:
-                class_name = frame.f_locals['self'].__class__.__name__
-            break
-
-    now = datetime.now()
-    formatted_time = now.strftime("%Y-%m-%d %H:%M:%S")
-
-    # build context string, basically the log
-    context = f"{file_name}:{line_number}"
-    if class_name:
-        context += f" {class_name}.{function_name}"
-    else:
-        context += f" {function_name}"
-
-    # build the log message
-    log_message = f"[{formatted_time}] [{level.upper()}] [{context}] {message}"
-    with open(LOG_FILE, 'a') as f:
-        f.write(log_message + '\n')
-
-    print(log_message)
+# json lines in logs/app-YYYYMMDD.jsonl, shared by every worker. each flush is a single O_APPEND
+# write so lines from different processes never interleave, and the date in the name rotates the
+# file without anyone having to rename it( a day's file that grows past LOG_MAX_BYTES continues in
+# app-YYYYMMDD.1.jsonl and so on )
+class JsonLinesHandler(logging.Handler):
+    def __init__(self, directory=LOG_DIR, max_bytes=LOG_MAX_BYTES, buffer_lines=LOG_BUFFER_LINES):
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.buffer_lines = buffer_lines
+        self.buffer = []
+        self.fd = None
+        self.day = None
+        self.part = 0
 
-Level = LogLevel()
+    def _path(self):
+        suffix = f".{self.part}" if self.part else ""
+        return os.path.join(self.directory, f"app-{self.day}{suffix}.jsonl")
+
+    def _open(self):
+        day = datetime.now().strftime("%Y%m%d")
+        if self.fd is not None and day == self.day and os.fstat(self.fd).st_size < self.max_bytes:
+            return
+        if self.fd is not None:
+            os.close(self.fd)
+        if day != self.day:
+            self.day, self.part = day, 0
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            self.fd = os.open(self._path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if os.fstat(self.fd).st_size < self.max_bytes:
+                return
+            os.close(self.fd)
+            self.part += 1
+
+    def emit(self, record):
+        self.buffer.append(json.dumps({
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "file": record.pathname,
+            "line": record.lineno,
+            "func": record.funcName,
+            "pid": record.process,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }, default=str) + "\n")
+        if len(self.buffer) >= self.buffer_lines or record.levelno >= logging.ERROR:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, []
+        try:
+            self._open()
+            os.write(self.fd, "".join(lines).encode())
+        except OSError:
+            self.handleError(None)
+
+    def close(self):
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        super().close()
+
+# flushes the handlers whenever the queue has been idle for LOG_FLUSH_INTERVAL
+class _Listener(QueueListener):
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
 
-# class ExampleClass:
-#     def example_method(self):
-#         log("info", "This is a log message from inside a method.")
+_logger = logging.getLogger("hms")
+_logger.setLevel(_threshold)
+_logger.propagate = False
+_listener = None
 
-# def example_function():
-#     log("debug", "This is a log message from inside a function.")
+def _start():
+    global _listener
+    handlers = [JsonLinesHandler()]
+    if LOG_TO_CONSOLE:
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter(
+            "[%(asctime)s] [%(levelname)s] [%(pathname)s:%(lineno)d %(funcName)s] %(message)s", "%Y-%m-%d %H:%M:%S"
+        ))
+        handlers.append(console)
 
-# if __name__ == "__main__":
-#     example_function()
-#     example_instance = ExampleClass()
-#     example_instance.example_method()
+    log_queue = queue.SimpleQueue()
+    _logger.handlers = [QueueHandler(log_queue)]
+    _listener = _Listener(log_queue, *handlers)
+    _listener.start()
+
+def _stop():
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+
+_start()
+atexit.register(_stop)
+# the listener thread doesn't survive a fork( gunicorn --preload, celery prefork ), start a new one
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_start)
+
+def log(level, message):
+    levelno = _LEVELS.get(level) or _LEVELS.get(str(level).upper(), logging.INFO)
+    # drop filtered levels before touching the stack or formatting anything
+    if levelno < _threshold:
+        return
+
+    # only the caller's frame, co_qualname already reads "Class.method" for methods
+    frame = sys._getframe(1)
+    code = frame.f_code
+    record = _logger.makeRecord(
+        _logger.name, levelno, code.co_filename, frame.f_lineno, message, None, None,
+        getattr(code, "co_qualname", code.co_name),
+    )
+    # the listener thread formats the record, take the request id while still in the caller's context
+    record.request_id = context.get().get("request_id")
+    _logger.handle(record)
+
+Level = LogLevel()
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand, CommandError
+from utils.emailer import SMTPTransport
+import os
+import socket
+import time
+
+# the old path opened a connection( + starttls + login ) per message, the pooled one sends batches
+# over one session. without --host a local aiosmtpd server stands in for the real one
+class Command(BaseCommand):
+    help = "Reports messages/second of one-connection-per-message delivery against the pooled SMTP transport"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500)
+        parser.add_argument('--batch', type=int, default=100, help='messages per send_many call')
+        parser.add_argument('--host', help='smtp server to use instead of a local stand-in')
+        parser.add_argument('--port', type=int, default=587)
+        parser.add_argument('--tls', action='store_true', help='STARTTLS( only with --host )')
+        parser.add_argument('--login', action='store_true', help='log in with SENDER_EMAIL / SENDER_PASSWORD')
+        parser.add_argument('--to', default='benchmark@example.com')
+
+    def handle(self, *args, **options):
+        controller = None
+        if options['host']:
+            host, port = options['host'], options['port']
+        else:
+            try:
+                from aiosmtpd.controller import Controller
+                from aiosmtpd.handlers import Sink
+            except ImportError:
+                raise CommandError("pip install aiosmtpd or pass --host")
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                host, port = s.getsockname()
+            controller = Controller(Sink(), hostname=host, port=port)
+            controller.start()
+
+        credentials = {}
+        if options['login']:
+            credentials = {"username": os.getenv("SENDER_EMAIL"), "password": os.getenv("SENDER_PASSWORD")}
+        make_transport = lambda: SMTPTransport(host=host, port=port, use_tls=options['tls'] and bool(options['host']), **credentials)
+        messages = [
+            {"subject": f"benchmark {i}", "body": "hello from benchmark_email", "to": options['to']}
+            for i in range(options['messages'])
+        ]
+
+        try:
+            start = time.perf_counter()
+            single_failed = 0
+            for message in messages:
+                transport = make_transport()
+                single_failed += transport.send(message)["status"] != "sent"
+                transport.close()
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            transport = make_transport()
+            pooled_failed = 0
+            for i in range(0, len(messages), options['batch']):
+                pooled_failed += sum(r["status"] != "sent" for r in transport.send_many(messages[i:i + options['batch']]))
+            transport.close()
+            pooled = time.perf_counter() - start
+        finally:
+            if controller is not None:
+                controller.stop()
+
+        count = len(messages)
+        self.stdout.write(f"connection per message: {count / single:10.0f} msg/s  ({single_failed} failed)")
+        self.stdout.write(f"pooled session:         {count / pooled:10.0f} msg/s  ({pooled_failed} failed)")
+        self.stdout.write(f"speedup:                {single / pooled:10.1f}x")
@@ -0,0 +1,178 @@
+from django.core.management.base import BaseCommand
+from hospital.models import Hospital, Department, HospitalDepartment
+from doctor.models import Doctor
+from patient.models import Patient, Visit, refresh_current_visit, VISIT_FILTER_INDEXES
+from patient.views import filter_visits, visit_list_queryset
+from datetime import timedelta
+from django.utils import timezone
+from utils.crypto import CryptUtils
+from utils.cache import invalidate_model
+import json
+import os
+import random
+import time
+
+BATCH = 10000
+
+# plan fragments that mean the table is read front to back
+FULL_SCAN_MARKERS = ("type: all", "'type': 'all'", "seq scan", "full table scan")
+
+def is_full_scan(plan):
+    plan = plan.lower()
+    if any(marker in plan for marker in FULL_SCAN_MARKERS):
+        return True
+    # sqlite says "SCAN <table>" for a table scan and "SCAN <table> USING INDEX" for an index scan
+    return any(line.strip().lstrip("-|` ").startswith("scan") and "using" not in line for line in plan.splitlines())
+
+class Command(BaseCommand):
+    help = "Seeds hospitals, doctors, patients and visits and reports time and query plan of the hot lookups"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', action='store_true', help='insert the synthetic rows before measuring')
+        parser.add_argument('--hospitals', type=int, default=200)
+        parser.add_argument('--departments', type=int, default=30)
+        parser.add_argument('--doctors', type=int, default=5000)
+        parser.add_argument('--patients', type=int, default=100000)
+        parser.add_argument('--visits', type=int, default=1000000)
+        parser.add_argument('--repeat', type=int, default=50, help='runs per lookup')
+        parser.add_argument('--output', help='write the results to this json file, e.g. before.json')
+        parser.add_argument('--compare', help='json file of an earlier run( e.g. on the old schema ) to compare against')
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.seed(options)
+
+        results = {}
+        for name, build in self.lookups().items():
+            results[name] = self.measure(build, options['repeat'])
+            result = results[name]
+            self.stdout.write(
+                f"{name:<28} avg {result['avg_ms']:8.3f} ms  p95 {result['p95_ms']:8.3f} ms  "
+                f"{'FULL SCAN' if result['full_scan'] else 'index'}"
+            )
+            self.stdout.write("    " + result['plan'].replace("\n", "\n    "))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def seed(self, options):
+        cu = CryptUtils(os.getenv('DJANGO_SECRET_KEY'))
+        run = int(time.time())
+        self.stdout.write("seeding...")
+
+        Hospital.objects.bulk_create(
+            [Hospital(name=f"bench-{run}-hospital-{i}", addr="bench") for i in range(options['hospitals'])], batch_size=BATCH)
+        Department.objects.bulk_create(
+            [Department(name=f"bench-{run}-department-{i}") for i in range(options['departments'])], batch_size=BATCH)
+        hospitals = list(Hospital.objects.filter(name__startswith=f"bench-{run}-").values_list('id', flat=True))
+        departments = list(Department.objects.filter(name__startswith=f"bench-{run}-").values_list('id', flat=True))
+        HospitalDepartment.objects.bulk_create(
+            [HospitalDepartment(hospital_id=h, department_id=d) for h in hospitals for d in departments],
+            batch_size=BATCH, ignore_conflicts=True)
+
+        Doctor.objects.bulk_create([
+            Doctor(name=f"bench-{run}-doctor-{i}", hospital_id=random.choice(hospitals), department_id=random.choice(departments))
+            for i in range(options['doctors'])
+        ], batch_size=BATCH)
+        doctors = list(Doctor.objects.filter(name__startswith=f"bench-{run}-").values_list('id', 'hospital_id', 'department_id'))
+
+        for start in range(0, options['patients'], BATCH):
+            Patient.objects.bulk_create([
+                Patient(
+                    name=f"bench-{run}-patient-{i}", addr="bench", email=f"bench-{run}-{i}@example.com",
+                    phone=cu.encrypt(f"{run}{i:09d}"), phone_index=cu.blind_index(f"{run}{i:09d}"),
+                )
+                for i in range(start, min(start + BATCH, options['patients']))
+            ])
+        patients = list(Patient.objects.filter(name__startswith=f"bench-{run}-").values_list('id', flat=True))
+
+        for start in range(0, options['visits'], BATCH):
+            visits = []
+            for i in range(start, min(start + BATCH, options['visits'])):
+                doctor, hospital, department = random.choice(doctors)
+                visits.append(Visit(
+                    patient_id=random.choice(patients), doctor_id=doctor, hospital_id=hospital, department_id=department,
+                    status=Visit.Status.DISCHARGED,
+                ))
+            Visit.objects.bulk_create(visits)
+            self.stdout.write(f"  visits {min(start + BATCH, options['visits'])}/{options['visits']}")
+        # bulk_create skipped Visit.save, point the patients at their latest visit
+        for start in range(0, len(patients), BATCH):
+            refresh_current_visit(patients[start:start + BATCH])
+
+        # bulk_create skipped the signals, drop whatever the api has cached for these tables
+        for model in (Hospital, Department, HospitalDepartment, Doctor, Patient, Visit):
+            invalidate_model(model)
+
+    # each lookup builds its queryset from a sample row, the same way the views do
+    def lookups(self):
+        cu = CryptUtils(os.getenv('DJANGO_SECRET_KEY'))
+        hospital = Hospital.objects.order_by('?').values_list('name', flat=True).first()
+        department = Department.objects.order_by('?').values_list('name', flat=True).first()
+        doctor = Doctor.objects.order_by('-id').values_list('name', flat=True).first()
+        patient = Patient.objects.order_by('-id').values('id', 'name', 'email', 'phone').first() or {}
+        phone = cu.decrypt(patient['phone']) if patient.get('phone') else None
+
+        lookups = {
+            "hospital.name": lambda: Hospital.objects.filter(name=hospital),
+            "department.name": lambda: Department.objects.filter(name=department),
+            "doctor.name": lambda: Doctor.objects.filter(name=doctor),
+            "patient.name": lambda: Patient.objects.filter(name=patient.get('name')),
+            "patient.email": lambda: Patient.objects.filter(email=patient.get('email')),
+            "patient.phone_index": lambda: Patient.objects.filter(phone_index=cu.blind_index(phone or "")),
+            "visit(patient, timestamp)": lambda: Visit.objects.filter(patient_id=patient.get('id')).order_by('-timestamp')[:1],
+            "patient.current_visit": lambda: Patient.objects.filter(pk=patient.get('id')).select_related('current_visit'),
+        }
+        lookups.update(self.visit_filters(patient.get('id')))
+        return lookups
+
+    # the first page of GET /visits for every filter combination it takes, newest first over the last
+    # week. at --visits 10000000 each one should still be a range scan on its VISIT_FILTER_INDEXES index
+    def visit_filters(self, patient_id):
+        sample = Visit.objects.filter(patient_id=patient_id).values('hospital_id', 'department_id', 'doctor_id').first() or {}
+        values = {
+            "status": Visit.Status.DISCHARGED, "hospital": sample.get('hospital_id'), "department": sample.get('department_id'),
+            "doctor": sample.get('doctor_id'), "patient": patient_id,
+        }
+        since = (timezone.now() - timedelta(days=7)).isoformat()
+
+        def build(params):
+            queryset, keys = filter_visits(visit_list_queryset(), params)
+            return lambda: queryset.order_by(*keys)[:100]
+
+        return {
+            f"visits?{'&'.join(sorted(combination)) or 'from'}": build({
+                **{name: str(values[name] or 0) for name in combination}, "from": since, "ordering": "-timestamp",
+            })
+            for combination in VISIT_FILTER_INDEXES
+        }
+
+    def measure(self, build, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(build())
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        plan = build().explain()
+        return {
+            "avg_ms": sum(timings) / len(timings),
+            "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            "plan": plan,
+            "full_scan": is_full_scan(plan),
+        }
+
+    def compare(self, path, results):
+        with open(path) as f:
+            before = json.load(f)
+        self.stdout.write(f"\n{'lookup':<28} {'before':>12} {'after':>12} {'speedup':>9}  plan")
+        for name, after in results.items():
+            if name not in before:
+                continue
+            old = before[name]
+            speedup = old['avg_ms'] / after['avg_ms'] if after['avg_ms'] else float('inf')
+            plan = f"{'FULL SCAN' if old['full_scan'] else 'index'} -> {'FULL SCAN' if after['full_scan'] else 'index'}"
+            self.stdout.write(f"{name:<28} {old['avg_ms']:10.3f}ms {after['avg_ms']:10.3f}ms {speedup:8.1f}x  {plan}")
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.renderers import JSONRenderer
+from hospital.models import Hospital, Department
+from hospital.serializer import HospitalSerializer, DepartmentSerializer, hospital_projection, department_projection
+from doctor.models import Doctor
+from doctor.serializer import DoctorSerializer, doctor_projection
+from patient.models import Patient
+from patient.serializer import PatientSerializer, patient_projection
+import time
+
+# compares the drf serializers with the values_list projections the list endpoints use, on the
+# rows already in the database( seed some with benchmark_lookups --seed )
+class Command(BaseCommand):
+    help = "Reports rows/second of the DRF list serializers against the fast read-path projections"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000, help='rows per model')
+        parser.add_argument('--repeat', type=int, default=3, help='runs per path, the best one is reported')
+
+    def handle(self, *args, **options):
+        targets = {
+            "patient": (Patient, PatientSerializer, patient_projection),
+            "doctor": (Doctor, DoctorSerializer, doctor_projection),
+            "hospital": (Hospital, HospitalSerializer, hospital_projection),
+            "department": (Department, DepartmentSerializer, department_projection),
+        }
+        renderer = JSONRenderer()
+
+        self.stdout.write(f"{'model':<12} {'rows':>8} {'drf rows/s':>12} {'fast rows/s':>12} {'speedup':>9}")
+        for name, (model, serializer_class, projection) in targets.items():
+            queryset = model.objects.order_by('id')[:options['rows']]
+
+            drf = lambda: renderer.render(serializer_class(list(queryset), many=True).data)
+            fast = lambda: renderer.render(projection.serialize(projection.queryset(queryset)))
+
+            drf_time, drf_body = self.measure(drf, options['repeat'])
+            fast_time, fast_body = self.measure(fast, options['repeat'])
+            if drf_body != fast_body:
+                raise CommandError(f"{name}: the projection output differs from {serializer_class.__name__}")
+
+            rows = queryset.count()
+            self.stdout.write(
+                f"{name:<12} {rows:>8} {rows / drf_time:>12.0f} {rows / fast_time:>12.0f} {drf_time / fast_time:>8.1f}x"
+            )
+
+    def measure(self, run, repeat):
+        best, body = None, None
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            body = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, body
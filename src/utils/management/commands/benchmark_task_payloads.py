@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from kombu import Connection
+from kombu.serialization import dumps
+from hms.celery import app
+from hospital.models import Hospital, Department, HospitalDepartment
+from doctor.tasks import create_object_task, create_objects_task
+import time
+
+# message size and enqueue latency of create_object_task the old way( pickled model instances ),
+# with ids as json, and as one create_objects_task message for all rows. messages go to a scratch
+# queue on --broker( memory:// by default, pass the redis url to include the network ) and are
+# purged afterwards, no worker runs them
+class Command(BaseCommand):
+    help = "Compares broker message size and enqueue latency of pickled-instance and id-based task payloads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000)
+        parser.add_argument('--broker', default='memory://')
+        parser.add_argument('--queue', default='benchmark_task_payloads')
+
+    def handle(self, *args, **options):
+        pair = HospitalDepartment.objects.select_related('hospital', 'department').first()
+        if pair is None:
+            raise CommandError("needs at least one linked hospital and department( benchmark_lookups --seed )")
+        hospital, department = pair.hospital, pair.department
+        count = options['messages']
+
+        variants = {
+            "pickle, instances": (create_object_task, [(f"bench-{i}", hospital, department) for i in range(count)], 'pickle'),
+            "json, ids": (create_object_task, [(f"bench-{i}", hospital.id, department.id) for i in range(count)], 'json'),
+            "json, bulk ids": (create_objects_task, [([[f"bench-{i}", hospital.id, department.id] for i in range(count)],)], 'json'),
+        }
+
+        self.stdout.write(f"{'payload':<20} {'messages':>8} {'bytes/msg':>10} {'total KB':>10} {'enqueue ms':>11} {'us/doctor':>10}")
+        with Connection(options['broker']) as connection:
+            producer = connection.Producer()
+            for name, (task, arguments, serializer) in variants.items():
+                size = sum(len(dumps((args, {}, {}), serializer=serializer)[2]) for args in arguments)
+
+                start = time.perf_counter()
+                for args in arguments:
+                    # straight to the broker, task_always_eager would run it in place otherwise
+                    app.send_task(task.name, args=args, serializer=serializer, queue=options['queue'], producer=producer, ignore_result=True)
+                elapsed = time.perf_counter() - start
+
+                self.stdout.write(
+                    f"{name:<20} {len(arguments):>8} {size / len(arguments):>10.0f} {size / 1024:>10.1f} "
+                    f"{elapsed * 1000:>11.1f} {elapsed * 1e6 / count:>10.1f}"
+                )
+            connection.default_channel.queue_purge(options['queue'])
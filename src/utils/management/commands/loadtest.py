@@ -0,0 +1,128 @@
+from django.core.management.base import BaseCommand, CommandError
+from urllib.parse import urlsplit
+import asyncio
+import json
+import time
+
+# closed-loop http load against a running server, --concurrency clients on keep-alive connections
+# each send their next request as soon as the last one is answered. to compare the deployments:
+#
+#   gunicorn hms.wsgi -w 4                                    # sync workers
+#   gunicorn hms.asgi -w 4 -k uvicorn.workers.UvicornWorker   # asgi
+#   python manage.py loadtest /hospital/1 /async/hospital/1 --username admin --password ...
+#
+# run it once against each, the sync paths measure the old endpoints and /async/ the new ones
+class Command(BaseCommand):
+    help = "Reports requests/second and latency percentiles of endpoints on a running server"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--concurrency', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=5000, help='per path')
+        parser.add_argument('--warmup', type=int, default=100, help='requests per path before measuring')
+        parser.add_argument('--token', help='jwt access token')
+        parser.add_argument('--username', help='get a token from /token/ instead of --token')
+        parser.add_argument('--password')
+
+    def handle(self, *args, **options):
+        url = urlsplit(options['url'])
+        if url.scheme != 'http':
+            raise CommandError("only plain http is supported, put the load test next to the server")
+        self.host, self.port = url.hostname, url.port or 80
+        asyncio.run(self.run(options))
+
+    async def run(self, options):
+        token = options['token']
+        if options['username']:
+            status, body = await self.request_once('POST', '/token/', {
+                "username": options['username'], "password": options['password'],
+            })
+            if status != 200:
+                raise CommandError(f"/token/ answered {status}: {body[:200]!r}")
+            token = json.loads(body)["access"]
+        headers = f"Authorization: Bearer {token}\r\n" if token else ""
+
+        self.stdout.write(
+            f"{'path':<32} {'requests':>8} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        )
+        for path in options['paths']:
+            request = f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\n{headers}\r\n".encode()
+            await self.load(request, options['warmup'], options['concurrency'])
+            latencies, errors, elapsed = await self.load(request, options['requests'], options['concurrency'])
+            latencies.sort()
+            pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+            self.stdout.write(
+                f"{path:<32} {len(latencies):>8} {errors:>6} {len(latencies) / elapsed:>9.0f} "
+                f"{pct(0.5):>8.1f} {pct(0.9):>8.1f} {pct(0.99):>8.1f} {pct(1):>8.1f}"
+            )
+
+    async def load(self, request, total, concurrency):
+        latencies, errors = [], 0
+        remaining = total
+
+        async def client():
+            nonlocal remaining, errors
+            connection = None
+            while remaining > 0:
+                remaining -= 1
+                start = time.perf_counter()
+                try:
+                    if connection is None:
+                        connection = await asyncio.open_connection(self.host, self.port)
+                    status, _, keep_alive = await self.exchange(*connection, request)
+                except (OSError, asyncio.IncompleteReadError, ValueError):
+                    errors += 1
+                    connection = self.close(connection)
+                    continue
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+                if not keep_alive:
+                    connection = self.close(connection)
+            self.close(connection)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(max(1, min(concurrency, total)))))
+        return latencies, errors, time.perf_counter() - start
+
+    # one request/response on an open connection -> (status, body, keep_alive)
+    async def exchange(self, reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("server closed the connection")
+        status = int(status_line.split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while size := int((await reader.readline()).split(b';')[0], 16):
+                body += await reader.readexactly(size)
+                await reader.readline()
+            await reader.readline()
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, body, headers.get('connection', '').lower() != 'close'
+
+    async def request_once(self, method, path, data):
+        payload = json.dumps(data).encode()
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            status, body, _ = await self.exchange(reader, writer, (
+                f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n"
+            ).encode() + payload)
+        finally:
+            self.close((reader, writer))
+        return status, body
+
+    def close(self, connection):
+        if connection is not None:
+            connection[1].close()
+        return None
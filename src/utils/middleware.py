@@ -1,33 +1,95 @@
-from django.utils.deprecation import MiddlewareMixin
-from rest_framework_simplejwt.authentication import JWTAuthentication
-import threading
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .authentication import CachedJWTAuthentication
+from . import context
+import re
+
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+# both middlewares run natively in sync and async mode, under asgi a sync-only middleware would put
+# every request through a thread even when the view is async
+
+def client_ip(request):
+    x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
+    return x_forwarded_for.split(',')[0] if x_forwarded_for else request.META.get('REMOTE_ADDR')
+
+class AuditLogMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.process_request(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        request.client_ip = client_ip(request)
+        request.jwt_user = None
+        try:
+            result = await CachedJWTAuthentication().aauthenticate(request)
+            if result:
+                request.jwt_user = result[0]
+        except Exception:
+            request.jwt_user = None
+        return await self.get_response(request)
 
-class AuditLogMiddleware(MiddlewareMixin):
     def process_request(self, request):
         # get ip addr
-        x_forwarded_for = request.META.get('HTTP_X_FORWARDED_FOR')
-        request.client_ip = x_forwarded_for.split(',')[0] if x_forwarded_for else request.META.get('REMOTE_ADDR')
-        
-        # extract user_id from jwt
+        request.client_ip = client_ip(request)
+
+        # extract user from jwt, the result is kept on the request for DRF's authentication
+        request.jwt_user = None
         try:
-            jwt_auth = JWTAuthentication()
-            header = jwt_auth.get_header(request)
-            if header:
-                raw_token = jwt_auth.get_raw_token(header)
-                if raw_token:
-                    validated_token = jwt_auth.get_validated_token(raw_token)
-                    request.jwt_user = jwt_auth.get_user(validated_token)
+            result = CachedJWTAuthentication().authenticate(request)
+            if result:
+                request.jwt_user = result[0]
         except Exception:
             request.jwt_user = None
 
+# binds the request context( utils/context.py ) for the rest of the request and echoes the request
+# id back. runs after AuditLogMiddleware, which resolves the client ip and the jwt user
 class RequestMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
-        
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def bind(self, request):
+        # a request id from the proxy in front is kept, as long as it looks like one
+        incoming = request.headers.get(context.REQUEST_ID_HEADER, '')
+        request.request_id = incoming if REQUEST_ID_PATTERN.fullmatch(incoming) else context.new_request_id()
+        return context.bind(
+            actor_id=getattr(getattr(request, 'jwt_user', None), 'id', None),
+            ip_address=getattr(request, 'client_ip', None) or client_ip(request),
+            request_id=request.request_id,
+        )
+
     def __call__(self, request):
-        # store request data in thread local storage, maybe can even use redis
-        threading.current_thread()._current_request = request
-        response = self.get_response(request)
-        # clean up
-        delattr(threading.current_thread(), '_current_request')
-        return response
\ No newline at end of file
+        if self.async_mode:
+            return self.__acall__(request)
+        token = self.bind(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            context.reset(token)
+        response[context.REQUEST_ID_HEADER] = request.request_id
+        return response
+
+    async def __acall__(self, request):
+        token = self.bind(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            context.reset(token)
+        response[context.REQUEST_ID_HEADER] = request.request_id
+        return response
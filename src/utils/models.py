@@ -1,5 +1,6 @@
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.auth.models import User
@@ -8,7 +9,8 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.auth.models import User
 
 class Log(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # default instead of auto_now_add so batched writes keep the time the action happened
+    timestamp = models.DateTimeField(default=timezone.now)
     actor = models.ForeignKey(
         User,
         null=True,
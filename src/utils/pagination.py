@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.utils.urls import replace_query_param
+from .cache import list_key, CACHE_TTL
+from .async_cache import acache, alist_key
+from datetime import date, datetime
+import base64
+import json
+
+PAGE_SIZE = getattr(settings, 'PAGE_SIZE', 100)
+MAX_PAGE_SIZE = getattr(settings, 'MAX_PAGE_SIZE', 1000)
+
+class InvalidCursor(ValueError):
+    pass
+
+# cursors are opaque to clients, just the sort key values of the last row of the previous page
+def encode_cursor(values):
+    raw = json.dumps([v.isoformat() if isinstance(v, (date, datetime)) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursor("Invalid cursor")
+    if not isinstance(values, list):
+        raise InvalidCursor("Invalid cursor")
+    return values
+
+# keyset pagination, every page is "rows after the last key seen" on an indexed ordering so deep
+# pages cost the same as the first one. keys are field names of model, '-' prefix for descending,
+# the last key has to be unique( usually id )
+class KeysetPaginator:
+    def __init__(self, request, model, keys=('id',), page_size=None):
+        self.request = request
+        self.model = model
+        self.keys = tuple(keys)
+        # a DRF request, or a plain django one in the async views
+        params = getattr(request, 'query_params', request.GET)
+        self.cursor = params.get('cursor') or None
+
+        try:
+            size = int(params.get('page_size', page_size or PAGE_SIZE))
+        except ValueError:
+            raise InvalidCursor("page_size must be an integer")
+        self.page_size = max(1, min(size, MAX_PAGE_SIZE))
+
+        self.after = self._convert(decode_cursor(self.cursor)) if self.cursor else None
+
+    # the cursor's values as the key fields take them, a cursor made up by the client( ["abc"] for
+    # an id ) is a 400 here instead of a 500 in the query
+    def _convert(self, values):
+        if len(values) != len(self.keys):
+            raise InvalidCursor("Invalid cursor")
+        converted = []
+        for key, value in zip(self.keys, values):
+            try:
+                if value is None:
+                    raise ValueError
+                converted.append(self.model._meta.get_field(key.lstrip('-')).to_python(value))
+            except (ValidationError, TypeError, ValueError):
+                raise InvalidCursor("Invalid cursor")
+        return converted
+
+    # the parts that identify a page in a cache key
+    def cache_parts(self):
+        return (self.page_size, self.cursor or "first")
+
+    def _after_filter(self):
+        # (a, b) > (x, y)  <=>  a > x OR (a = x AND b > y), plus a >= x so the planner sees a plain range
+        fields = [key.lstrip('-') for key in self.keys]
+        ops = ['lt' if key.startswith('-') else 'gt' for key in self.keys]
+
+        q, equal = Q(), {}
+        for field, op, value in zip(fields, ops, self.after):
+            q |= Q(**equal, **{f"{field}__{op}": value})
+            equal[field] = value
+        return Q(**{f"{fields[0]}__{ops[0]}e": self.after[0]}) & q
+
+    def paginate_queryset(self, queryset):
+        queryset = queryset.order_by(*self.keys)
+        if self.after is not None:
+            queryset = queryset.filter(self._after_filter())
+        # one extra row tells us whether there is a next page
+        return queryset[:self.page_size + 1]
+
+    def _key_values(self, row):
+        fields = [key.lstrip('-') for key in self.keys]
+        if isinstance(row, dict):
+            return [row[field] for field in fields]
+        return [getattr(row, field) for field in fields]
+
+    # trims the extra row off and returns (rows, next_cursor)
+    def get_page(self, rows):
+        rows = list(rows)
+        if len(rows) <= self.page_size:
+            return rows, None
+        rows = rows[:self.page_size]
+        return rows, encode_cursor(self._key_values(rows[-1]))
+
+    def get_headers(self, next_cursor):
+        if not next_cursor:
+            return {}
+        url = replace_query_param(self.request.build_absolute_uri(), 'cursor', next_cursor)
+        return {'X-Next-Cursor': next_cursor, 'Link': f'<{url}>; rel="next"'}
+
+# one page of a list endpoint, cached on its own under the model's list generation
+def cached_page(paginator, model, queryset, serialize):
+    key = list_key(model, *paginator.cache_parts())
+    cached_data = cache.get(key)
+    if cached_data is not None:
+        return cached_data["results"], cached_data["next"]
+    rows, next_cursor = paginator.get_page(paginator.paginate_queryset(queryset))
+    data = serialize(rows)
+    cache.set(key, {"results": data, "next": next_cursor}, timeout=CACHE_TTL)
+    return data, next_cursor
+
+# cached_page for async views, a cache hit never leaves the event loop. a miss still runs its query
+# in a thread, django's async orm doesn't have async database drivers yet
+async def acached_page(paginator, model, queryset, serialize):
+    key = await alist_key(model, *paginator.cache_parts())
+    cached_data = await acache.get(key)
+    if cached_data is not None:
+        return cached_data["results"], cached_data["next"]
+    rows, next_cursor = paginator.get_page([row async for row in paginator.paginate_queryset(queryset)])
+    data = serialize(rows)
+    await acache.set(key, {"results": data, "next": next_cursor}, timeout=CACHE_TTL)
+    return data, next_cursor
@@ -0,0 +1,92 @@
+from rest_framework import serializers
+import threading
+
+# drf fields whose to_representation returns what the database driver already gives us( str for a
+# CharField, int for an IntegerField, the id for a foreign key ), the value can go out as it is
+IDENTITY_FIELDS = (
+    serializers.CharField,
+    serializers.EmailField,
+    serializers.IntegerField,
+    serializers.BooleanField,
+)
+
+# read-only fast path for list endpoints. the serializer's fields are compiled once into a list of
+# (column, converter) pairs, rows come straight out of values_list() and are turned into dicts
+# column by column, no field objects or model instances per row. the output is the same as
+# Serializer(rows, many=True).data, anything the serializer can't be compiled for( nested
+# serializers, method fields, dotted sources ) raises TypeError at compile time
+#
+# transforms are per-column batch functions for what the serializer does in its own
+# to_representation, e.g. {'phone': cu.decrypt_many}. a serializer that overrides
+# to_representation has to name them, otherwise the fast path would quietly differ from it
+class Projection:
+    def __init__(self, serializer_class, transforms=None):
+        self.serializer_class = serializer_class
+        self.transforms = transforms or {}
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def _compile(self):
+        serializer_class = self.serializer_class
+        if serializer_class.to_representation is not serializers.ModelSerializer.to_representation and not self.transforms:
+            raise TypeError(f"{serializer_class.__name__} overrides to_representation, pass transforms for it")
+
+        model = serializer_class.Meta.model
+        names, columns, converters = [], [], []
+        for field in serializer_class().fields.values():
+            if field.write_only:
+                continue
+            source = field.source
+            if source == '*' or '.' in source or isinstance(field, (serializers.BaseSerializer, serializers.SerializerMethodField)):
+                raise TypeError(f"{serializer_class.__name__}.{field.field_name} can't be projected")
+            model_field = model._meta.get_field(source)
+
+            if field.field_name in self.transforms:
+                converter = None
+            elif isinstance(field, serializers.PrimaryKeyRelatedField) and field.pk_field is None:
+                converter = None # values_list gives the id, which is what the related field renders
+            elif type(field) in IDENTITY_FIELDS:
+                converter = None
+            else:
+                converter = field.to_representation
+
+            names.append(field.field_name)
+            # values_list(<fk name>) already returns the id
+            columns.append(model_field.name)
+            converters.append(converter)
+        return names, columns, converters
+
+    @property
+    def compiled(self):
+        if self._compiled is None:
+            with self._lock:
+                if self._compiled is None:
+                    self._compiled = self._compile()
+        return self._compiled
+
+    @property
+    def names(self):
+        return self.compiled[0]
+
+    @property
+    def columns(self):
+        return self.compiled[1]
+
+    # named rows so KeysetPaginator can still read the cursor keys off them
+    def queryset(self, queryset):
+        return queryset.values_list(*self.columns, named=True)
+
+    def serialize(self, rows):
+        names, _, converters = self.compiled
+        rows = list(rows)
+        if not rows:
+            return []
+
+        columns = [list(column) for column in zip(*rows)]
+        for i, (name, converter) in enumerate(zip(names, converters)):
+            if name in self.transforms:
+                columns[i] = self.transforms[name](columns[i])
+            elif converter is not None:
+                # drf renders a None attribute as None without asking the field
+                columns[i] = [None if value is None else converter(value) for value in columns[i]]
+        return [dict(zip(names, values)) for values in zip(*columns)]
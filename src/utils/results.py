@@ -0,0 +1,84 @@
+from asgiref.sync import sync_to_async
+from celery import current_app, states
+from django.conf import settings
+import asyncio
+import math
+import time
+
+MAX_TASK_IDS = getattr(settings, 'TASK_STATUS_MAX_IDS', 500)
+# the long wait is for /async/tasks/status, where a waiting request is only a coroutine. the sync
+# view holds a whole worker( thread ) while it waits and gets a much shorter one
+MAX_WAIT = getattr(settings, 'TASK_STATUS_MAX_WAIT', 30)
+SYNC_MAX_WAIT = getattr(settings, 'TASK_STATUS_SYNC_MAX_WAIT', 2)
+POLL_INTERVAL = getattr(settings, 'TASK_STATUS_POLL_INTERVAL', 0.5)
+
+def _backend():
+    return current_app.backend
+
+# the task metadata of many tasks at once. key-value result backends( redis, cache ) answer with a
+# single MGET, anything else falls back to one lookup per task
+def fetch_task_meta(task_ids, backend=None):
+    backend = backend or _backend()
+    missing = {"status": states.PENDING, "result": None}
+    try:
+        keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+        values = backend.mget(keys)
+    except (AttributeError, NotImplementedError):
+        return {task_id: backend.get_task_meta(task_id) for task_id in task_ids}
+
+    if hasattr(values, 'items'):
+        # the memcached client answers with a dict of the keys it found
+        values = [values.get(key) for key in keys]
+    return {
+        task_id: backend.decode_result(value) if value else dict(missing)
+        for task_id, value in zip(task_ids, values)
+    }
+
+# same wording as TaskView
+def describe(meta):
+    if meta["status"] == states.SUCCESS:
+        return {"status": "Completed", "state": meta["status"], "result": meta["result"]}
+    if meta["status"] in states.EXCEPTION_STATES:
+        return {"status": "Failed", "state": meta["status"]}
+    return {"status": "In Progress", "state": meta["status"]}
+
+def _deadline(wait, most):
+    # nan compares false with everything, the deadline would never pass
+    return time.monotonic() + (min(max(wait, 0), most) if math.isfinite(wait) else 0)
+
+def _changed(metas, seen):
+    return any(meta["status"] != seen[task_id] for task_id, meta in metas.items())
+
+# the states of the tasks, and with wait > 0 the request is held until one of them is in another
+# state than the client last saw( `seen`, task id -> state ) or than it was on the first fetch.
+# the backend is polled every POLL_INTERVAL with one MGET, instead of the client polling every task
+def task_statuses(task_ids, wait=0, seen=None, backend=None):
+    metas = fetch_task_meta(task_ids, backend)
+    baseline = {task_id: (seen or {}).get(task_id, meta["status"]) for task_id, meta in metas.items()}
+    deadline = _deadline(wait, SYNC_MAX_WAIT)
+
+    while not _changed(metas, baseline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(POLL_INTERVAL, remaining))
+        metas = fetch_task_meta(task_ids, backend)
+
+    return {task_id: describe(meta) for task_id, meta in metas.items()}
+
+# the same for the async view, waiting on the event loop. the backend client is sync, every fetch
+# runs in a thread of the default executor( not the one thread_sensitive calls queue for )
+async def atask_statuses(task_ids, wait=0, seen=None, backend=None):
+    fetch = sync_to_async(fetch_task_meta, thread_sensitive=False)
+    metas = await fetch(task_ids, backend)
+    baseline = {task_id: (seen or {}).get(task_id, meta["status"]) for task_id, meta in metas.items()}
+    deadline = _deadline(wait, MAX_WAIT)
+
+    while not _changed(metas, baseline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(POLL_INTERVAL, remaining))
+        metas = await fetch(task_ids, backend)
+
+    return {task_id: describe(meta) for task_id, meta in metas.items()}
@@ -0,0 +1,43 @@
+from django.contrib.auth.models import User, Group, Permission
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from .backends import local_permissions, invalidate_user_permissions, invalidate_all_permissions
+
+# keep the cached permission sets of utils.backends in step with group and permission changes
+
+def _invalidate_users(instance, pk_set):
+    if isinstance(instance, User):
+        invalidate_user_permissions(instance.pk)
+    elif pk_set:
+        for user_id in pk_set:
+            invalidate_user_permissions(user_id)
+    else:
+        # reverse clear( group.user_set.clear() ), the affected users are unknown
+        invalidate_all_permissions()
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, instance, action, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _invalidate_users(instance, pk_set)
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def user_permissions_changed(sender, instance, action, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _invalidate_users(instance, pk_set)
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate_all_permissions()
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_delete, sender=Group)
+def permissions_changed(sender, **kwargs):
+    invalidate_all_permissions()
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    # is_active/is_superuser live on the user, the generation bump is done by hms.signals already
+    local_permissions.delete(instance.pk)
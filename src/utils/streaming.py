@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from itertools import islice
+import json
+
+# rows fetched from the database and serialized per step of a streamed response
+STREAM_CHUNK_SIZE = getattr(settings, 'STREAM_CHUNK_SIZE', 2000)
+
+STREAM_FORMATS = {
+    '1': 'json', 'true': 'json', 'json': 'json',
+    'ndjson': 'ndjson', 'jsonl': 'ndjson',
+}
+CONTENT_TYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+# ?stream=1 / ?stream=json streams the whole list as one json array, ?stream=ndjson as one object
+# per line. None when the client didn't ask for a stream
+def stream_format(request):
+    return STREAM_FORMATS.get(request.query_params.get('stream', '').lower())
+
+# same settings JSONRenderer uses, so a streamed array is byte for byte the body the normal
+# response would have for the same rows
+_encoder = JSONEncoder(
+    ensure_ascii=not api_settings.UNICODE_JSON,
+    allow_nan=not api_settings.STRICT_JSON,
+    separators=(',', ':'),
+)
+
+def _dumps(item):
+    # JSONRenderer escapes these two as well, they are valid json but not valid javascript
+    return _encoder.encode(item).replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def _chunks(rows, serialize, fmt, chunk_size):
+    first = True
+    if fmt == 'json':
+        yield b'['
+    for batch in _batches(rows, chunk_size):
+        items = [_dumps(item) for item in serialize(batch)]
+        if not items:
+            continue
+        if fmt == 'json':
+            yield (('' if first else ',') + ','.join(items)).encode()
+        else:
+            yield ('\n'.join(items) + '\n').encode()
+        first = False
+    if fmt == 'json':
+        yield b']'
+
+# streams a queryset without holding it in memory, rows come off a server side cursor
+# chunk_size at a time and each chunk is serialized, encoded and sent before the next is read.
+# serialize turns a list of rows into a list of dicts( e.g. a Projection's serialize )
+def stream_response(queryset, serialize, fmt='json', chunk_size=None):
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    rows = queryset.iterator(chunk_size=chunk_size)
+    return StreamingHttpResponse(_chunks(rows, serialize, fmt, chunk_size), content_type=CONTENT_TYPES[fmt])
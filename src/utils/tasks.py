@@ -1,8 +1,39 @@
 from celery import shared_task
 from .models import *
-from .emailer import send_email
+from django.conf import settings
+from .emailer import send_email, get_transport
+from .audit import from_json, write_records
 
-@shared_task(serializer='pickle')
+@shared_task
 def send_email_task(subject, body, to_email):
     send_email(subject, body, to_email)
-    return {"success": "success"}
\ No newline at end of file
+    return {"success": "success"}
+
+EMAIL_MAX_RETRIES = getattr(settings, 'EMAIL_MAX_RETRIES', 5)
+EMAIL_RETRY_DELAY = getattr(settings, 'EMAIL_RETRY_DELAY', 30)
+
+# many {"subject", "body", "to"} messages over the worker's pooled smtp session. every message is
+# reported on its own, the ones that failed for a transient reason are retried( with backoff ) as
+# a smaller batch and the counts carry over so the final result covers the whole batch
+@shared_task(bind=True, max_retries=EMAIL_MAX_RETRIES)
+def send_email_batch_task(self, messages, sent=0, failed=None):
+    failed = list(failed or [])
+    results = get_transport().send_many(messages)
+    sent += sum(1 for result in results if result["status"] == "sent")
+
+    retry = [message for message, result in zip(messages, results) if result["status"] == "failed" and result["retry"]]
+    failed += [result for result in results if result["status"] == "failed" and not result["retry"]]
+    if retry and self.request.retries < self.max_retries:
+        raise self.retry(
+            args=(retry,), kwargs={"sent": sent, "failed": failed},
+            countdown=EMAIL_RETRY_DELAY * 2 ** self.request.retries,
+        )
+    # out of retries, whatever is left counts as failed
+    failed += [result for result in results if result["status"] == "failed" and result["retry"]]
+    return {"sent": sent, "failed": failed}
+
+# batches handed over by utils.audit when AUDIT_LOG_MODE = 'celery'
+@shared_task
+def write_audit_logs_task(records):
+    write_records([from_json(record) for record in records])
+    return {"written": len(records)}
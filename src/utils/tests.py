@@ -1,3 +1,612 @@
 from django.test import TestCase
+from django.utils import timezone
+from unittest import mock, skipUnless
+from .models import Log
+from . import audit
+from .emailer import SMTPTransport
+from .tasks import send_email_batch_task
+from .results import fetch_task_meta, task_statuses
+from celery import current_app, states
+from celery.backends.cache import CacheBackend
+from django.test import Client, RequestFactory
+from django.contrib.auth.models import User
+from django.db import IntegrityError, OperationalError, transaction
+import glob
+import json
+import os
+import smtplib
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
 
-# Create your tests here.
+class AuditWriterTests(TestCase):
+    def setUp(self):
+        self.writer = audit.AuditWriter()
+        self.spool = os.path.join(tempfile.mkdtemp(), "audit_spool.jsonl")
+        patcher = mock.patch.object(audit, 'SPOOL_PATH', self.spool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    # the background writer of the running process may be adding rows of its own
+    def logs(self):
+        return Log.objects.filter(action__startswith=self.id())
+
+    def make_records(self, count):
+        return [
+            {"timestamp": timezone.now(), "action": f"{self.id()} {i}", "actor_id": None,
+             "ip_address": "127.0.0.1", "method": "POST", "metadata": {"i": i}}
+            for i in range(count)
+        ]
+
+    def test_flush_writes_batch(self):
+        records = self.make_records(5)
+        with self.assertNumQueries(1):
+            self.writer._flush(records)
+        self.assertEqual(self.logs().count(), 5)
+        self.assertEqual(self.logs().get(action=f"{self.id()} 0").timestamp, records[0]["timestamp"])
+
+    def test_failed_flush_is_spooled_and_replayed(self):
+        with mock.patch.object(audit, 'write_records', side_effect=Exception("db down")):
+            self.writer._flush(self.make_records(3))
+        self.assertEqual(self.logs().count(), 0)
+        self.assertTrue(os.path.exists(self.spool))
+
+        self.writer._flush(self.make_records(2))
+        self.assertEqual(self.logs().count(), 5)
+        self.assertFalse(os.path.exists(self.spool))
+
+    def test_poison_record_is_set_aside(self):
+        records = self.make_records(3)
+        self.writer._spool(records)
+        poison = records[1]["action"]
+        write = audit.write_records
+
+        def refuse_poison(batch):
+            if any(record["action"] == poison for record in batch):
+                raise IntegrityError("actor doesn't exist")
+            write(batch)
+
+        with mock.patch.object(audit, 'write_records', side_effect=refuse_poison):
+            self.writer._replay_spool()
+            # the others go in one at a time, the bad one waits for the next replay
+            self.assertEqual(self.logs().count(), 2)
+            self.assertTrue(os.path.exists(self.spool))
+            for _ in range(audit.MAX_REPLAYS - 1):
+                self.writer._replay_spool()
+        self.assertFalse(os.path.exists(self.spool))
+        with open(self.spool + ".rejected") as f:
+            self.assertEqual([json.loads(line)["action"] for line in f], [poison])
+        self.assertEqual(glob.glob(self.spool + ".*.replay"), [])
+
+    def test_failed_replay_goes_back_to_spool(self):
+        self.writer._spool(self.make_records(3))
+        with mock.patch.object(audit, 'write_records', side_effect=OperationalError("db down")):
+            self.writer._replay_spool()
+        self.assertEqual(glob.glob(self.spool + ".*.replay"), [])
+        with open(self.spool) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        self.writer._replay_spool()
+        self.assertEqual(self.logs().count(), 3)
+
+    def test_leftover_of_dead_worker_is_replayed(self):
+        self.writer._spool(self.make_records(2))
+        os.replace(self.spool, f"{self.spool}.999999-0.replay")
+        with mock.patch.object(audit, '_alive', return_value=False):
+            self.writer._flush(self.make_records(1))
+        self.assertEqual(self.logs().count(), 3)
+        self.assertEqual(glob.glob(self.spool + ".*"), [])
+
+    def test_record_only_enqueues(self):
+        with mock.patch.object(audit, 'MODE', 'buffered'), \
+             mock.patch.object(audit.AuditWriter, '_ensure_started'):
+            self.writer._queue = audit.queue.Queue()
+            with self.assertNumQueries(0):
+                self.writer.record("queued action", method="POST")
+        self.assertEqual(self.writer._queue.qsize(), 1)
+
+from django.contrib.auth.models import User, Permission
+from django.test import Client, RequestFactory
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import CachedJWTAuthentication
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='jwtuser', password='jwtpass')
+        self.user.user_permissions.add(Permission.objects.get(codename='view_hospital'))
+        self.token = AccessToken.for_user(self.user)
+
+    def test_user_snapshot_is_cached(self):
+        auth = CachedJWTAuthentication()
+        self.assertEqual(auth.get_user(self.token).id, self.user.id)
+        with self.assertNumQueries(0):
+            user = auth.get_user(self.token)
+        self.assertEqual((user.id, user.username, user.is_active), (self.user.id, 'jwtuser', True))
+
+    def test_deactivating_user_drops_snapshot(self):
+        auth = CachedJWTAuthentication()
+        auth.get_user(self.token)
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(Exception):
+            auth.get_user(self.token)
+
+    def test_token_validated_once_per_request(self):
+        client = Client(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+        with mock.patch.object(JWTAuthentication, 'get_validated_token', autospec=True,
+                               side_effect=JWTAuthentication.get_validated_token) as validate:
+            response = client.get('/hospitals')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(validate.call_count, 1)
+
+    def test_invalid_token_is_rejected(self):
+        client = Client(HTTP_AUTHORIZATION='Bearer not.a.token')
+        self.assertEqual(client.get('/hospitals').status_code, 401)
+
+from django.contrib.auth.models import Group
+from .backends import local_permissions
+
+class CachedPermissionBackendTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='permuser', password='permpass')
+        self.group = Group.objects.create(name='Perm Group')
+        self.user.groups.add(self.group)
+        self.group.permissions.add(Permission.objects.get(codename='view_doctor'))
+
+    def fresh_user(self):
+        # every request works on a newly loaded user, without django's per-instance cache
+        return User.objects.get(pk=self.user.pk)
+
+    def test_has_perm_without_queries_once_cached(self):
+        self.assertTrue(self.fresh_user().has_perm('doctor.view_doctor'))
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('doctor.view_doctor'))
+            self.assertFalse(user.has_perm('doctor.delete_doctor'))
+
+    def test_shared_cache_used_when_local_entry_missing(self):
+        self.fresh_user().has_perm('doctor.view_doctor')
+        local_permissions.clear()
+        user = self.fresh_user()
+        with self.assertNumQueries(0):
+            self.assertTrue(user.has_perm('doctor.view_doctor'))
+
+    def test_group_and_user_changes_invalidate(self):
+        self.assertFalse(self.fresh_user().has_perm('doctor.change_doctor'))
+        self.group.permissions.add(Permission.objects.get(codename='change_doctor'))
+        self.assertTrue(self.fresh_user().has_perm('doctor.change_doctor'))
+
+        self.user.groups.remove(self.group)
+        self.assertFalse(self.fresh_user().has_perm('doctor.view_doctor'))
+
+        self.user.user_permissions.add(Permission.objects.get(codename='delete_doctor'))
+        self.assertTrue(self.fresh_user().has_perm('doctor.delete_doctor'))
+
+        self.group.user_set.add(self.user)
+        self.assertTrue(self.fresh_user().has_perm('doctor.view_doctor'))
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+from .crypto import CryptUtils
+
+class CryptUtilsTests(TestCase):
+    def setUp(self):
+        self.cu = CryptUtils("test-key")
+
+    def test_round_trip_and_random_iv(self):
+        encrypted = self.cu.encrypt("+91 9876543210")
+        self.assertEqual(self.cu.decrypt(encrypted), "+91 9876543210")
+        self.assertNotEqual(encrypted, self.cu.encrypt("+91 9876543210"))
+
+    def test_reads_fixed_iv_values(self):
+        legacy = AES.new(self.cu.key, AES.MODE_CBC, self.cu.iv).encrypt(pad(b"9876543210", AES.block_size)).hex()
+        self.assertEqual(self.cu.decrypt(legacy), "9876543210")
+
+    def test_batch_matches_single(self):
+        values = ["9876543210", None, "", "a much longer value that spans several aes blocks", "ünïcode"]
+        self.assertEqual(self.cu.decrypt_many(self.cu.encrypt_many(values)), values)
+        self.assertEqual(self.cu.decrypt_many([]), [])
+
+    def test_blind_index(self):
+        self.assertEqual(self.cu.blind_index("9876543210"), self.cu.blind_index("9876543210"))
+        self.assertNotEqual(self.cu.blind_index("9876543210"), self.cu.blind_index("9876543211"))
+        self.assertNotEqual(self.cu.blind_index("9876543210"), CryptUtils("other-key").blind_index("9876543210"))
+
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+# local stand-in for the smtp server, remembers which session( client address ) delivered what and
+# refuses recipients starting with "bad"( 550 ) or "later"( 451 )
+class RecordingHandler:
+    def __init__(self):
+        self.delivered = []
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address.startswith("bad"):
+            return "550 no such user"
+        if address.startswith("later"):
+            return "451 try again later"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.delivered.append((session.peer, envelope.rcpt_tos[0]))
+        return "250 Message accepted for delivery"
+
+@skipUnless(Controller, "aiosmtpd is not installed")
+class SMTPTransportTests(TestCase):
+    def setUp(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.handler = RecordingHandler()
+        self.controller = Controller(self.handler, hostname="127.0.0.1", port=port)
+        self.controller.start()
+        self.addCleanup(self.controller.stop)
+        self.transport = SMTPTransport(host="127.0.0.1", port=port, use_tls=False)
+        self.addCleanup(self.transport.close)
+
+    def messages(self, *recipients):
+        return [{"subject": "hi", "body": "hello", "to": to} for to in recipients]
+
+    def test_one_session_for_many_messages(self):
+        results = self.transport.send_many(self.messages(*[f"p{i}@example.com" for i in range(5)]))
+        self.assertEqual([r["status"] for r in results], ["sent"] * 5)
+        self.assertEqual(len({peer for peer, _ in self.handler.delivered}), 1)
+
+        # the next batch still uses the same session
+        self.transport.send_many(self.messages("p5@example.com"))
+        self.assertEqual(len({peer for peer, _ in self.handler.delivered}), 1)
+
+    def test_per_message_errors(self):
+        results = self.transport.send_many(self.messages("a@example.com", "bad@example.com", "later@example.com", "b@example.com"))
+        self.assertEqual([r["status"] for r in results], ["sent", "failed", "failed", "sent"])
+        self.assertFalse(results[1]["retry"])
+        self.assertTrue(results[2]["retry"])
+        # a refused recipient doesn't cost the session
+        self.assertEqual(len({peer for peer, _ in self.handler.delivered}), 1)
+
+    def test_session_is_replaced_after_max_messages(self):
+        self.transport.max_per_connection = 2
+        self.transport.send_many(self.messages(*[f"p{i}@example.com" for i in range(5)]))
+        self.assertEqual(len({peer for peer, _ in self.handler.delivered}), 3)
+
+    def test_dropped_session_is_closed_before_reconnecting(self):
+        self.transport.send_many(self.messages("a@example.com"))
+        old = self.transport._server
+        with mock.patch.object(old, 'sendmail', side_effect=smtplib.SMTPServerDisconnected("gone")), \
+             mock.patch.object(old, 'close', wraps=old.close) as close:
+            results = self.transport.send_many(self.messages("b@example.com"))
+        self.assertEqual(results[0]["status"], "sent")
+        close.assert_called_once()
+        self.assertIsNot(self.transport._server, old)
+
+    def test_unreachable_server_fails_the_batch_fast(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            closed_port = s.getsockname()[1]
+        transport = SMTPTransport(host="127.0.0.1", port=closed_port, use_tls=False)
+        results = transport.send_many(self.messages("a@example.com", "b@example.com"))
+        self.assertEqual([r["status"] for r in results], ["failed", "failed"])
+        self.assertTrue(all(r["retry"] for r in results))
+
+    def test_batch_task(self):
+        with mock.patch('utils.tasks.get_transport', return_value=self.transport):
+            result = send_email_batch_task.apply(args=(self.messages("a@example.com", "bad@example.com"),)).get()
+        self.assertEqual(result["sent"], 1)
+        self.assertEqual([r["to"] for r in result["failed"]], ["bad@example.com"])
+
+class TaskStatusTests(TestCase):
+    def setUp(self):
+        self.backend = CacheBackend(app=current_app, backend='memory', url='memory://')
+        patcher = mock.patch('utils.results._backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ids = [str(uuid.uuid4()) for _ in range(3)]
+        self.backend.store_result(self.ids[0], {"id": 1}, states.SUCCESS)
+        self.backend.store_result(self.ids[1], None, states.STARTED)
+
+        user = User.objects.create_user(username="task-user", password="pass")
+        self.client = Client()
+        self.client.login(username="task-user", password="pass")
+
+    def test_one_mget_for_all_tasks(self):
+        with mock.patch.object(self.backend, 'mget', wraps=self.backend.mget) as mget:
+            metas = fetch_task_meta(self.ids, self.backend)
+        mget.assert_called_once()
+        self.assertEqual([metas[i]["status"] for i in self.ids], [states.SUCCESS, states.STARTED, states.PENDING])
+
+    def test_batch_endpoint(self):
+        response = self.client.get('/tasks/status?ids=' + ",".join(self.ids))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body[self.ids[0]], {"status": "Completed", "state": "SUCCESS", "result": {"id": 1}})
+        self.assertEqual(body[self.ids[1]]["status"], "In Progress")
+        self.assertEqual(body[self.ids[2]]["state"], "PENDING")
+
+        self.assertEqual(self.client.get('/tasks/status?ids=not-a-task').status_code, 400)
+        for wait in ("nan", "inf", "-inf"):
+            self.assertEqual(self.client.get(f'/tasks/status?wait={wait}&ids=' + self.ids[0]).status_code, 400)
+        statuses = task_statuses(self.ids, wait=float("nan"), backend=self.backend)
+        self.assertEqual(statuses[self.ids[2]]["status"], "In Progress")
+
+    def test_long_poll_returns_on_change(self):
+        timer = threading.Timer(0.3, self.backend.store_result, (self.ids[1], 2, states.SUCCESS))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        start = time.monotonic()
+        response = self.client.post(
+            '/tasks/status',
+            data=json.dumps({"ids": self.ids, "wait": 5, "seen": {self.ids[0]: "SUCCESS"}}),
+            content_type='application/json',
+        )
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertEqual(response.json()[self.ids[1]]["result"], 2)
+
+    def test_sync_view_waits_briefly(self):
+        with mock.patch('utils.results.SYNC_MAX_WAIT', 0.1):
+            start = time.monotonic()
+            response = self.client.get(f'/tasks/status?wait=30&ids={self.ids[2]}')
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(response.json()[self.ids[2]]["state"], "PENDING")
+
+    def test_async_long_poll(self):
+        timer = threading.Timer(0.3, self.backend.store_result, (self.ids[1], 2, states.SUCCESS))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        with mock.patch('utils.results.SYNC_MAX_WAIT', 0):
+            start = time.monotonic()
+            response = self.client.post(
+                '/async/tasks/status',
+                data=json.dumps({"ids": self.ids, "wait": 5, "seen": {self.ids[0]: "SUCCESS"}}),
+                content_type='application/json',
+            )
+            self.assertLess(time.monotonic() - start, 3)
+            self.assertEqual(response.json()[self.ids[1]]["result"], 2)
+
+            # seen under another spelling of the same id, the task has moved on since
+            start = time.monotonic()
+            response = self.client.post(
+                '/async/tasks/status',
+                data=json.dumps({"ids": self.ids[:1], "wait": 5, "seen": {self.ids[0].upper(): "PENDING"}}),
+                content_type='application/json',
+            )
+            self.assertLess(time.monotonic() - start, 3)
+            self.assertEqual(response.json()[self.ids[0]]["state"], "SUCCESS")
+
+        self.assertEqual(Client().get('/async/tasks/status?ids=' + self.ids[0]).status_code, 401)
+        for data in ({"ids": self.ids, "seen": {"not-a-task": "SUCCESS"}}, {"ids": self.ids, "seen": []}, [self.ids]):
+            response = self.client.post('/async/tasks/status', data=json.dumps(data), content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_long_poll_times_out(self):
+        with mock.patch('utils.results.POLL_INTERVAL', 0.05):
+            start = time.monotonic()
+            statuses = task_statuses(self.ids, wait=0.2, backend=self.backend)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+        self.assertEqual(statuses[self.ids[2]]["status"], "In Progress")
+
+from asgiref.sync import async_to_sync, sync_to_async
+from .async_cache import acache, adetail_key, alist_key
+from .backends import ahas_perm
+from .cache import detail_key, list_key, invalidate_instance
+
+class AsyncCacheTests(TestCase):
+    async def test_same_keys_as_sync(self):
+        self.assertEqual(await adetail_key(User, 1, 'x'), await sync_to_async(detail_key)(User, 1, 'x'))
+        self.assertEqual(await alist_key(User, 10), await sync_to_async(list_key)(User, 10))
+
+        key = await adetail_key(User, 1)
+        await acache.set(key, {"name": "cached"})
+        await sync_to_async(invalidate_instance)(User, 1)
+        self.assertNotEqual(await adetail_key(User, 1), key)
+        self.assertEqual(await acache.get(key), {"name": "cached"})
+
+    async def test_has_perm(self):
+        user = await User.objects.acreate(username="async-perms")
+        await user.user_permissions.aadd(await Permission.objects.aget(codename='view_log'))
+        user = await User.objects.aget(pk=user.pk)
+        self.assertTrue(await ahas_perm(user, 'utils.view_log'))
+        self.assertFalse(await ahas_perm(user, 'utils.delete_log'))
+        self.assertEqual(await sync_to_async(user.has_perm)('utils.view_log'), True)
+
+from django.core.cache import cache
+from . import cache as generation_cache
+
+class GenerationTests(TestCase):
+    def test_object_generations_expire(self):
+        with mock.patch.object(cache, 'add', wraps=cache.add) as add:
+            detail_key(User, 123456)
+            async_to_sync(adetail_key)(User, 654321)
+        timeouts = {}
+        for call in add.call_args_list:
+            # the async side passes the timeout positionally
+            key, _, *timeout = call.args
+            timeouts[key] = call.kwargs['timeout'] if 'timeout' in call.kwargs else timeout[0]
+        self.assertEqual(timeouts['gen:auth.user:123456'], generation_cache.OBJECT_GEN_TTL)
+        self.assertEqual(timeouts['gen:auth.user:654321'], generation_cache.OBJECT_GEN_TTL)
+        self.assertGreater(generation_cache.OBJECT_GEN_TTL, generation_cache.CACHE_TTL)
+        self.assertIsNone(generation_cache._gen_timeout('gen:auth.user'))
+        self.assertIsNone(generation_cache._gen_timeout('gen:auth.user:list'))
+        self.assertIsNone(generation_cache._gen_timeout('gen:permissions'))
+
+    def test_bump_outside_lock(self):
+        snapshot = generation_cache.write_snapshot(User)
+        incr = cache.incr
+        seen = []
+
+        def slow_incr(key, *args, **kwargs):
+            # the lock is free while redis is asked, a snapshot taken now is not trusted
+            seen.append(generation_cache._own_lock.acquire(blocking=False))
+            generation_cache._own_lock.release()
+            seen.append(generation_cache.write_snapshot(User)[1])
+            return incr(key, *args, **kwargs)
+
+        with mock.patch.object(cache, 'incr', slow_incr):
+            generation_cache._bump(generation_cache._list_gen_key(User), own=True)
+        self.assertEqual(seen, [True, None])
+        own, current = generation_cache.only_own_writes(snapshot, User)
+        self.assertTrue(own)
+        self.assertFalse(generation_cache.only_own_writes((current[0], None), User)[0])
+
+from celery import shared_task
+from rest_framework_simplejwt.tokens import AccessToken
+from hospital.models import Hospital
+from .middleware import RequestMiddleware
+from . import context
+import asyncio
+
+@shared_task
+def context_echo():
+    return context.get()
+
+class RequestContextTests(TestCase):
+    def test_audit_attribution(self):
+        user = User.objects.create_superuser(username="ctx-admin", password="pass")
+        hospital = Hospital.objects.create(name="Context Hospital", addr="x")
+        headers = {"Authorization": f"Bearer {AccessToken.for_user(user)}", "X-Request-ID": "req-42"}
+        with mock.patch('hms.signals.audit') as signal_audit, self.captureOnCommitCallbacks(execute=True):
+            response = Client().put(
+                f'/hospital/{hospital.id}', data=json.dumps({"name": "Renamed", "addr": "y"}),
+                content_type='application/json', headers=headers,
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Request-ID'], "req-42")
+        kwargs = signal_audit.record.call_args.kwargs
+        self.assertEqual((kwargs["actor_id"], kwargs["ip_address"]), (user.id, "127.0.0.1"))
+        self.assertEqual(kwargs["metadata"]["request_id"], "req-42")
+        # and gone once the request is over
+        self.assertEqual(context.get(), {})
+
+    def test_rolled_back_write_not_audited(self):
+        with mock.patch('hms.signals.audit') as signal_audit, self.captureOnCommitCallbacks(execute=True), \
+                context.bound(request_id=self.id()):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                Hospital.objects.create(name="Rolled Back Hospital", addr="x")
+                raise RuntimeError
+            kept = Hospital.objects.create(name="Kept Hospital", addr="x")
+        # what the signals queued, written the way the background writer would
+        with mock.patch.object(audit, 'MODE', 'sync'):
+            for call in signal_audit.record.call_args_list:
+                audit.audit.record(**call.kwargs)
+        hospitals = Log.objects.filter(metadata__model="Hospital", metadata__request_id=self.id())
+        self.assertEqual([log.metadata["instance_id"] for log in hospitals], [kept.id])
+
+    def test_request_id_generated_for_odd_header(self):
+        response = Client().get('/hospitals', headers={"X-Request-ID": "not a request id!"})
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+    def test_reset_when_view_raises(self):
+        def failing_view(request):
+            self.assertEqual(context.get()["request_id"], request.request_id)
+            raise RuntimeError("boom")
+
+        request = RequestFactory().get('/')
+        with self.assertRaises(RuntimeError):
+            RequestMiddleware(failing_view)(request)
+        self.assertEqual(context.get(), {})
+
+    def test_async_tasks_are_isolated(self):
+        async def handle(actor_id):
+            with context.bound(actor_id=actor_id):
+                await asyncio.sleep(0.01)
+                return context.get()["actor_id"]
+
+        async def main():
+            return await asyncio.gather(*(handle(i) for i in range(5)))
+
+        self.assertEqual(asyncio.run(main()), list(range(5)))
+
+    def test_carried_into_tasks(self):
+        with context.bound(actor_id=7, ip_address="10.0.0.1", request_id="req-7"):
+            self.assertEqual(context_echo.delay().get(), {"actor_id": 7, "ip_address": "10.0.0.1", "request_id": "req-7"})
+        self.assertEqual(context_echo.delay().get(), {})
+
+        # on a worker the header arrives as an attribute of the task request
+        context_echo.push_request(**{context.TASK_HEADER: {"actor_id": 8}})
+        try:
+            self.assertEqual(context_echo(), {"actor_id": 8})
+        finally:
+            context_echo.pop_request()
+
+import logging
+from datetime import datetime
+from . import logger
+from .logger import JsonLinesHandler, Level
+
+class LoggerTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def handler(self, **kwargs):
+        handler = JsonLinesHandler(directory=self.directory, **kwargs)
+        self.addCleanup(handler.close)
+        return handler
+
+    def record(self, level=logging.INFO, message="hello"):
+        return logger._logger.makeRecord("hms", level, __file__, 1, message, None, None, "caller")
+
+    def files(self):
+        return sorted(os.listdir(self.directory))
+
+    def lines(self, name=None):
+        name = name or f"app-{datetime.now():%Y%m%d}.jsonl"
+        with open(os.path.join(self.directory, name)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_filtered_levels_are_dropped(self):
+        with mock.patch.object(logger, '_threshold', logging.WARNING), \
+             mock.patch.object(logger._logger, 'handle') as handle:
+            logger.log(Level.INFO, "dropped")
+            logger.log(Level.DEBUG, "dropped")
+            handle.assert_not_called()
+            logger.log(Level.WARNING, "kept")
+            logger.log("error", "kept")
+        self.assertEqual([call.args[0].levelname for call in handle.call_args_list], ["WARNING", "ERROR"])
+
+    def test_record_points_at_caller(self):
+        with mock.patch.object(logger._logger, 'handle') as handle:
+            line = sys._getframe().f_lineno + 1
+            logger.log(Level.INFO, "where am i")
+        record = handle.call_args.args[0]
+        self.assertEqual((record.pathname, record.lineno), (__file__, line))
+        self.assertEqual(record.funcName, "LoggerTests.test_record_points_at_caller")
+        self.assertEqual(record.getMessage(), "where am i")
+
+    def test_json_line_shape(self):
+        handler = self.handler()
+        record = self.record(message="shape")
+        record.request_id = "req-1"
+        handler.emit(record)
+        handler.flush()
+        [line] = self.lines()
+        self.assertEqual(set(line), {"ts", "level", "file", "line", "func", "pid", "msg", "request_id"})
+        self.assertEqual((line["level"], line["file"], line["line"], line["func"]), ("INFO", __file__, 1, "caller"))
+        self.assertEqual((line["msg"], line["request_id"], line["pid"]), ("shape", "req-1", os.getpid()))
+        datetime.fromisoformat(line["ts"])
+
+    def test_full_file_continues_in_next_part(self):
+        handler = self.handler(max_bytes=500, buffer_lines=1)
+        for i in range(10):
+            handler.emit(self.record(message=f"line {i}"))
+        day = datetime.now().strftime("%Y%m%d")
+        parts = [f"app-{day}.jsonl"] + [f"app-{day}.{part}.jsonl" for part in range(1, len(self.files()))]
+        self.assertGreater(len(parts), 1)
+        self.assertEqual(self.files(), sorted(parts))
+        # a part is only left once it reached max_bytes, and the lines stay in order across parts
+        for name in parts[:-1]:
+            self.assertGreaterEqual(os.path.getsize(os.path.join(self.directory, name)), 500)
+        self.assertEqual([line["msg"] for name in parts for line in self.lines(name)], [f"line {i}" for i in range(10)])
+
+    def test_error_flushes_right_away(self):
+        handler = self.handler(buffer_lines=100)
+        handler.emit(self.record(message="buffered"))
+        self.assertEqual(self.files(), [])
+        handler.emit(self.record(logging.ERROR, "failed"))
+        self.assertEqual([line["msg"] for line in self.lines()], ["buffered", "failed"])
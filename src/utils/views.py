@@ -4,7 +4,12 @@ from rest_framework import status
 from rest_framework.permissions import IsAuthenticated
 from django.contrib.auth.decorators import permission_required
 from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from .async_views import AsyncReadView, json_response
+from .results import task_statuses, atask_statuses, MAX_TASK_IDS
 import json
+import math
+import uuid
 
 from celery.result import AsyncResult
 
@@ -23,3 +28,79 @@ class TaskView(APIView):
         except Exception as e:
             return Response({"error": str(e)}, status=500)
         
+
+# ids, wait and seen of a task status request checked and normalized, ((ids, wait, seen), None) or
+# (None, error). task ids are compared as strings, "ABC..." in seen is the same task as "abc..."
+def task_status_args(ids, wait, seen):
+    try:
+        ids = list(dict.fromkeys(str(uuid.UUID(str(task_id))) for task_id in ids))
+        wait = float(wait)
+        if not math.isfinite(wait):
+            raise ValueError(wait)  # nan would never reach the deadline
+    except (TypeError, ValueError):
+        return None, "ids must be task ids and wait a number of seconds"
+    if not ids or len(ids) > MAX_TASK_IDS:
+        return None, f"Pass between 1 and {MAX_TASK_IDS} task ids"
+    if seen is not None:
+        try:
+            seen = {str(uuid.UUID(str(task_id))): state for task_id, state in seen.items()}
+        except (AttributeError, TypeError, ValueError):
+            return None, "seen must map task ids to states"
+    return (ids, wait, seen), None
+
+# status of many tasks in one call, GET /tasks/status?ids=<id>,<id>&wait=2 or a POST of
+# {"ids": [...], "wait": 2, "seen": {"<id>": "<state>"}}. with wait the answer comes as soon as any
+# task leaves the state the client last saw( seen, else its state when the request came in ). this
+# one waits TASK_STATUS_SYNC_MAX_WAIT at most, long polls go to /async/tasks/status
+class TaskStatusView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        ids = [task_id for task_id in request.query_params.get("ids", "").split(",") if task_id]
+        return self.respond(ids, request.query_params.get("wait", 0), None)
+
+    def post(self, request):
+        return self.respond(request.data.get("ids", []), request.data.get("wait", 0), request.data.get("seen"))
+
+    def respond(self, ids, wait, seen):
+        args, error = task_status_args(ids, wait, seen)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            ids, wait, seen = args
+            return Response(task_statuses(ids, wait=wait, seen=seen))
+        except Exception as e:
+            return Response({"error": str(e)}, status=500)
+
+# the same under /async/, up to TASK_STATUS_MAX_WAIT( 30 s ). under asgi a waiting request is a
+# coroutine sleeping on the event loop and holds no worker
+class AsyncTaskStatusView(AsyncReadView):
+    # it only reads, and jwt clients send no csrf token( DRF's APIView is exempt the same way )
+    @classmethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def get(self, request):
+        ids = [task_id for task_id in request.GET.get("ids", "").split(",") if task_id]
+        return await self.respond(ids, request.GET.get("wait", 0), None)
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            return json_response({"error": "Expected a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+        return await self.respond(data.get("ids", []), data.get("wait", 0), data.get("seen"))
+
+    async def respond(self, ids, wait, seen):
+        args, error = task_status_args(ids, wait, seen)
+        if error:
+            return json_response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            ids, wait, seen = args
+            return json_response(await atask_statuses(ids, wait=wait, seen=seen))
+        except Exception as e:
+            return json_response({"error": str(e)}, status=500)